@@ -0,0 +1,214 @@
+"""
+Offline benchmark of the collector transform path. Synthetic SHOW results are
+served to the collectors in place of pgbouncer, so that the benchmark measures
+only the exporter work: from the query results through to the text exposition.
+
+Usage:
+    python -m benchmarks.benchmark_collector --databases 1000 --users 5 --targets 10 --output results.json
+    python -m benchmarks.benchmark_collector --compare results.json
+"""
+
+import argparse
+import gc
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from prometheus_client.exposition import generate_latest
+from prometheus_pgbouncer_exporter.config import PgbouncerConfig
+from prometheus_pgbouncer_exporter.collector import PgbouncerMetricsCollector, PgbouncersMetricsCollector
+from prometheus_pgbouncer_exporter.pgwire import QueryResult
+
+
+def generate_results(databases, users, configKeys=100):
+    """
+    Generate the results of the SHOW queries of a pgbouncer >= 1.8 with the given
+    number of databases and users (a pool for each database and user pair).
+    """
+    names = ["database_{index}".format(index=index) for index in range(databases)]
+    userNames = ["user_{index}".format(index=index) for index in range(users)]
+
+    stats = QueryResult(
+        columns=("database", "total_xact_count", "total_query_count", "total_received", "total_sent", "total_xact_time", "total_query_time", "total_wait_time"),
+        rows=[(name, index * 7, index * 11, index * 1024, index * 2048, index * 13, index * 17, index * 3) for index, name in enumerate(names)])
+
+    pools = QueryResult(
+        columns=("database", "user", "cl_active", "cl_waiting", "sv_active", "sv_idle", "sv_used", "sv_tested", "sv_login", "maxwait", "maxwait_us", "pool_mode"),
+        rows=[(name, user, 10, 2, 8, 2, 1, 0, 0, 1, 250000, "transaction") for name in names for user in userNames])
+
+    dbs = QueryResult(
+        columns=("name", "host", "port", "database", "force_user", "pool_size", "reserve_pool", "pool_mode", "max_connections", "current_connections"),
+        rows=[(name, "localhost", 5432, name, None, 20, 5, None, 0, 10) for name in names])
+
+    config = QueryResult(
+        columns=("key", "value", "default", "changeable"),
+        rows=[("max_client_conn", "10000", "100", "yes"), ("max_user_connections", "0", "0", "yes")] +
+             [("setting_{index}".format(index=index), str(index), "0", "yes") for index in range(configKeys - 2)])
+
+    version = QueryResult(columns=("version",), rows=[("PgBouncer 1.21.0",)])
+
+    return {"SHOW STATS": stats, "SHOW POOLS": pools, "SHOW DATABASES": dbs, "SHOW CONFIG": config, "SHOW VERSION": version}
+
+
+class StubConnection():
+    """
+    A persistent connection which is always usable, so that the benchmark measures
+    the steady state path (the version and the query plans detected once).
+    """
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def stub_collector(collector, results):
+    """
+    Serve the synthetic results to the collector instead of querying pgbouncer.
+    """
+    collector._createConnection = lambda timeout: StubConnection()
+    collector._isConnectionUsable = lambda conn: True
+    collector._fetchMetrics = lambda conn, query: results.get(query, False)
+
+    return collector
+
+
+def build_transform_case(args, results):
+    collector = stub_collector(PgbouncerMetricsCollector(PgbouncerConfig({"extra_labels": {"pool_id": 0}})), results)
+
+    def run():
+        count = 0
+        for _ in collector.collect():
+            count += 1
+
+        return count
+
+    return run
+
+
+def build_exposition_case(args, results):
+    configs = [PgbouncerConfig({"extra_labels": {"pool_id": index}}) for index in range(args.targets)]
+    collector = PgbouncersMetricsCollector(configs, concurrency=args.concurrency)
+
+    for target in collector.collectors:
+        stub_collector(target, results)
+
+    class Registry():
+        def collect(self):
+            return collector.collect()
+
+    registry = Registry()
+
+    def run():
+        return len(generate_latest(registry))
+
+    return run
+
+
+CASES = {
+    "transform":  build_transform_case,
+    "exposition": build_exposition_case,
+}
+
+
+def measure(run, iterations):
+    # Warm up (ie. compile the query plans)
+    run()
+
+    timings = []
+    for _ in range(iterations):
+        gc.collect()
+        start = time.perf_counter()
+        output = run()
+        timings.append(time.perf_counter() - start)
+
+    # Measure the allocations on a separate run, because tracing slows it down
+    gc.collect()
+    tracemalloc.start()
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "output_size":             output,
+        "wall_seconds_min":        min(timings),
+        "wall_seconds_mean":       statistics.mean(timings),
+        "wall_seconds_median":     statistics.median(timings),
+        "wall_seconds_max":        max(timings),
+        "tracemalloc_peak_bytes":  peak,
+        "tracemalloc_net_bytes":   current,
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def compare(baseline, report):
+    """
+    Print the relative change of each measure against a previous report.
+    """
+    previous = {case["name"]: case for case in baseline["cases"]}
+
+    for case in report["cases"]:
+        if case["name"] not in previous:
+            continue
+
+        for key in ["wall_seconds_median", "tracemalloc_peak_bytes"]:
+            before = previous[case["name"]][key]
+            after = case[key]
+            change = (after - before) / before * 100 if before else 0
+            print("{case:<12} {key:<24} {before:>14.6g} -> {after:>14.6g} ({change:+.1f}%)".format(
+                case=case["name"], key=key, before=before, after=after, change=change), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the collector transform path on synthetic pgbouncer results")
+    parser.add_argument("--databases",   help="Number of databases per pgbouncer", type=int, default=1000)
+    parser.add_argument("--users",       help="Number of users per database", type=int, default=5)
+    parser.add_argument("--targets",     help="Number of pgbouncers (exposition case only)", type=int, default=10)
+    parser.add_argument("--concurrency", help="Scrape concurrency (exposition case only)", type=int, default=10)
+    parser.add_argument("--iterations",  help="Number of measured iterations per case", type=int, default=10)
+    parser.add_argument("--case",        help="Cases to run", choices=list(CASES.keys()), action="append")
+    parser.add_argument("--output",      help="Path to the JSON report, or '-' for stdout", default="-")
+    parser.add_argument("--compare",     help="Path to a previous JSON report to compare against")
+    args = parser.parse_args()
+
+    results = generate_results(args.databases, args.users)
+    report = {
+        "commit":     get_git_commit(),
+        "python":     platform.python_version(),
+        "parameters": {"databases": args.databases, "users": args.users, "targets": args.targets, "concurrency": args.concurrency, "iterations": args.iterations},
+        "cases":      [],
+    }
+
+    for name in args.case or list(CASES.keys()):
+        measures = measure(CASES[name](args, results), args.iterations)
+        report["cases"].append(dict(name=name, **measures))
+
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report["peak_rss_bytes"] = maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    output = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import bisect
+import calendar
+import functools
+import ipaddress
+import time
+from datetime import datetime
+from prometheus_client.utils import floatToGoString
+from .metrics import Sample
+
+# The buckets (in seconds) of the connections wait and age histograms
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+AGE_BUCKETS = (1.0, 10.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 21600.0, 86400.0, 604800.0)
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_pgbouncer_timestamp(value):
+    """
+    Parse a timestamp returned by SHOW CLIENTS and SHOW SERVERS (ie. "2024-01-31 10:00:00 UTC")
+    into seconds since the epoch, or None if unparsable. Parsed timestamps are cached,
+    because many connections share the same (second resolution) timestamp.
+    """
+    try:
+        value, _, timezone = value.rpartition(" ")
+        parsed = datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timetuple()
+    except (AttributeError, ValueError):
+        return None
+
+    # pgbouncer formats the timestamps in its local time zone
+    return calendar.timegm(parsed) if timezone in ("UTC", "GMT") else time.mktime(parsed)
+
+
+class Histogram():
+    """
+    A histogram with fixed buckets, exported as the cumulative buckets and sum
+    expected by the histogram metric family.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def export(self):
+        # Cumulative buckets, as expected by the histogram metric family
+        buckets = []
+        total = 0
+
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            buckets.append((floatToGoString(bound), total))
+
+        return buckets, self.sum
+
+
+class ConnectionsAggregator():
+    """
+    Folds the rows returned by SHOW CLIENTS or SHOW SERVERS, as they're read, into
+    histograms of the connection age, the request age and (optionally) the wait time
+    of the waiting connections, per database and user. The memory used is bounded by
+    the number of pools, regardless of the number of connections.
+    """
+
+    def __init__(self, metricPrefix, observeWait, now=None):
+        self.metricPrefix = metricPrefix
+        self.observeWait = observeWait
+        self.now = now or time.time()
+        self.pools = {}
+
+    def begin(self, columns):
+        positions = {column: index for index, column in enumerate(columns)}
+
+        missing = [column for column in ("database", "user") if column not in positions]
+        if missing:
+            raise Exception("Missing label columns {columns}".format(columns=", ".join(missing)))
+
+        self.databaseIndex = positions["database"]
+        self.userIndex = positions["user"]
+        self.connectTimeIndex = positions.get("connect_time")
+        self.requestTimeIndex = positions.get("request_time")
+        self.stateIndex = positions.get("state")
+        self.waitIndexes = (positions["wait"], positions["wait_us"]) if "wait" in positions and "wait_us" in positions else None
+
+    def add(self, row):
+        key = (row[self.databaseIndex], row[self.userIndex])
+
+        histograms = self.pools.get(key)
+        if histograms is None:
+            histograms = self.pools[key] = (Histogram(AGE_BUCKETS), Histogram(AGE_BUCKETS), Histogram(WAIT_BUCKETS))
+
+        if self.connectTimeIndex is not None:
+            connectedAt = parse_pgbouncer_timestamp(row[self.connectTimeIndex])
+            if connectedAt is not None:
+                histograms[0].observe(max(0, self.now - connectedAt))
+
+        if self.requestTimeIndex is not None:
+            requestedAt = parse_pgbouncer_timestamp(row[self.requestTimeIndex])
+            if requestedAt is not None:
+                histograms[1].observe(max(0, self.now - requestedAt))
+
+        if self.observeWait and self.waitIndexes and self.stateIndex is not None and str(row[self.stateIndex]).startswith("waiting"):
+            histograms[2].observe(int(row[self.waitIndexes[0]]) + int(row[self.waitIndexes[1]]) / 1000000.0)
+
+    def export(self, databaseFilter, extraLabelNames, extraLabelValues):
+        labelNames = ("database", "user") + extraLabelNames
+
+        for (database, user), (connectionAge, requestAge, wait) in self.pools.items():
+            if not databaseFilter(database):
+                continue
+
+            labelValues = (database, user) + extraLabelValues
+
+            yield Sample("histogram", self.metricPrefix + "connection_age_seconds", "Age of the connections", labelNames, labelValues, connectionAge.export())
+            yield Sample("histogram", self.metricPrefix + "request_age_seconds", "Time since the last request of the connections", labelNames, labelValues, requestAge.export())
+
+            if self.observeWait:
+                yield Sample("histogram", self.metricPrefix + "wait_seconds", "Time the waiting connections have been waiting for a server connection", labelNames, labelValues, wait.export())
+
+
+class ApplicationsAggregator():
+    """
+    Counts the active and waiting clients returned by SHOW CLIENTS per database and
+    application_name (and optionally client address prefix). The applications of each
+    database are tracked with the Space-Saving heavy hitters algorithm, so that only
+    the topK busiest ones get their own series while the other ones are folded into
+    the "__other__" series, regardless of how many distinct clients connect.
+    """
+
+    def __init__(self, topK, addressPrefixLength=0):
+        self.topK = topK
+        self.addressPrefixLength = addressPrefixLength
+        self.summaries = {}
+        self.totals = {}
+
+    def begin(self, columns):
+        positions = {column: index for index, column in enumerate(columns)}
+
+        required = ["database", "application_name", "state"] + (["addr"] if self.addressPrefixLength else [])
+        missing = [column for column in required if column not in positions]
+        if missing:
+            raise Exception("Missing label columns {columns}".format(columns=", ".join(missing)))
+
+        self.databaseIndex = positions["database"]
+        self.applicationIndex = positions["application_name"]
+        self.stateIndex = positions["state"]
+        self.addressIndex = positions.get("addr")
+
+    def add(self, row):
+        database = row[self.databaseIndex]
+        waiting = 1 if str(row[self.stateIndex]).startswith("waiting") else 0
+
+        if database not in self.summaries:
+            self.summaries[database] = _SpaceSaving(self.topK)
+            self.totals[database] = [0, 0]
+
+        self.totals[database][waiting] += 1
+
+        key = row[self.applicationIndex] or ""
+        if self.addressPrefixLength:
+            key = (key, compute_address_prefix(row[self.addressIndex], self.addressPrefixLength))
+
+        self.summaries[database].add(key, waiting)
+
+    def export(self, databaseFilter, extraLabelNames, extraLabelValues):
+        labelNames = ("database", "application_name") + (("address_prefix",) if self.addressPrefixLength else ()) + extraLabelNames
+        other = ("__other__", "__other__") if self.addressPrefixLength else ("__other__",)
+
+        for database, summary in self.summaries.items():
+            if not databaseFilter(database):
+                continue
+
+            # The applications not tracked (or tracked only since they replaced another
+            # one) are accounted in the __other__ series, so that the totals are exact
+            otherActive, otherWaiting = self.totals[database]
+
+            for key, (_, _, active, waiting) in summary.top():
+                otherActive -= active
+                otherWaiting -= waiting
+                yield from self._exportSamples(labelNames, (database,) + (key if self.addressPrefixLength else (key,)) + extraLabelValues, active, waiting)
+
+            yield from self._exportSamples(labelNames, (database,) + other + extraLabelValues, otherActive, otherWaiting)
+
+    def _exportSamples(self, labelNames, labelValues, active, waiting):
+        yield Sample("gauge", "pgbouncer_clients_application_active_connections", "Client connections of the busiest applications which are not waiting for a server connection", labelNames, labelValues, active)
+        yield Sample("gauge", "pgbouncer_clients_application_waiting_connections", "Client connections of the busiest applications which are waiting for a server connection", labelNames, labelValues, waiting)
+
+
+@functools.lru_cache(maxsize=8192)
+def compute_address_prefix(address, prefixLength):
+    """
+    Returns the network of the given IPv4 prefix length (or /64 for IPv6) the client
+    address belongs to, or the address itself if not an IP address (ie. unix socket).
+    """
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return str(address)
+
+    return str(ipaddress.ip_network("{ip}/{length}".format(ip=ip, length=prefixLength if ip.version == 4 else 64), strict=False))
+
+
+class _SpaceSaving():
+    """
+    Space-Saving summary of the most frequent keys of a stream, keeping at most
+    `capacity` counters. Each counter is a list of [count, error, active, waiting],
+    where count overestimates the key frequency by at most error, while active and
+    waiting are exact since the key is tracked.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+
+    def add(self, key, waiting):
+        counter = self.counters.get(key)
+
+        if counter is None:
+            if len(self.counters) < self.capacity:
+                counter = self.counters[key] = [0, 0, 0, 0]
+            else:
+                # Replace the key with the lowest count, inheriting it as error
+                evicted = min(self.counters, key=lambda item: self.counters[item][0])
+                minimum = self.counters.pop(evicted)[0]
+                counter = self.counters[key] = [minimum, minimum, 0, 0]
+
+        counter[0] += 1
+        counter[3 if waiting else 2] += 1
+
+    def top(self):
+        return sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)
+
+
+class AggregatorsGroup():
+    """
+    Feeds the rows of a single query to all the aggregators interested in them.
+    """
+
+    def __init__(self, aggregators):
+        self.aggregators = aggregators
+        self.rowCount = 0
+
+    def begin(self, columns):
+        for aggregator in self.aggregators:
+            aggregator.begin(columns)
+
+    def add(self, row):
+        self.rowCount += 1
+
+        for aggregator in self.aggregators:
+            aggregator.add(row)
+
+    def export(self, databaseFilter, extraLabelNames, extraLabelValues):
+        for aggregator in self.aggregators:
+            yield from aggregator.export(databaseFilter, extraLabelNames, extraLabelValues)
@@ -0,0 +1,110 @@
+import logging
+import random
+import threading
+
+
+# The states of a circuit breaker
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATES = [CLOSED, OPEN, HALF_OPEN]
+
+
+class CircuitBreaker():
+    """
+    Tracks the consecutive connection failures of a pgbouncer. Once they reach the
+    failure threshold the circuit opens: the pgbouncer is reported down without
+    connecting to it, while it's re-probed in background with an exponential backoff
+    (plus jitter) until a probe succeeds and the circuit is closed again.
+    """
+
+    def __init__(self, name, probe, failureThreshold=3, backoffInitial=1, backoffMax=60):
+        self.name = name
+        self.probe = probe
+        self.failureThreshold = failureThreshold
+        self.backoffInitial = backoffInitial
+        self.backoffMax = backoffMax
+
+        self.state = CLOSED
+        self.failures = 0
+        self.backoff = backoffInitial
+        self.transitions = dict.fromkeys(STATES, 0)
+        self.lock = threading.Lock()
+        self.timer = False
+        self.stopped = False
+
+    def isEnabled(self):
+        return self.failureThreshold > 0
+
+    def isOpen(self):
+        return self.state != CLOSED
+
+    def recordSuccess(self):
+        with self.lock:
+            self.failures = 0
+
+            if self.state != CLOSED:
+                logging.getLogger().info("Closing the circuit breaker of {name} because it's reachable again".format(name=self.name))
+                self.backoff = self.backoffInitial
+                self._transition(CLOSED)
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.state == CLOSED and self.isEnabled() and self.failures >= self.failureThreshold:
+                logging.getLogger().warning("Opening the circuit breaker of {name} after {failures} consecutive failures".format(name=self.name, failures=self.failures))
+                self._transition(OPEN)
+                self._schedule()
+            elif self.state == HALF_OPEN:
+                self.backoff = min(self.backoff * 2, self.backoffMax)
+                self._transition(OPEN)
+                self._schedule()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+
+            if self.timer:
+                self.timer.cancel()
+                self.timer = False
+
+    def export(self):
+        """
+        Returns a tuple of (state values, transition counts) keyed by state.
+        """
+        with self.lock:
+            return {state: 1 if state == self.state else 0 for state in STATES}, dict(self.transitions)
+
+    def getNextProbeDelay(self):
+        # Add up to 20% of jitter, so that the probes of the pgbouncers that went down
+        # at the same time don't stay in sync
+        return self.backoff * random.uniform(1, 1.2)
+
+    def _transition(self, state):
+        self.state = state
+        self.transitions[state] += 1
+
+    def _schedule(self):
+        if self.stopped:
+            return
+
+        self.timer = threading.Timer(self.getNextProbeDelay(), self._probe)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _probe(self):
+        with self.lock:
+            if self.stopped or self.state != OPEN:
+                return
+
+            self._transition(HALF_OPEN)
+
+        # The probe records its own success or failure
+        try:
+            self.probe()
+        except Exception as error:
+            logging.getLogger().debug("Unable to probe {name}".format(name=self.name), extra={"exception": str(error)})
+
+        if self.state == HALF_OPEN:
+            self.recordFailure()
@@ -1,14 +1,21 @@
 import logging
 import sys
+import select
 import signal
-import time
 import argparse
 import os
-from prometheus_client import start_http_server
+from prometheus_client import GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR
 from prometheus_client.core import REGISTRY
 from pythonjsonlogger import jsonlogger
 from .config import Config
-from .collector import PgbouncersMetricsCollector
+from .collector import CachedMetricsSnapshots, PgbouncersMetricsCollector, PgbouncersMetricsPoller
+from .discovery import FileDiscovery
+from .sharding import Shard
+from .server import SnapshotExposition, start_http_server
+
+# The maximum number of seconds to wait for each background thread on shutdown, so
+# that a pgbouncer which doesn't respond can't hold the exporter up
+SHUTDOWN_TIMEOUT = 1
 
 
 def read_config_file(config_file):
@@ -40,8 +47,15 @@ def main():
     parser.add_argument("--config",     help="Path to config file", default="config.yml")
     parser.add_argument("--log-level",  help="Minimum log level. Accepted values are: DEBUG, INFO, WARNING, ERROR, CRITICAL", default="INFO")
     parser.add_argument("--log-file",   help="Path to log file or 'stdout' to log on console. Signal with -HUP to re-open log file descriptor", default="stdout")
+    parser.add_argument("--shard-index", help="Index of this exporter replica, from 0 to --shard-count minus 1, when splitting the pgbouncers across multiple replicas", type=int, default=0)
+    parser.add_argument("--shard-count", help="Number of exporter replicas the pgbouncers are split across", type=int, default=1)
     args = parser.parse_args()
 
+    try:
+        shard = Shard(args.shard_index, args.shard_count)
+    except Exception as error:
+        parser.error(str(error))
+
     # Init logger
     logHandler = logging.FileHandler(args.log_file) if args.log_file is not "stdout" else logging.StreamHandler()
     formatter = jsonlogger.JsonFormatter("%(asctime)s %(levelname)s %(message)s`", datefmt="%Y-%m-%d %H:%M:%S")
@@ -73,25 +87,75 @@ def main():
     signal.signal(signal.SIGINT, _on_sigterm)
     signal.signal(signal.SIGTERM, _on_sigterm)
 
+    # Wake up the main loop as soon as a signal is received
+    wakeupReader, wakeupWriter = os.pipe()
+    os.set_blocking(wakeupWriter, False)
+    signal.set_wakeup_fd(wakeupWriter)
+
     # Read config file
     config = read_config_file(args.config)
 
     # Register our custom collector
-    pgbcollector = PgbouncersMetricsCollector(config.getPgbouncers())
-    REGISTRY.register(pgbcollector)
+    pgbcollector = PgbouncersMetricsCollector(config.getPgbouncers(), config.getScrapeConcurrency(), config.getCacheTtl(), config.getEngine(), config.getScrapeTimeout(), config.getScrapeTimeoutOffset(), shard, config.getProbeCacheSize(), config.getProbeIdleTimeout())
+    logging.getLogger().info("Exporter shard {index} of {count} owns {targets} pgbouncers".format(index=shard.index, count=shard.count, targets=len(pgbcollector.collectors)))
+
+    # Discover the pgbouncers from files, if configured. The discovery is always created
+    # so that it can be enabled with a config reload.
+    discovery = FileDiscovery(config.getFileSdConfigs(), pgbcollector.updateDiscovered)
+    discovery.refresh()
+    discovery.start()
+
+    # In polling mode, pgbouncers are scraped in background and the exporter serves the latest snapshot
+    pgbpoller = False
+    snapshotExposition = False
+    if config.getPollingInterval() > 0:
+        # The process metrics are included in the snapshot too, so that the whole
+        # exposition can be rendered once per snapshot and served as is
+        processCollectors = [GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR]
+        for collector in processCollectors:
+            REGISTRY.unregister(collector)
+
+        pgbpoller = PgbouncersMetricsPoller(pgbcollector, config.getPollingInterval(), processCollectors)
+        pgbpoller.start()
+        REGISTRY.register(pgbpoller)
+        snapshotExposition = SnapshotExposition(pgbpoller)
+        logging.getLogger().info("Exporter polling pgbouncers every {interval} seconds".format(interval=config.getPollingInterval()))
+    else:
+        REGISTRY.register(pgbcollector)
+
+        # With a cache TTL, the exposition is rendered once per cached collection too, while
+        # the requests filtering by metric names are still served from the registry
+        if config.getCacheTtl() > 0:
+            snapshotExposition = SnapshotExposition(CachedMetricsSnapshots(pgbcollector, [GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR]))
 
     # Start server
-    start_http_server(config.getExporterPort(), config.getExporterHost())
+    start_http_server(config.getExporterPort(), config.getExporterHost(), REGISTRY, snapshotExposition, pgbcollector)
     logging.getLogger().info("Exporter listening on {host}:{port}".format(host=config.getExporterHost(), port=config.getExporterPort()))
 
     while not shutdown:
-        # check if HUPs were received in the last cycle and subsequently reload the pgbouncer hosts
+        # check if HUPs were received since the last wake up and subsequently reload the pgbouncer hosts
         if sighup_received_count:
             logging.getLogger().info("Processing SIGHUP - Reloading pgbouncer hosts")
             sighup_received_count = 0
             config = read_config_file(args.config)
             pgbcollector.update(config.getPgbouncers())
-        time.sleep(4)
+            discovery.reconfigure(config.getFileSdConfigs())
+
+        # Wait for the next signal. The signal handlers run before select() returns.
+        if not shutdown and not sighup_received_count:
+            select.select([wakeupReader], [], [])
+            os.read(wakeupReader, 4096)
+
+    signal.set_wakeup_fd(-1)
+    os.close(wakeupReader)
+    os.close(wakeupWriter)
+
+    # Stop discovering and polling, and close the persistent connections to pgbouncer
+    # (without waiting for the scrapes in progress)
+    discovery.stop(SHUTDOWN_TIMEOUT)
+    if pgbpoller:
+        pgbpoller.stop(SHUTDOWN_TIMEOUT)
+    pgbcollector.close()
 
     logging.getLogger().info("Exporter has shutdown")
 
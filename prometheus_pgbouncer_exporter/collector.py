@@ -1,210 +1,1392 @@
+import asyncio
 import psycopg2
+import psycopg2.extensions
 import logging
+import math
+import re
+import select
+import sys
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from typing import List
-from psycopg2.extras import DictCursor
-from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from .aggregators import AggregatorsGroup, ApplicationsAggregator, ConnectionsAggregator, Histogram
+from .breaker import CircuitBreaker
 from .config import PgbouncerConfig
+from .connection import close_connection, create_connection, fetch_query_result
+from .limiter import TopDatabasesLimiter
+from .metrics import Sample, compute_maxwait_seconds
+from .sampler import PoolsSampler
+from .sharding import Shard
+from .watchdog import QUERY_WATCHDOG
+from . import pgwire
+
+
+# The scrape timeout requested by the client of the current thread
+_scrapeContext = threading.local()
+
+# The buckets (in seconds) of the connect and query duration histograms
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The number of rows folded at once by the connections aggregators
+FETCH_BATCH_SIZE = 1000
+
+# The pattern used to extract the version number from SHOW VERSION
+VERSION_PATTERN = re.compile(r'(\d+)\.(\d+)(?:\.(\d+))?')
+
+# A plan to export the metrics from the rows returned by a query, compiled once per
+# connection from the returned columns (see compile_query_plan())
+QueryPlan = namedtuple("QueryPlan", ["databaseIndex", "labelNames", "labelIndexes", "metrics"])
+PlannedMetric = namedtuple("PlannedMetric", ["type", "name", "help", "indexes", "compute", "rollup"])
+
+# The admin console queries run on each scrape
+QUERIES = ["SHOW STATS", "SHOW POOLS", "SHOW DATABASES", "SHOW CONFIG"]
+
+# The collector running each of the queries above
+QUERY_COLLECTORS = {"SHOW STATS": "stats", "SHOW POOLS": "pools", "SHOW DATABASES": "databases", "SHOW CONFIG": "config"}
+
+# The queries returning mostly static results, which are cached for config_cache_ttl
+# seconds on a persistent connection
+CACHED_QUERIES = ["SHOW CONFIG"]
+
+# The metrics exported from each SHOW query returning a row per database (or pool).
+# Each entry is a tuple of (query, metric prefix, metric mappings, label mappings).
+EXPORTED_QUERIES = [
+    ("SHOW STATS", "pgbouncer_stats_", [
+        # pgbouncer < 1.8
+        {"type": "counter", "column": "total_requests",    "metric": "requests_total",                     "help": "Total number of requests pooled. Could be transactions or queries, depending on pool mode.", "until": (1, 8)},
+
+        # pgbouncer >= 1.8
+        {"type": "counter", "column": "total_xact_count",  "metric": "transactions_total",                 "help": "Total number of transactions pooled", "since": (1, 8)},
+        {"type": "counter", "column": "total_query_count", "metric": "queries_total",                      "help": "Total number of queries pooled", "since": (1, 8)},
+        {"type": "counter", "column": "total_xact_time",   "metric": "transactions_duration_microseconds", "help": "Total number of microseconds spent in a transaction. Includes time spent waiting for an available connection.", "since": (1, 8)},
+        {"type": "counter", "column": "total_wait_time",   "metric": "waiting_duration_microseconds",      "help": "Total number of microseconds spent waiting for an available connection.", "since": (1, 8)},
+
+        # all versions
+        {"type": "counter", "column": "total_query_time",  "metric": "queries_duration_microseconds",      "help": "Total number of microseconds spent waiting for a server to return a query response. Includes time spent waiting for an available connection."},
+        {"type": "counter", "column": "total_received",    "metric": "received_bytes_total",               "help": "Total volume in bytes of network traffic received by pgbouncer"},
+        {"type": "counter", "column": "total_sent",        "metric": "sent_bytes_total",                   "help": "Total volume in bytes of network traffic sent by pgbouncer"},
+    ], {"database": "database"}),
+
+    ("SHOW POOLS", "pgbouncer_pools_", [
+        {"type": "gauge", "column": "cl_active",              "metric": "client_active_connections",   "help": "Client connections that are linked to server connection and can process queries"},
+        {"type": "gauge", "column": "cl_waiting",             "metric": "client_waiting_connections",  "help": "Client connections have sent queries but have not yet got a server connection"},
+        {"type": "gauge", "column": "sv_active",              "metric": "server_active_connections",   "help": "Server connections that linked to client"},
+        {"type": "gauge", "column": "sv_idle",                "metric": "server_idle_connections",     "help": "Server connections that unused and immediately usable for client queries"},
+        {"type": "gauge", "column": "sv_used",                "metric": "server_used_connections",     "help": "Server connections that have been idle more than server_check_delay, so they needs server_check_query to run on it before it can be used"},
+        {"type": "gauge", "column": "sv_tested",              "metric": "server_testing_connections",  "help": "Server connections that are currently running either server_reset_query or server_check_query"},
+        {"type": "gauge", "column": "sv_login",               "metric": "server_login_connections",    "help": "Server connections currently in logging in process"},
+        {"type": "gauge", "compute": compute_maxwait_seconds, "columns": ["maxwait", "maxwait_us"], "metric": "client_maxwait_seconds", "help": "How long the first (oldest) client in queue has waited, in seconds", "rollup": "max"},
+    ], {"database": "database", "user": "user"}),
+
+    ("SHOW DATABASES", "pgbouncer_databases_", [
+        {"type": "gauge", "column": "pool_size",           "metric": "database_pool_size",           "help": "Configured Pool Size Limit"},
+        {"type": "gauge", "column": "reserve_pool",        "metric": "database_reserve_pool_size",   "help": "Configured Reserve Limit"},
+        {"type": "gauge", "column": "current_connections", "metric": "database_current_connections", "help": "Database connection count"},
+        {"type": "gauge", "column": "max_connections",     "metric": "database_max_connections",     "help": "Database maximum number of allowed connections"},
+    ], {"name": "database", "database": "backend_database"}),
+]
+
+# The optional queries returning a row per connection, folded into aggregated metrics
+# while read. Each entry is a tuple of (query, [(collector name, aggregator factory)]).
+AGGREGATED_QUERIES = [
+    ("SHOW CLIENTS", [
+        ("clients", lambda config: ConnectionsAggregator("pgbouncer_clients_", observeWait=True)),
+        ("applications", lambda config: ApplicationsAggregator(config.getApplicationsTopK(), config.getApplicationsAddressPrefixLength())),
+    ]),
+    ("SHOW SERVERS", [
+        ("servers", lambda config: ConnectionsAggregator("pgbouncer_servers_", observeWait=False)),
+    ]),
+]
+
+# The SHOW POOLS columns of the server connections counted against the pool size
+SERVER_CONNECTION_COLUMNS = ["sv_active", "sv_idle", "sv_used", "sv_tested", "sv_login"]
+
+# The metrics exported from SHOW CONFIG, which returns a row per config key
+CONFIG_METRICS = [
+    {"type": "gauge", "key": "max_client_conn",      "metric": "max_client_conn",      "help": "Config maximum number of client connections"},
+    {"type": "gauge", "key": "max_user_connections", "metric": "max_user_connections", "help": "Config maximum number of server connections per user"},
+]
+
+
+def close_in_background(collectors):
+    """
+    Close the collectors from a background thread, so that the caller (ie. the main
+    loop reloading the config) is never blocked by a pgbouncer which doesn't respond.
+    """
+    if not collectors:
+        return
+
+    def close():
+        for collector in collectors:
+            try:
+                collector.close()
+            except Exception as error:
+                logging.getLogger().debug("Unable to close the collector of {dsn}".format(dsn=collector.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+
+    threading.Thread(target=close, name="pgbouncer-closer", daemon=True).start()
+
+
+def parse_pgbouncer_version(version):
+    """
+    Parse the version string returned by SHOW VERSION (ie. "PgBouncer 1.21.0")
+    into a tuple of integers, or None if unparsable.
+    """
+    match = VERSION_PATTERN.search(version or "")
+
+    return tuple(int(part) for part in match.groups() if part is not None) if match else None
+
+
+def compile_query_plan(columns, version, metricPrefix, metricMappings, labelMappings):
+    """
+    Compile the metric and label mappings of a query into a plan of column indexes,
+    given the columns returned by the query and the pgbouncer version (if known).
+    Metrics whose columns are not returned, or which are not supported by the
+    pgbouncer version, are excluded from the plan.
+    """
+    positions = {column: index for index, column in enumerate(columns)}
+    metrics = []
+
+    for mapping in metricMappings:
+        if version and "since" in mapping and version < mapping["since"]:
+            continue
+        if version and "until" in mapping and version >= mapping["until"]:
+            continue
+
+        sourceColumns = mapping["columns"] if "compute" in mapping else [mapping["column"]]
+        if not all(column in positions for column in sourceColumns):
+            continue
+
+        metrics.append(PlannedMetric(
+            type=mapping["type"],
+            name=metricPrefix + mapping["metric"],
+            help=mapping["help"],
+            indexes=tuple(positions[column] for column in sourceColumns),
+            compute=mapping.get("compute"),
+            rollup=mapping.get("rollup", "sum")))
+
+    missing = [column for column in labelMappings if column not in positions]
+    if missing:
+        raise Exception("Missing label columns {columns}".format(columns=", ".join(missing)))
+
+    return QueryPlan(
+        databaseIndex=positions.get("database"),
+        labelNames=tuple(labelMappings.values()),
+        labelIndexes=tuple(positions[column] for column in labelMappings),
+        metrics=tuple(metrics))
+
+
+@contextmanager
+def requested_scrape_timeout(timeout):
+    """
+    Set the scrape timeout requested by the client (ie. the X-Prometheus-Scrape-Timeout-Seconds
+    header sent by Prometheus) to the collects run by the current thread.
+    """
+    _scrapeContext.timeout = timeout
+
+    try:
+        yield
+    finally:
+        _scrapeContext.timeout = None
+
+
+def get_requested_scrape_timeout():
+    return getattr(_scrapeContext, "timeout", None)
+
+
+class ScrapeDeadlineExceeded(Exception):
+    pass
+
+
+class ScrapeInstrumentation():
+    """
+    Tracks where the scrapes of a single pgbouncer spend their time: the duration of
+    the connection and of each admin query, the rows returned, the samples emitted
+    and the errors occurred at each stage (connect, each query, transform).
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or DURATION_BUCKETS
+        self.lock = threading.Lock()
+        self.connectDurations = Histogram(self.buckets)
+        self.queryDurations = {}
+        self.rows = {}
+        self.samples = 0
+        self.errors = dict.fromkeys(["connect", "SHOW VERSION"] + QUERIES + ["transform"], 0)
+
+    def observeConnect(self, duration, success):
+        with self.lock:
+            self.connectDurations.observe(duration)
+
+            if not success:
+                self.errors["connect"] += 1
+
+    def observeQuery(self, query, duration, rows):
+        """
+        Observe a query which returned the given number of rows, or None on error.
+        """
+        with self.lock:
+            if query not in self.queryDurations:
+                self.queryDurations[query] = Histogram(self.buckets)
+                self.rows[query] = 0
+
+            self.queryDurations[query].observe(duration)
+
+            if rows is not None:
+                self.rows[query] += rows
+            else:
+                self.errors[query] = self.errors.get(query, 0) + 1
+
+    def observeExport(self, samples, transformErrors):
+        with self.lock:
+            self.samples += samples
+            self.errors["transform"] += transformErrors
+
+    def export(self, extraLabelNames, extraLabelValues):
+        queryLabelNames = ("query",) + extraLabelNames
+        stageLabelNames = ("stage",) + extraLabelNames
+
+        with self.lock:
+            samples = [Sample("histogram", "pgbouncer_exporter_connect_duration_seconds", "Time spent connecting to pgbouncer", extraLabelNames, extraLabelValues, self.connectDurations.export())]
+
+            for query, histogram in self.queryDurations.items():
+                samples.append(Sample("histogram", "pgbouncer_exporter_query_duration_seconds", "Time spent running an admin console query", queryLabelNames, (query,) + extraLabelValues, histogram.export()))
+
+            for query, rows in self.rows.items():
+                samples.append(Sample("counter", "pgbouncer_exporter_query_rows", "Number of rows returned by an admin console query", queryLabelNames, (query,) + extraLabelValues, rows))
+
+            samples.append(Sample("counter", "pgbouncer_exporter_samples", "Number of samples exported from the scraped metrics", extraLabelNames, extraLabelValues, self.samples))
+
+            for stage, errors in self.errors.items():
+                samples.append(Sample("counter", "pgbouncer_exporter_errors", "Number of errors occurred while scraping, by stage", stageLabelNames, (stage,) + extraLabelValues, errors))
+
+        return samples
 
 
 class PgbouncersMetricsCollector():
-    def __init__(self, configs: List[PgbouncerConfig]):
+    def __init__(self, configs: List[PgbouncerConfig], concurrency: int = 10, cacheTtl: float = 0, engine: str = "psycopg2", scrapeTimeout: float = 0, scrapeTimeoutOffset: float = 0.5, shard: Shard = None, probeCacheSize: int = 100, probeIdleTimeout: float = 300):
+        self.concurrency = concurrency
+        self.executor = False
+        self.loop = False
+
+        if engine == "asyncio":
+            # A single event loop, running in background, scrapes all pgbouncers
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name="pgbouncer-scraper", daemon=True).start()
+        else:
+            # Bounded pool of workers used to scrape the pgbouncers concurrently
+            self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="pgbouncer-scraper")
+
+        # The collectors of the configured and the discovered pgbouncers. The list of all
+        # collectors is swapped atomically on changes, so that in-flight collects keep
+        # scraping the pgbouncers they started with.
+        self.shard = shard or Shard()
+        self.collectors = []
+        self.staticCollectors = []
+        self.discoveredCollectors = {}
+
+        # The configs of the pgbouncers owned by other shards, which can only be probed
+        self.unownedConfigs = []
+        self.unownedDiscoveredConfigs = {}
+
+        # The discovered pgbouncers not scraped because their extra labels are the same of
+        # another scraped pgbouncer, by identity. They're scraped once the other one is gone.
+        self.pendingDiscoveredConfigs = {}
+        self.updateLock = threading.Lock()
         self.update(configs)
 
+        # Concurrent collects share the same in-flight collection, and its result
+        # is reused for cacheTtl seconds (if greater than 0)
+        self.cacheTtl = cacheTtl
+        self.cacheLock = threading.Lock()
+        self.cached = False
+        self.inflight = False
+        self.generation = 0
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+        # Each collect must complete within the configured scrape timeout (if greater
+        # than 0) and the one requested by the client minus the offset (if any)
+        self.scrapeTimeout = scrapeTimeout
+        self.scrapeTimeoutOffset = scrapeTimeoutOffset
+
+        # The probed pgbouncers which are scraped by this exporter reuse their collector,
+        # while the collectors of the other ones are kept warm (connection, query plans)
+        # in a LRU cache, and closed once evicted or idle for probeIdleTimeout seconds
+        self.probeCacheSize = probeCacheSize
+        self.probeIdleTimeout = probeIdleTimeout
+        self.probeLock = threading.Lock()
+        self.probeCollectors = OrderedDict()
+        self.probeTargets = ((), {})
+
+        # Evicts the idle probed collectors even if no more probes are received
+        self.probeEvictionTimer = False
+        self.closed = False
+
     def update(self, configs: List[PgbouncerConfig]):
-        self.collectors = list(map(lambda config: PgbouncerMetricsCollector(config), configs))
+        """
+        Replace the configured pgbouncers, diffing them by identity with the current
+        ones: the collectors of the unchanged pgbouncers (and their connection, caches
+        and circuit breaker state) are kept, while only the added, removed or changed
+        ones are created or closed.
+        """
+        with self.updateLock:
+            current = {collector.config.getIdentity(): collector for collector in self.staticCollectors}
+            collectors = []
+            changed = []
+            unowned = []
 
-    def collect(self):
-        entries = []
+            for config in configs:
+                if not self.shard.owns(config):
+                    unowned.append(config)
+                    continue
+
+                collector = current.pop(config.getIdentity(), None)
+
+                if collector and collector.config.config == config.config:
+                    collectors.append(collector)
+                    continue
+
+                if collector:
+                    changed.append(collector)
+
+                collectors.append(PgbouncerMetricsCollector(config))
+
+            # The static pgbouncers take precedence over the discovered ones with the same labels
+            self.staticCollectors = collectors
+            discovered = dict(self.discoveredCollectors)
+            pending = dict(self.pendingDiscoveredConfigs)
+            changed += self._scrapeDiscovered(discovered, pending)
+
+            # Swap the collectors atomically, so that in-flight collects are not affected
+            self.unownedConfigs = unowned
+            self.discoveredCollectors = discovered
+            self.pendingDiscoveredConfigs = pending
+            self.collectors = self.staticCollectors + list(discovered.values())
+
+        # Release the connections held by the removed or changed collectors
+        close_in_background(list(current.values()) + changed)
+
+    def updateDiscovered(self, added: List[PgbouncerConfig], removed):
+        """
+        Add the collectors of the newly discovered pgbouncers and remove the ones of
+        the pgbouncers (identities) which aren't discovered anymore, keeping the state
+        of all the other ones.
+        """
+        with self.updateLock:
+            discovered = dict(self.discoveredCollectors)
+            previous = [discovered.pop(identity) for identity in removed if identity in discovered]
+            unowned = dict(self.unownedDiscoveredConfigs)
+            pending = dict(self.pendingDiscoveredConfigs)
+
+            for identity in removed:
+                unowned.pop(identity, None)
+                pending.pop(identity, None)
+
+            for config in added:
+                if self.shard.owns(config):
+                    pending[config.getIdentity()] = config
+                else:
+                    unowned[config.getIdentity()] = config
+
+            previous += self._scrapeDiscovered(discovered, pending)
+
+            for config in added:
+                if config.getIdentity() in pending:
+                    logging.getLogger().warning("Skipping the discovered pgbouncer {dsn} because its extra labels are the same of another scraped pgbouncer".format(dsn=config.getDsnWithMaskedPassword()))
+
+            self.discoveredCollectors = discovered
+            self.unownedDiscoveredConfigs = unowned
+            self.pendingDiscoveredConfigs = pending
+            self.collectors = self.staticCollectors + list(discovered.values())
+
+        # Release the connections held by the removed collectors
+        close_in_background(previous)
+
+    def _scrapeDiscovered(self, discovered, pending):
+        """
+        Create the collectors of the pending discovered pgbouncers, unless another
+        scraped pgbouncer has the same extra labels (they would export the same series),
+        and move back to pending the discovered ones clashing with a static one. Returns
+        the collectors to close. Must be called with the update lock held.
+        """
+        scraped = set(tuple(sorted(collector.config.getExtraLabels().items())) for collector in self.staticCollectors)
+        closed = []
+
+        for identity, collector in list(discovered.items()):
+            labels = tuple(sorted(collector.config.getExtraLabels().items()))
+
+            if labels in scraped:
+                logging.getLogger().warning("Stopped scraping the discovered pgbouncer {dsn} because its extra labels are the same of a configured pgbouncer".format(dsn=collector.config.getDsnWithMaskedPassword()))
+                closed.append(discovered.pop(identity))
+                pending[identity] = collector.config
+            else:
+                scraped.add(labels)
+
+        for identity, config in list(pending.items()):
+            labels = tuple(sorted(config.getExtraLabels().items()))
+
+            if labels not in scraped:
+                scraped.add(labels)
+                discovered[identity] = PgbouncerMetricsCollector(config)
+                del pending[identity]
+
+        return closed
+
+    def close(self):
+        with self.probeLock:
+            self.closed = True
+            probed = [collector for collector, lastProbedAt in self.probeCollectors.values()]
+            self.probeCollectors.clear()
+
+            if self.probeEvictionTimer:
+                self.probeEvictionTimer.cancel()
+                self.probeEvictionTimer = False
+
+        for collector in self.collectors + probed:
+            collector.close()
+
+    def probe(self, target, timestamp=None):
+        """
+        Collect the metrics of a single pgbouncer, given its name. Returns None if
+        there's no pgbouncer with such name.
+        """
+        collector, evicted = self._getProbeCollector(target)
+
+        # Release the connections held by the evicted collectors
+        for item in evicted:
+            item.close()
+
+        if not collector:
+            return None
+
+        timeout = self._getScrapeTimeout()
+        deadline = time.monotonic() + timeout if timeout else None
+
+        if self.loop:
+            samples = asyncio.run_coroutine_threadsafe(collector.collectAsync(deadline), self.loop).result()
+        else:
+            samples = collector.collect(deadline)
+
+        return self._buildFamilies([samples], timestamp)
+
+    def collect(self, timestamp=None):
+        families, generation = self.collectCached(timestamp)
+
+        return list(families) + self._exporterMetrics()
+
+    def collectCached(self, timestamp=None):
+        """
+        Returns the metric families of all pgbouncers, shared by the concurrent collects
+        and reused for cacheTtl seconds, along with the generation of the collection
+        they come from.
+        """
+        leader = False
+
+        with self.cacheLock:
+            if self.cached and time.monotonic() < self.cached.expiresAt:
+                self.cacheHits += 1
+                return self.cached.families, self.cached.generation
+
+            if self.inflight:
+                # Another collect is in progress: wait for its result
+                flight = self.inflight
+                self.cacheHits += 1
+            else:
+                flight = self.inflight = _InflightCollect()
+                leader = True
+                self.cacheMisses += 1
+
+        if leader:
+            timeout = self._getScrapeTimeout()
+            deadline = time.monotonic() + timeout if timeout else None
+
+            try:
+                flight.families = tuple(self._collect(timestamp, deadline))
+            except Exception as error:
+                flight.error = error
+            finally:
+                with self.cacheLock:
+                    self.inflight = False
+                    self.generation += 1
+                    flight.generation = self.generation
+
+                    if self.cacheTtl > 0 and not flight.error:
+                        self.cached = _CachedCollect(families=flight.families, expiresAt=time.monotonic() + self.cacheTtl, generation=flight.generation)
+
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.error:
+            raise flight.error
+
+        return flight.families, flight.generation
+
+    def _collect(self, timestamp=None, deadline=None):
+        collectors = self.collectors
+
+        # Collect all metrics data, fanning out across the pgbouncers. The results
+        # are merged in the configured order so that the output is deterministic.
+        if self.loop:
+            allSamples = asyncio.run_coroutine_threadsafe(self._collectAsync(collectors, deadline), self.loop).result()
+        else:
+            allSamples = self._collectThreaded(collectors, deadline)
+
+        return self._buildFamilies(allSamples, timestamp)
+
+    def _buildFamilies(self, allSamples, timestamp=None):
         metrics = {}
 
-        # Collect all metrics data
-        for collector in self.collectors:
-            entries += collector.collect()
+        # Stream the samples of each pgbouncer straight into the metric families
+        for samples in allSamples:
+            for sample in samples:
+                family = metrics.get(sample.name)
+                if family is None:
+                    family = metrics[sample.name] = self._instanceMetric(sample)
 
-        # Instance metrics
-        for data in entries:
-            name = data["name"]
-            metrics[name] = metrics[name] if name in metrics else self._instanceMetric(data)
-            metrics[name].add_metric(value=data["value"], labels=data["labels"].values())
+                if sample.type == "histogram":
+                    family.add_metric(sample.labelValues, sample.value[0], sample.value[1], timestamp=timestamp)
+                else:
+                    family.add_metric(sample.labelValues, sample.value, timestamp=timestamp)
 
         return metrics.values()
 
-    def _instanceMetric(self, data):
-        if data["type"] is "counter":
-            return CounterMetricFamily(data["name"], data["help"], labels=data["labels"].keys())
-        elif data["type"] is "gauge":
-            return GaugeMetricFamily(data["name"], data["help"], labels=data["labels"].keys())
+    def _collectThreaded(self, collectors, deadline=None):
+        futures = [self.executor.submit(collector.collect, deadline) for collector in collectors]
+
+        if deadline is not None:
+            wait(futures, timeout=max(0, deadline - time.monotonic()))
+
+        allSamples = []
+        for collector, future in zip(collectors, futures):
+            if deadline is None or future.done():
+                allSamples.append(future.result())
+            else:
+                # Give up on the pgbouncers not scraped in time (the queued ones are never started)
+                future.cancel()
+                allSamples.append(collector.exportIncompleteMetrics())
+
+        return allSamples
+
+    async def _collectAsync(self, collectors, deadline=None):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def collect(collector):
+            async with semaphore:
+                return await collector.collectAsync(deadline)
+
+        if deadline is None:
+            return await asyncio.gather(*[collect(collector) for collector in collectors])
+
+        # Give up on the pgbouncers not scraped in time. Their scrapes are left running,
+        # because each query is cancelled on its own once the deadline is exceeded.
+        tasks = [asyncio.ensure_future(collect(collector)) for collector in collectors]
+        if tasks:
+            await asyncio.wait(tasks, timeout=max(0, deadline - time.monotonic()))
+
+        return [task.result() if task.done() else collector.exportIncompleteMetrics() for collector, task in zip(collectors, tasks)]
+
+    def _getProbeCollector(self, target):
+        """
+        Returns the warm collector of the pgbouncer with the given name (if any) and
+        the collectors evicted from the cache.
+        """
+        now = time.monotonic()
+        evicted = []
+
+        with self.probeLock:
+            collector, config = self._getProbeTargets().get(target, (None, None))
+            entry = self.probeCollectors.pop(target, None)
+
+            # The pgbouncer config changed, it's scraped by this exporter now, or it's
+            # not configured anymore
+            if entry and (collector or entry[0].config is not config):
+                evicted.append(entry[0])
+                entry = None
+
+            # The pgbouncers owned by other shards get a collector without sampler,
+            # because it lives only as long as it's probed
+            if not collector and config:
+                collector = entry[0] if entry else PgbouncerMetricsCollector(config, sample=False)
+                self.probeCollectors[target] = (collector, now)
+
+            evicted += self._evictProbeCollectors(now)
+            self._scheduleProbeEviction()
+
+        return collector, evicted
+
+    def _evictProbeCollectors(self, now):
+        """
+        Evict the least recently probed collectors, if too many or idle. Must be called
+        with the probe lock held.
+        """
+        evicted = []
+
+        while self.probeCollectors:
+            name, (oldest, lastProbedAt) = next(iter(self.probeCollectors.items()))
+            if len(self.probeCollectors) <= self.probeCacheSize and now - lastProbedAt <= self.probeIdleTimeout:
+                break
+
+            del self.probeCollectors[name]
+            evicted.append(oldest)
+
+        return evicted
+
+    def _scheduleProbeEviction(self):
+        """
+        Schedule the eviction of the least recently probed collector, once idle. Must
+        be called with the probe lock held.
+        """
+        if self.probeEvictionTimer or self.closed or not self.probeCollectors:
+            return
+
+        oldest, lastProbedAt = next(iter(self.probeCollectors.values()))
+        delay = max(0, lastProbedAt + self.probeIdleTimeout - time.monotonic())
+
+        self.probeEvictionTimer = threading.Timer(delay, self._evictIdleProbeCollectors)
+        self.probeEvictionTimer.daemon = True
+        self.probeEvictionTimer.start()
+
+    def _evictIdleProbeCollectors(self):
+        with self.probeLock:
+            self.probeEvictionTimer = False
+            evicted = self._evictProbeCollectors(time.monotonic())
+            self._scheduleProbeEviction()
+
+        # Release the connections held by the evicted collectors
+        close_in_background(evicted)
+
+    def _getProbeTargets(self):
+        """
+        Index the pgbouncers by name, each time they change, into a tuple of (scraped
+        collector or None, config).
+        """
+        key, targets = self.probeTargets
+        current = (self.collectors, self.unownedConfigs, self.unownedDiscoveredConfigs, self.pendingDiscoveredConfigs)
+
+        if len(key) != len(current) or any(previous is not value for previous, value in zip(key, current)):
+            targets = {}
+
+            for collector in current[0]:
+                targets.setdefault(collector.config.getName(), (collector, collector.config))
+
+            for config in current[1] + list(current[2].values()) + list(current[3].values()):
+                targets.setdefault(config.getName(), (None, config))
+
+            self.probeTargets = (current, targets)
+
+        return targets
+
+    def _getScrapeTimeout(self):
+        timeouts = []
+
+        requested = get_requested_scrape_timeout()
+        if requested:
+            # Leave some room to send the response before Prometheus gives up
+            timeouts.append(requested - self.scrapeTimeoutOffset if requested > self.scrapeTimeoutOffset else requested)
+
+        if self.scrapeTimeout > 0:
+            timeouts.append(self.scrapeTimeout)
+
+        return min(timeouts) if timeouts else None
+
+    def _exporterMetrics(self):
+        return self._cacheMetrics() + self._shardMetrics()
+
+    def _shardMetrics(self):
+        targets = GaugeMetricFamily("pgbouncer_exporter_shard_targets", "Number of pgbouncers owned and scraped by this exporter shard", labels=["shard_index", "shard_count"])
+        targets.add_metric([str(self.shard.index), str(self.shard.count)], len(self.collectors))
+
+        return [targets]
+
+    def _cacheMetrics(self):
+        hits = CounterMetricFamily("pgbouncer_exporter_collect_cache_hits", "Number of collects served by a cached or in-flight collection")
+        hits.add_metric([], self.cacheHits)
+
+        misses = CounterMetricFamily("pgbouncer_exporter_collect_cache_misses", "Number of collects which scraped the pgbouncers")
+        misses.add_metric([], self.cacheMisses)
+
+        return [hits, misses]
+
+    def _instanceMetric(self, sample):
+        if sample.type == "counter":
+            return CounterMetricFamily(sample.name, sample.help, labels=sample.labelNames)
+        elif sample.type == "gauge":
+            return GaugeMetricFamily(sample.name, sample.help, labels=sample.labelNames)
+        elif sample.type == "histogram":
+            return HistogramMetricFamily(sample.name, sample.help, labels=sample.labelNames)
         else:
-            raise Exception("Unsupported metric type: {type}".format(type=data['type']))
+            raise Exception("Unsupported metric type: {type}".format(type=sample.type))
+
+
+# The result of a collect shared by concurrent and subsequent collects
+_CachedCollect = namedtuple("_CachedCollect", ["families", "expiresAt", "generation"])
+
+
+class _InflightCollect():
+    def __init__(self):
+        self.done = threading.Event()
+        self.families = ()
+        self.generation = 0
+        self.error = False
+
+
+# An immutable snapshot of the metric families collected by a single poll
+MetricsSnapshot = namedtuple("MetricsSnapshot", ["families", "generation", "timestamp"])
+
+
+class CachedMetricsSnapshots():
+    """
+    Serves the collections of all pgbouncers cached for cache_ttl seconds as
+    snapshots, so that their exposition is rendered once per collection like in
+    polling mode. The exporter metrics and the ones of the extra collectors (ie.
+    process metrics) are taken when the pgbouncers are collected.
+    """
+
+    def __init__(self, collector: PgbouncersMetricsCollector, extraCollectors=()):
+        self.collector = collector
+        self.extraCollectors = extraCollectors
+        self.snapshot = MetricsSnapshot(families=(), generation=0, timestamp=None)
+        self.lock = threading.Lock()
+
+    def getSnapshot(self):
+        families, generation = self.collector.collectCached()
+
+        with self.lock:
+            # Concurrent requests may complete out of order, so never go back to an older one
+            if generation > self.snapshot.generation:
+                families = tuple(families) + tuple(self.collector._exporterMetrics())
+
+                for collector in self.extraCollectors:
+                    families += tuple(collector.collect())
+
+                self.snapshot = MetricsSnapshot(families=families, generation=generation, timestamp=None)
+
+            return self.snapshot
+
+
+class PgbouncersMetricsPoller():
+    """
+    Polls all pgbouncers in background on a fixed interval and serves the latest
+    snapshot on collect(), so that the scrape latency and the load on pgbouncer
+    don't depend on how many scrapers hit the exporter.
+    """
+
+    def __init__(self, collector: PgbouncersMetricsCollector, interval: float, extraCollectors=()):
+        self.collector = collector
+        self.interval = interval
+
+        # Other collectors (ie. process metrics) whose metrics are included in the snapshot
+        self.extraCollectors = extraCollectors
+        self.snapshot = MetricsSnapshot(families=(), generation=0, timestamp=None)
+        self.stopEvent = threading.Event()
+        self.thread = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="pgbouncer-poller", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopEvent.set()
+
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = False
+
+    def poll(self):
+        timestamp = time.time()
+        families = tuple(self.collector.collect(timestamp=timestamp))
+
+        for collector in self.extraCollectors:
+            families += tuple(collector.collect())
+
+        # Swap the snapshot atomically, so that concurrent scrapes never see a partial one
+        self.snapshot = MetricsSnapshot(families=families, generation=self.snapshot.generation + 1, timestamp=timestamp)
+
+    def collect(self):
+        return self.snapshot.families
+
+    def getSnapshot(self):
+        return self.snapshot
+
+    def _run(self):
+        nextPollAt = time.monotonic()
+
+        while not self.stopEvent.is_set():
+            try:
+                self.poll()
+            except Exception as error:
+                logging.getLogger().error("Unable to poll pgbouncers metrics", extra={"exception": str(error)})
+
+            # Schedule at a fixed rate, skipping the polls we're late for
+            nextPollAt += self.interval
+            now = time.monotonic()
+            if nextPollAt < now:
+                nextPollAt = now
+
+            self.stopEvent.wait(nextPollAt - now)
 
 
 class PgbouncerMetricsCollector():
-    def __init__(self, config: PgbouncerConfig):
+    def __init__(self, config: PgbouncerConfig, sample: bool = True):
         self.config = config
+        self.conn = False
+        self.asyncConn = False
+        self.asyncLock = False
+        self.loop = False
 
-    def collect(self):
+        # The pgbouncer version and the compiled query plans, detected once per connection
+        self.version = False
+        self.plans = {}
+        self.extraLabels = False
+
+        # The results of the cached queries, and the key/value index of SHOW CONFIG
+        self.cachedResults = {}
+        self.keyValueIndex = (None, {})
+        self.instrumentation = ScrapeInstrumentation()
+
+        # Keep the full detail only for the top K databases, if configured
+        limit = config.getTopDatabasesLimit()
+        self.limiter = TopDatabasesLimiter(limit, config.getTopDatabasesRankBy()) if limit > 0 else False
+
+        # Serialize scrapes of the same pgbouncer, because they share the same connection
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # Stop connecting to an unreachable pgbouncer, and re-probe it in background
+        self.breaker = CircuitBreaker(
+            config.getDsnWithMaskedPassword(),
+            self._probe,
+            config.getCircuitBreakerFailureThreshold(),
+            config.getCircuitBreakerBackoffInitial(),
+            config.getCircuitBreakerBackoffMax())
+
+        # Sample the pools between scrapes, if enabled
+        self.sampler = False
+
+        if sample and config.getSamplerInterval() > 0:
+            self.sampler = PoolsSampler(config, lambda: not self.breaker.isOpen())
+            self.sampler.start()
+
+    def collect(self, deadline=None):
+        # Report an unreachable pgbouncer down straight away
+        if self.breaker.isOpen():
+            return list(self._exportAllMetrics({}, False))
+
+        # Wait for the scrape in progress (if any) no longer than the deadline
+        if not self.lock.acquire(timeout=-1 if deadline is None else max(0, deadline - time.monotonic())):
+            return self.exportIncompleteMetrics()
+
+        # The samples are generated lazily, so they're materialized while holding the
+        # lock (the query plans are shared by the scrapes) and within the deadline
+        try:
+            results, success, complete = self._fetchAllMetrics(deadline)
+            return list(self._exportAllMetrics(results, success, complete))
+        finally:
+            self.lock.release()
+
+            # The collector has been closed while scraping
+            if self.closed:
+                self._closeConnectionIfIdle()
+
+    async def collectAsync(self, deadline=None):
+        # The lock is lazily created, because it's bound to the event loop running the scrape
+        if not self.asyncLock:
+            self.asyncLock = asyncio.Lock()
+            self.loop = asyncio.get_running_loop()
+
+        # Report an unreachable pgbouncer down straight away
+        if self.breaker.isOpen():
+            return list(self._exportAllMetrics({}, False))
+
+        try:
+            await asyncio.wait_for(self.asyncLock.acquire(), None if deadline is None else max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            return self.exportIncompleteMetrics()
+
+        try:
+            results, success, complete = await self._fetchAllMetricsAsync(deadline)
+            return list(self._exportAllMetrics(results, success, complete))
+        finally:
+            self.asyncLock.release()
+
+    def exportIncompleteMetrics(self):
+        """
+        Returns the samples of a scrape which didn't complete within the deadline,
+        along with the instrumentation and circuit breaker metrics.
+        """
+        extraLabelNames, extraLabelValues = self._getExtraLabels()
+
+        samples = [
+            Sample("gauge", "pgbouncer_up", "PgBouncer is UP and the scraping of all metrics succeeded", extraLabelNames, extraLabelValues, 0),
+            Sample("gauge", "pgbouncer_scrape_incomplete", "Whether the scraping of PgBouncer did not complete within the scrape deadline", extraLabelNames, extraLabelValues, 1),
+        ]
+
+        self.instrumentation.observeExport(len(samples), 0)
+        samples += self.instrumentation.export(extraLabelNames, extraLabelValues)
+
+        if self.breaker.isEnabled():
+            samples += self._exportCircuitBreakerMetrics(extraLabelNames, extraLabelValues)
+
+        return samples
+
+    def close(self):
+        """
+        Release the connection and background tasks of the collector, without waiting
+        for the scrape in progress (if any), which drops the connection once completed.
+        """
+        self.closed = True
+        self.breaker.stop()
+
+        if self.sampler:
+            self.sampler.stop()
+
+        self._closeConnectionIfIdle()
+
+        if self.asyncConn:
+            self.asyncConn.closeThreadsafe()
+            self.asyncConn = False
+
+    def _fetchAllMetrics(self, deadline=None):
         conn = False
-        metrics = []
+        results = {}
         success = True
+        complete = True
 
         try:
-            # Connect to pgbouncer
-            conn = self._createConnection()
-
-            # SHOW STATS
-            results = self._fetchMetrics(conn, "SHOW STATS")
-            if results:
-                results = self._filterMetricsByIncludeDatabases(results, self.config.getIncludeDatabases())
-                results = self._filterMetricsByExcludeDatabases(results, self.config.getExcludeDatabases())
-                metrics += self._exportMetrics(results, "pgbouncer_stats_", [
-                    # pgbouncer < 1.8
-                    {"type": "counter", "column": "total_requests",    "metric": "requests_total",                     "help": "Total number of requests pooled. Could be transactions or queries, depending on pool mode."},
-
-                    # pgbouncer >= 1.8
-                    {"type": "counter", "column": "total_xact_count",  "metric": "transactions_total",                 "help": "Total number of transactions pooled"},
-                    {"type": "counter", "column": "total_query_count", "metric": "queries_total",                      "help": "Total number of queries pooled"},
-                    {"type": "counter", "column": "total_xact_time",   "metric": "transactions_duration_microseconds", "help": "Total number of microseconds spent in a transaction. Includes time spent waiting for an available connection."},
-                    {"type": "counter", "column": "total_wait_time",   "metric": "waiting_duration_microseconds",      "help": "Total number of microseconds spent waiting for an available connection."},
-
-                    # all versions
-                    {"type": "counter", "column": "total_query_time",  "metric": "queries_duration_microseconds",      "help": "Total number of microseconds spent waiting for a server to return a query response. Includes time spent waiting for an available connection."},
-                    {"type": "counter", "column": "total_received",    "metric": "received_bytes_total",               "help": "Total volume in bytes of network traffic received by pgbouncer"},
-                    {"type": "counter", "column": "total_sent",        "metric": "sent_bytes_total",                   "help": "Total volume in bytes of network traffic sent by pgbouncer"},
-
-                ], {"database": "database"}, self.config.getExtraLabels())
-            else:
+            # Connect to pgbouncer (or reuse the persistent connection)
+            conn = self._getConnection(deadline)
+            results.update(self._getCachedResults())
+            queries = self._getQueries(results)
+
+            for index, query in enumerate(queries):
+                try:
+                    result = self._fetchObservedMetrics(conn, query, self._getQueryTimeout(deadline, len(queries) - index))
+                except ScrapeDeadlineExceeded as error:
+                    logging.getLogger().warning("Unable to complete the scrape of {dsn} in time".format(dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+                    complete = False
+
+                    # Run the next queries only if pgbouncer honoured the cancel request
+                    if not self._isConnectionUsable(conn):
+                        break
+                    continue
+
+                if query == "SHOW VERSION":
+                    self.version = self._fetchVersion(result)
+                else:
+                    results[query] = result
+                    self._cacheResult(query, result)
+        except Exception as error:
+            logging.getLogger().error("Unable fetch metrics from {dsn}".format(dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+
+            success = False
+            complete = complete and (deadline is None or time.monotonic() < deadline)
+        finally:
+            # Keep the connection open for the next scrape only if it's still healthy
+            if conn and (not self.config.getPersistentConnection() or not self._isConnectionUsable(conn)):
+                self._closeConnection()
+
+        return results, success, complete
+
+    async def _fetchAllMetricsAsync(self, deadline=None):
+        conn = False
+        results = {}
+        success = True
+        complete = True
+
+        try:
+            # Connect to pgbouncer (or reuse the persistent connection)
+            conn = await self._getConnectionAsync(deadline)
+            results.update(self._getCachedResults())
+            queries = self._getQueries(results)
+
+            for index, query in enumerate(queries):
+                try:
+                    result = await self._fetchObservedMetricsAsync(conn, query, self._getQueryTimeout(deadline, len(queries) - index))
+                except ScrapeDeadlineExceeded as error:
+                    logging.getLogger().warning("Unable to complete the scrape of {dsn} in time".format(dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+                    complete = False
+
+                    # The connection is discarded once a query has been cancelled
+                    if not conn.isUsable():
+                        break
+                    continue
+
+                if query == "SHOW VERSION":
+                    self.version = self._fetchVersion(result)
+                else:
+                    results[query] = result
+                    self._cacheResult(query, result)
+        except Exception as error:
+            logging.getLogger().error("Unable fetch metrics from {dsn}".format(dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+
+            success = False
+            complete = complete and (deadline is None or time.monotonic() < deadline)
+        finally:
+            # Keep the connection open for the next scrape only if it's still healthy
+            if conn and (not self.config.getPersistentConnection() or not conn.isUsable()):
+                conn.close()
+                self.asyncConn = False
+
+        return results, success, complete
+
+    def _exportAllMetrics(self, results, success, complete=True):
+        """
+        Generate the samples from the results of the queries. Rows are streamed
+        straight into samples, without building any intermediate list.
+        """
+        extraLabelNames, extraLabelValues = self._getExtraLabels()
+        emitted = 0
+        transformErrors = 0
+
+        # Rank the databases, when limiting the metrics to the top K ones
+        if self.limiter:
+            self.limiter.rank(results, self._isDatabaseExported)
+
+        # SHOW STATS, SHOW POOLS, SHOW DATABASES and the custom queries
+        for query, metricPrefix, metricMappings, labelMappings in self._getExportedQueries():
+            if not results.get(query):
                 success = False
+                continue
 
-            # SHOW POOLS
-            results = self._fetchMetrics(conn, "SHOW POOLS")
-            if results:
-                results = self._filterMetricsByIncludeDatabases(results, self.config.getIncludeDatabases())
-                results = self._filterMetricsByExcludeDatabases(results, self.config.getExcludeDatabases())
-                metrics += self._exportMetrics(results, "pgbouncer_pools_", [
-                    {"type": "gauge", "column": "cl_active",              "metric": "client_active_connections",   "help": "Client connections that are linked to server connection and can process queries"},
-                    {"type": "gauge", "column": "cl_waiting",             "metric": "client_waiting_connections",  "help": "Client connections have sent queries but have not yet got a server connection"},
-                    {"type": "gauge", "column": "sv_active",              "metric": "server_active_connections",   "help": "Server connections that linked to client"},
-                    {"type": "gauge", "column": "sv_idle",                "metric": "server_idle_connections",     "help": "Server connections that unused and immediately usable for client queries"},
-                    {"type": "gauge", "column": "sv_used",                "metric": "server_used_connections",     "help": "Server connections that have been idle more than server_check_delay, so they needs server_check_query to run on it before it can be used"},
-                    {"type": "gauge", "column": "sv_tested",              "metric": "server_testing_connections",  "help": "Server connections that are currently running either server_reset_query or server_check_query"},
-                    {"type": "gauge", "column": "sv_login",               "metric": "server_login_connections",    "help": "Server connections currently in logging in process"},
-                    {"type": "gauge", "compute": compute_maxwait_seconds, "metric": "client_maxwait_seconds",      "help": "How long the first (oldest) client in queue has waited, in seconds"},
-                ], {"database": "database", "user": "user"}, self.config.getExtraLabels())
-            else:
+            try:
+                plan = self._getQueryPlan(query, results[query], metricPrefix, metricMappings, labelMappings)
+                rows = self._filterMetricsByDatabases(results[query].rows, plan.databaseIndex)
+
+                if self.limiter and "database" in plan.labelNames:
+                    samples = self.limiter.export(query, rows, plan, extraLabelNames, extraLabelValues)
+                else:
+                    samples = self._exportMetrics(rows, plan, extraLabelNames, extraLabelValues)
+
+                for sample in samples:
+                    emitted += 1
+                    yield sample
+            except Exception as error:
+                logging.getLogger().error("Unable to export metrics of {query} from {dsn}".format(query=query, dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+                transformErrors += 1
                 success = False
 
-            # SHOW DATABASES
-            results = self._fetchMetrics(conn, "SHOW DATABASES")
-            if results:
-                results = self._filterMetricsByIncludeDatabases(results, self.config.getIncludeDatabases())
-                results = self._filterMetricsByExcludeDatabases(results, self.config.getExcludeDatabases())
-                metrics += self._exportMetrics(results, "pgbouncer_databases_", [
-                    {"type": "gauge", "column": "pool_size",           "metric": "database_pool_size",           "help": "Configured Pool Size Limit"},
-                    {"type": "gauge", "column": "reserve_pool",        "metric": "database_reserve_pool_size",   "help": "Configured Reserve Limit"},
-                    {"type": "gauge", "column": "current_connections", "metric": "database_current_connections", "help": "Database connection count"},
-                    {"type": "gauge", "column": "max_connections",     "metric": "database_max_connections",     "help": "Database maximum number of allowed connections"},
-                ], {"name": "database", "database": "backend_database"}, self.config.getExtraLabels())
-            else:
+        # Saturation metrics derived from SHOW POOLS and SHOW DATABASES
+        if self.config.getDerivedMetrics() and results.get("SHOW POOLS") and results.get("SHOW DATABASES"):
+            try:
+                for sample in self._exportDerivedMetrics(results["SHOW POOLS"], results["SHOW DATABASES"], extraLabelNames, extraLabelValues):
+                    emitted += 1
+                    yield sample
+            except Exception as error:
+                logging.getLogger().error("Unable to export the derived metrics from {dsn}".format(dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+                transformErrors += 1
+                success = False
+
+        # The windows of the high frequency sampler. Like the derived metrics, they can't
+        # be folded, so only the top K databases are exported
+        if self.sampler:
+            top = self.limiter.top if self.limiter else None
+
+            try:
+                for sample in self.sampler.export(lambda database: top is None or database in top, extraLabelNames, extraLabelValues):
+                    emitted += 1
+                    yield sample
+            except Exception as error:
+                logging.getLogger().error("Unable to export the sampled metrics from {dsn}".format(dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+                transformErrors += 1
+
+        # SHOW CLIENTS, SHOW SERVERS
+        for query, collectors in AGGREGATED_QUERIES:
+            if not self._isAnyCollectorEnabled(collectors):
+                continue
+
+            if not results.get(query):
+                success = False
+                continue
+
+            try:
+                for sample in results[query].export(self._isDatabaseExported, extraLabelNames, extraLabelValues):
+                    emitted += 1
+                    yield sample
+            except Exception as error:
+                logging.getLogger().error("Unable to export metrics of {query} from {dsn}".format(query=query, dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+                transformErrors += 1
                 success = False
 
-            # SHOW CONFIG
-            results = self._fetchMetrics(conn, "SHOW CONFIG")
-            if results:
-                metrics += self._exportKeyValueMetrics(results, "pgbouncer_config_", [
-                    {"type": "gauge", "key": "max_client_conn",      "metric": "max_client_conn",      "help": "Config maximum number of client connections"},
-                    {"type": "gauge", "key": "max_user_connections", "metric": "max_user_connections", "help": "Config maximum number of server connections per user"},
-                    ], self.config.getExtraLabels())
+        # SHOW CONFIG
+        if self.config.isCollectorEnabled("config"):
+            if results.get("SHOW CONFIG"):
+                try:
+                    for sample in self._exportKeyValueMetrics(results["SHOW CONFIG"], "pgbouncer_config_", CONFIG_METRICS, extraLabelNames, extraLabelValues):
+                        emitted += 1
+                        yield sample
+                except Exception as error:
+                    logging.getLogger().error("Unable to export metrics of SHOW CONFIG from {dsn}".format(dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+                    transformErrors += 1
+                    success = False
             else:
                 success = False
 
+        # Add pgbouncer_up metric
+        yield Sample("gauge", "pgbouncer_up", "PgBouncer is UP and the scraping of all metrics succeeded", extraLabelNames, extraLabelValues, 1 if success else 0)
+        yield Sample("gauge", "pgbouncer_scrape_incomplete", "Whether the scraping of PgBouncer did not complete within the scrape deadline", extraLabelNames, extraLabelValues, 0 if complete else 1)
+        emitted += 2
+
+        # Add the scrape instrumentation metrics
+        self.instrumentation.observeExport(emitted, transformErrors)
+        yield from self.instrumentation.export(extraLabelNames, extraLabelValues)
+
+        # Add the circuit breaker metrics
+        if self.breaker.isEnabled():
+            yield from self._exportCircuitBreakerMetrics(extraLabelNames, extraLabelValues)
+
+    def _exportCircuitBreakerMetrics(self, extraLabelNames, extraLabelValues):
+        states, transitions = self.breaker.export()
+        labelNames = ("state",) + extraLabelNames
+
+        for state, value in states.items():
+            yield Sample("gauge", "pgbouncer_exporter_circuit_breaker_state", "Current state of the circuit breaker of PgBouncer (closed, open or half_open)", labelNames, (state,) + extraLabelValues, value)
+
+        for state, value in transitions.items():
+            yield Sample("counter", "pgbouncer_exporter_circuit_breaker_transitions", "Number of transitions of the circuit breaker of PgBouncer to each state", labelNames, (state,) + extraLabelValues, value)
+
+    def _exportDerivedMetrics(self, pools, databases, extraLabelNames, extraLabelValues):
+        """
+        Join each pool with the limits of its database, indexed by name, and export
+        the saturation of the pool.
+        """
+        positions = {column: index for index, column in enumerate(databases.columns)}
+        nameIndex = positions["name"]
+        poolSizeIndex = positions["pool_size"]
+        reservePoolIndex = positions["reserve_pool"]
+        limits = {row[nameIndex]: (row[poolSizeIndex], row[reservePoolIndex]) for row in databases.rows}
+
+        positions = {column: index for index, column in enumerate(pools.columns)}
+        databaseIndex = positions["database"]
+        userIndex = positions["user"]
+        activeIndex = positions["sv_active"]
+        waitingIndex = positions["cl_waiting"]
+        serverIndexes = [positions[column] for column in SERVER_CONNECTION_COLUMNS if column in positions]
+
+        # Ratios can't be folded, so only the pools of the top K databases are exported
+        top = self.limiter.top if self.limiter else None
+        labelNames = ("database", "user") + extraLabelNames
+
+        for row in pools.rows:
+            database = row[databaseIndex]
+            if database not in limits or not self._isDatabaseExported(database) or (top is not None and database not in top):
+                continue
+
+            poolSize, reservePool = limits[database]
+            servers = sum(row[index] for index in serverIndexes)
+            active = row[activeIndex]
+            waiting = row[waitingIndex]
+            labelValues = (database, row[userIndex]) + extraLabelValues
+
+            if poolSize > 0:
+                yield Sample("gauge", "pgbouncer_pools_server_utilization_ratio", "Ratio of the active server connections to the pool size", labelNames, labelValues, active / poolSize)
+
+            yield Sample("gauge", "pgbouncer_pools_server_headroom_connections", "Server connections which can still be opened before reaching the pool size (negative when using the reserve pool)", labelNames, labelValues, poolSize - servers)
+            yield Sample("gauge", "pgbouncer_pools_client_waiting_per_active_server_ratio", "Waiting client connections per active server connection (+Inf if clients are waiting with no active server)", labelNames, labelValues, waiting / active if active else (math.inf if waiting else 0))
+            yield Sample("gauge", "pgbouncer_pools_reserve_pool_in_use_connections", "Server connections opened from the reserve pool, beyond the pool size", labelNames, labelValues, min(max(servers - poolSize, 0), reservePool))
+
+    def _exportMetrics(self, rows, plan, extraLabelNames, extraLabelValues):
+        labelNames = plan.labelNames + extraLabelNames
+        labelIndexes = plan.labelIndexes
+
+        for row in rows:
+            labelValues = tuple([row[index] for index in labelIndexes]) + extraLabelValues
+
+            for metric in plan.metrics:
+                if metric.compute:
+                    value = metric.compute(*[row[index] for index in metric.indexes])
+                else:
+                    value = row[metric.indexes[0]]
+
+                yield Sample(metric.type, metric.name, metric.help, labelNames, labelValues, value)
+
+    def _exportKeyValueMetrics(self, result, metricPrefix, metricMappings, extraLabelNames, extraLabelValues):
+        # Index the values by key, once per result (which may be cached across scrapes)
+        indexedResult, values = self.keyValueIndex
+        if indexedResult is not result:
+            keyIndex = result.columns.index("key")
+            valueIndex = result.columns.index("value")
+            values = {row[keyIndex]: row[valueIndex] for row in result.rows}
+            self.keyValueIndex = (result, values)
+
+        for mapping in metricMappings:
+            if mapping["key"] in values:
+                yield Sample(mapping["type"], metricPrefix + mapping["metric"], mapping["help"], extraLabelNames, extraLabelValues, int(values[mapping["key"]]))
+
+    def _getExtraLabels(self):
+        # Lazy build the extra labels tuples, shared by all samples of this pgbouncer
+        if self.extraLabels is False:
+            labels = self.config.getExtraLabels()
+            self.extraLabels = (tuple(sys.intern(name) for name in labels.keys()), tuple(labels.values()))
+
+        return self.extraLabels
+
+    def _isDatabaseExported(self, database):
+        return self.config.getDatabaseMatcher().matches(database)
+
+    def _filterMetricsByDatabases(self, rows, databaseIndex):
+        matcher = self.config.getDatabaseMatcher()
+
+        # No filtering if there are no rules
+        if matcher.isEmpty() or databaseIndex is None:
+            return rows
+
+        matches = matcher.matches
+        return (row for row in rows if matches(row[databaseIndex]))
+
+    def _fetchMetrics(self, conn, query):
+        try:
+            return fetch_query_result(conn, query)
         except Exception as error:
-            logging.getLogger().error("Unable fetch metrics from {dsn}".format(dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+            logging.getLogger().error("Unable run query {query} on {dsn}".format(query=query, dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
 
-            success = False
+            return False
+
+    def _fetchObservedMetrics(self, conn, query, timeout=None):
+        if timeout is not None and timeout <= 0:
+            raise ScrapeDeadlineExceeded("Skipped {query} because the scrape deadline is exceeded".format(query=query))
+
+        start = time.perf_counter()
+        result = False
+
+        # Cancel the query on pgbouncer if it doesn't complete within the timeout
+        watched = QUERY_WATCHDOG.watch(conn, timeout) if timeout is not None else None
+        aggregator = self._createAggregator(query)
+
+        try:
+            result = self._fetchAggregatedMetrics(conn, query, aggregator) if aggregator else self._fetchMetrics(conn, query)
         finally:
-            if conn:
+            if watched:
+                QUERY_WATCHDOG.unwatch(watched)
+
+            self.instrumentation.observeQuery(query, time.perf_counter() - start, self._countRows(result))
+
+        if watched and watched.cancelled and not result:
+            raise ScrapeDeadlineExceeded("Cancelled {query} because the scrape deadline is exceeded".format(query=query))
+
+        return result
+
+    async def _fetchObservedMetricsAsync(self, conn, query, timeout=None):
+        if timeout is not None and timeout <= 0:
+            raise ScrapeDeadlineExceeded("Skipped {query} because the scrape deadline is exceeded".format(query=query))
+
+        start = time.perf_counter()
+        result = False
+
+        aggregator = self._createAggregator(query)
+
+        try:
+            fetch = self._fetchAggregatedMetricsAsync(conn, query, aggregator) if aggregator else self._fetchMetricsAsync(conn, query)
+            result = await asyncio.wait_for(fetch, timeout)
+        except asyncio.TimeoutError:
+            # Cancel the query on pgbouncer too, and discard the connection because
+            # the reply to the cancelled query could still be in flight
+            try:
+                await asyncio.wait_for(conn.cancel(), self.config.getConnectTimeout())
+            except Exception as error:
+                logging.getLogger().debug("Unable to cancel {query} on {dsn}".format(query=query, dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+            finally:
                 conn.close()
 
-        # Add pgbouncer_up metric
-        metrics.append({
-            "type":   "gauge",
-            "name":   "pgbouncer_up",
-            "value":  1 if success else 0,
-            "labels": self.config.getExtraLabels(),
-            "help":   "PgBouncer is UP and the scraping of all metrics succeeded"
-        })
-
-        return metrics
-
-    def _exportMetrics(self, results, metricPrefix, metricMappings, labelMappings, extraLabels):
-        metrics = []
-
-        for result in results:
-            for mapping in metricMappings:
-                if "compute" in mapping:
-                    try:
-                        value = mapping["compute"](result)
-                    except KeyError:
-                        continue
-                elif mapping["column"] in result:
-                    value = result[mapping["column"]]
-                else:
-                    continue
+            raise ScrapeDeadlineExceeded("Cancelled {query} because the scrape deadline is exceeded".format(query=query))
+        finally:
+            self.instrumentation.observeQuery(query, time.perf_counter() - start, self._countRows(result))
 
-                labels = {labelName: result[columnName] for columnName, labelName in labelMappings.items()}
-                labels.update(extraLabels)
+        return result
 
-                metrics.append({
-                    "type":   mapping["type"],
-                    "name":   metricPrefix + mapping['metric'],
-                    "value":  value,
-                    "labels": labels,
-                    "help":   mapping["help"]
-                })
+    def _getQueries(self, cached=()):
+        queries = ["SHOW VERSION"] if self.version is False else []
+        queries += [query for query in QUERIES if query not in cached and self.config.isCollectorEnabled(QUERY_COLLECTORS[query])]
+        queries += [customQuery.query for customQuery in self.config.getCustomQueries()]
+        queries += [query for query, collectors in AGGREGATED_QUERIES if self._isAnyCollectorEnabled(collectors)]
 
-        return metrics
+        return queries
 
-    def _exportKeyValueMetrics(self, results, metricPrefix, metricMappings, extraLabels):
-        metrics = []
+    def _getExportedQueries(self):
+        exportedQueries = [entry for entry in EXPORTED_QUERIES if self.config.isCollectorEnabled(QUERY_COLLECTORS[entry[0]])]
 
-        for result in results:
-            for mapping in metricMappings:
-                if (result["key"] == mapping["key"]):
-                    metrics.append({
-                        "type":   mapping["type"],
-                        "name":   metricPrefix + mapping['metric'],
-                        "value":  int(result["value"]),
-                        "labels": extraLabels,
-                        "help":   mapping["help"]
-                    })
+        return exportedQueries + self.config.getCustomQueries()
 
-        return metrics
+    def _getCachedResults(self):
+        now = time.monotonic()
 
-    def _filterMetricsByIncludeDatabases(self, results, databases):
-        # No filtering if empty
-        if not databases:
-            return results
+        return {query: result for query, (result, expiresAt) in self.cachedResults.items() if now < expiresAt}
 
-        return list(filter(lambda item: item["database"] in databases, results))
+    def _cacheResult(self, query, result):
+        ttl = self.config.getConfigCacheTtl()
 
-    def _filterMetricsByExcludeDatabases(self, results, databases):
-        # No filtering if empty
-        if not databases:
-            return results
+        if result and ttl > 0 and query in CACHED_QUERIES:
+            self.cachedResults[query] = (result, time.monotonic() + ttl)
 
-        return list(filter(lambda item: item["database"] not in databases, results))
+    def _isAnyCollectorEnabled(self, collectors):
+        return any(self.config.isCollectorEnabled(name) for name, _ in collectors)
 
-    def _fetchMetrics(self, conn, query):
+    def _createAggregator(self, query):
+        for aggregatedQuery, collectors in AGGREGATED_QUERIES:
+            if query == aggregatedQuery:
+                return AggregatorsGroup([factory(self.config) for name, factory in collectors if self.config.isCollectorEnabled(name)])
+
+        return None
+
+    def _countRows(self, result):
+        if not result:
+            return None
+
+        return result.rowCount if isinstance(result, AggregatorsGroup) else len(result.rows)
+
+    def _getQueryTimeout(self, deadline, remainingQueries):
+        """
+        Split the time left before the deadline across the queries still to run, so that
+        a single stuck query doesn't prevent the other ones from running.
+        """
+        if deadline is None:
+            return None
+
+        return max(0, deadline - time.monotonic()) / remainingQueries
+
+    def _getConnectTimeout(self, deadline):
+        """
+        Returns the time left before the deadline, if shorter than the configured
+        connect_timeout (0 waits indefinitely), or None to use the configured one.
+        """
+        if deadline is None:
+            return None
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ScrapeDeadlineExceeded("Skipped connecting because the scrape deadline is exceeded")
+
+        configured = self.config.getConnectTimeout()
+        if configured and configured <= remaining:
+            return None
+
+        # libpq rounds the timeout down to whole seconds (see libpq_connect_timeout()), so
+        # the connect can only run past a deadline closer than the libpq minimum
+        return remaining
+
+    def _fetchAggregatedMetrics(self, conn, query, aggregator):
         cursor = False
 
         try:
             # Open a cursor
-            cursor = conn.cursor(cursor_factory=DictCursor)
-
-            # Fetch statistics
+            cursor = conn.cursor()
             cursor.execute(query)
+            aggregator.begin(tuple(column.name for column in cursor.description))
 
-            return cursor.fetchall()
+            # Fold the rows in batches, so that they're never all converted into python objects at once
+            while True:
+                rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+                if not rows:
+                    break
+
+                for row in rows:
+                    aggregator.add(row)
+
+            return aggregator
         except Exception as error:
             logging.getLogger().error("Unable run query {query} on {dsn}".format(query=query, dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
 
@@ -213,16 +1395,146 @@ class PgbouncerMetricsCollector():
             if cursor:
                 cursor.close()
 
-    def _createConnection(self):
-        conn = psycopg2.connect(dsn=self.config.getDsn(), connect_timeout=self.config.getConnectTimeout())
-        conn.set_session(autocommit=True)
+    async def _fetchAggregatedMetricsAsync(self, conn, query, aggregator):
+        try:
+            await conn.stream(query, aggregator.add, aggregator.begin)
 
-        return conn
+            return aggregator
+        except Exception as error:
+            logging.getLogger().error("Unable run query {query} on {dsn}".format(query=query, dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
 
+            return False
 
-def compute_maxwait_seconds(result):
-    """
-    Compute the maximum wait by summing `maxwait` with `maxwait_us` (microseconds)
-    so that we have higher precision on the maxwait seconds gauge
-    """
-    return result["maxwait"] + result["maxwait_us"] / 1000000.0
+    async def _fetchMetricsAsync(self, conn, query):
+        try:
+            return await conn.query(query)
+        except pgwire.PgwireError as error:
+            logging.getLogger().error("Unable run query {query} on {dsn}".format(query=query, dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+
+            return False
+
+    def _getConnection(self, deadline=None):
+        if self.conn and not self._isConnectionUsable(self.conn):
+            logging.getLogger().info("Reconnecting to {dsn} because the connection is no longer usable".format(dsn=self.config.getDsnWithMaskedPassword()))
+            self._closeConnection()
+
+        if not self.conn:
+            timeout = self._getConnectTimeout(deadline)
+            start = time.perf_counter()
+            connected = False
+
+            try:
+                self.conn = self._createConnection(timeout)
+                connected = True
+            finally:
+                self._observeConnect(time.perf_counter() - start, connected)
+
+            self._resetConnectionState()
+
+        return self.conn
+
+    async def _getConnectionAsync(self, deadline=None):
+        if self.asyncConn and not self.asyncConn.isUsable():
+            logging.getLogger().info("Reconnecting to {dsn} because the connection is no longer usable".format(dsn=self.config.getDsnWithMaskedPassword()))
+            self.asyncConn.close()
+            self.asyncConn = False
+
+        if not self.asyncConn:
+            timeout = self._getConnectTimeout(deadline)
+            start = time.perf_counter()
+            connected = False
+
+            if timeout is None:
+                timeout = self.config.getConnectTimeout() or None
+
+            try:
+                self.asyncConn = await pgwire.connect(self.config.getDsn(), timeout=timeout)
+                connected = True
+            finally:
+                self._observeConnect(time.perf_counter() - start, connected)
+
+            self._resetConnectionState()
+
+        return self.asyncConn
+
+    def _observeConnect(self, duration, connected):
+        self.instrumentation.observeConnect(duration, connected)
+
+        if connected:
+            self.breaker.recordSuccess()
+        else:
+            self.breaker.recordFailure()
+
+    def _probe(self):
+        """
+        Try to connect to pgbouncer, while the circuit breaker is open. The connection
+        is kept for the next scrape, if persistent.
+        """
+        if self.loop:
+            asyncio.run_coroutine_threadsafe(self._probeAsync(), self.loop).result()
+            return
+
+        with self.lock:
+            self._getConnection()
+
+            if not self.config.getPersistentConnection() or self.closed:
+                self._closeConnection()
+
+    async def _probeAsync(self):
+        async with self.asyncLock:
+            conn = await self._getConnectionAsync()
+
+            if not self.config.getPersistentConnection():
+                conn.close()
+                self.asyncConn = False
+
+    def _resetConnectionState(self):
+        # The pgbouncer behind a new connection may have been upgraded, restarted or reloaded
+        self.version = False
+        self.plans = {}
+        self.cachedResults = {}
+
+    def _fetchVersion(self, result):
+        version = parse_pgbouncer_version(result.rows[0][0]) if result and result.rows else None
+        if not version:
+            logging.getLogger().debug("Unable to detect the version of {dsn}".format(dsn=self.config.getDsnWithMaskedPassword()))
+
+        return version
+
+    def _getQueryPlan(self, query, result, metricPrefix, metricMappings, labelMappings):
+        key = (query, result.columns)
+
+        if key not in self.plans:
+            self.plans[key] = compile_query_plan(result.columns, self.version, metricPrefix, metricMappings, labelMappings)
+
+        return self.plans[key]
+
+    def _isConnectionUsable(self, conn):
+        """
+        Cheaply check whether an idle connection can be reused, without any round trip
+        to pgbouncer. An idle admin connection is not expected to receive any data, so
+        a readable socket means it has been closed (or is erroring) on the server side.
+        """
+        try:
+            if conn.closed != 0 or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                return False
+
+            readable, _, _ = select.select([conn.fileno()], [], [], 0)
+            return not readable
+        except Exception:
+            return False
+
+    def _closeConnection(self):
+        close_connection(self.conn, self.config)
+        self.conn = False
+
+    def _closeConnectionIfIdle(self):
+        # If a scrape is in progress, it closes the connection itself once completed
+        if self.lock.acquire(blocking=False):
+            try:
+                self._closeConnection()
+            finally:
+                self.lock.release()
+
+    def _createConnection(self, timeout=None):
+        return create_connection(self.config, timeout)
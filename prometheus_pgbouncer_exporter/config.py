@@ -1,19 +1,56 @@
+import fnmatch
+import threading
 import yaml
 import os
 import re
+from collections import namedtuple
 
 # Define the regex used to replace $(ENV_VAR) with ENV_VAR value
 ENV_VAR_MATCHER_PATTERN = re.compile(r'^(.*)\$\(([^\)]+)\)(.*)$')
 ENV_VAR_REPLACER_PATTERN = re.compile(r'\$\(([^\)]+)\)')
 
+# The collectors, and whether they're enabled by default
+DEFAULT_COLLECTORS = {
+    "stats": True,
+    "pools": True,
+    "databases": True,
+    "config": True,
+    "clients": False,
+    "servers": False,
+    "applications": False,
+}
+
+# The supported rankings of the top databases limiter, and the collector they require
+TOP_DATABASES_RANK_BY = {"total_xact_count": "stats", "cl_active": "pools", "cl_waiting": "pools"}
+
+# The admin console queries run by the built-in collectors, which can't be redefined
+# by the custom queries
+BUILTIN_QUERIES = ["SHOW VERSION", "SHOW STATS", "SHOW POOLS", "SHOW DATABASES", "SHOW CONFIG", "SHOW CLIENTS", "SHOW SERVERS"]
+
+# The valid names of metrics and labels
+METRIC_NAME_PATTERN = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+LABEL_NAME_PATTERN = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+# A custom admin console query, compiled into the same shape of the built-in ones: the
+# query, the prefix of the metric names, the metric mappings and the label mappings
+# (column to label name)
+CustomQuery = namedtuple("CustomQuery", ["query", "metricPrefix", "metricMappings", "labelMappings"])
+
 # Define the regex used to mask the password in the DSN
 DSN_PASSWORD_MASK_PATTERN = re.compile(r'^(.*:)([^@]*)(@.*)$')
 
+# The characters turning a database rule into a glob pattern
+DATABASE_GLOB_CHARS = frozenset("*?[")
+
+# The maximum number of database names whose match result is cached
+DATABASE_MATCHER_CACHE_SIZE = 100000
+
 
 class Config():
     def __init__(self, config={}):
         self.config = config
         self.pgbouncers = False
+        self.fileSdConfigs = False
 
     def getExporterHost(self):
         return self.config["exporter_host"] if "exporter_host" in self.config else "127.0.0.1"
@@ -21,6 +58,30 @@ class Config():
     def getExporterPort(self):
         return int(self.config["exporter_port"]) if "exporter_port" in self.config else 9100
 
+    def getScrapeConcurrency(self):
+        return int(self.config["scrape_concurrency"]) if "scrape_concurrency" in self.config else 10
+
+    def getPollingInterval(self):
+        return float(self.config["polling_interval"]) if "polling_interval" in self.config else 0
+
+    def getCacheTtl(self):
+        return float(self.config["cache_ttl"]) if "cache_ttl" in self.config else 0
+
+    def getScrapeTimeout(self):
+        return float(self.config["scrape_timeout"]) if "scrape_timeout" in self.config else 0
+
+    def getScrapeTimeoutOffset(self):
+        return float(self.config["scrape_timeout_offset"]) if "scrape_timeout_offset" in self.config else 0.5
+
+    def getProbeCacheSize(self):
+        return int(self.config["probe_cache_size"]) if "probe_cache_size" in self.config else 100
+
+    def getProbeIdleTimeout(self):
+        return float(self.config["probe_idle_timeout"]) if "probe_idle_timeout" in self.config else 300
+
+    def getEngine(self):
+        return self.config["engine"] if "engine" in self.config else "psycopg2"
+
     def getPgbouncers(self):
         # Lazy instance pgbouncer config
         if self.pgbouncers is False:
@@ -31,32 +92,27 @@ class Config():
 
         return self.pgbouncers
 
-    def read(self, filepath):
-        stream = False
-
-        # Setup environment variables replacement
-        def env_var_single_replace(match):
-            return os.environ[match.group(1)] if match.group(1) in os.environ else match.group()
-
-        def env_var_multi_replacer(loader, node):
-            value = loader.construct_scalar(node)
+    def getFileSdConfigs(self):
+        # Lazy instance file discovery config
+        if self.fileSdConfigs is False:
+            if "file_sd_configs" in self.config and self.config["file_sd_configs"]:
+                self.fileSdConfigs = list(map(lambda item: FileSdConfig(item), self.config["file_sd_configs"]))
+            else:
+                self.fileSdConfigs = []
 
-            return re.sub(ENV_VAR_REPLACER_PATTERN, env_var_single_replace, value)
+        return self.fileSdConfigs
 
-        yaml.add_implicit_resolver("!envvarreplacer", ENV_VAR_MATCHER_PATTERN)
-        yaml.add_constructor('!envvarreplacer', env_var_multi_replacer)
+    def read(self, filepath):
+        # The file is parsed again only if changed since the last read, while the environment
+        # variables are replaced on each read, because they may have changed in the meanwhile
+        self.config = replace_env_vars(_parse_config_file(filepath))
 
-        # Read file
-        try:
-            stream = open(filepath, "r")
-            self.config = yaml.load(stream, Loader=yaml.FullLoader)
+        # Handle an empty configuration file
+        if not self.config:
+            self.config = {}
 
-            # Handle an empty configuration file
-            if not self.config:
-                self.config = {}
-        finally:
-            if stream:
-                stream.close()
+        self.pgbouncers = False
+        self.fileSdConfigs = False
 
     def validate(self):
         """
@@ -64,31 +120,190 @@ class Config():
         of invalid config, or just pass on success.
         """
 
-        # Ensure there's at least 1 pgbouncer configured
-        if len(self.getPgbouncers()) == 0:
-            raise Exception("There is no pgbouncer instance configured. At least 1 pgbouncer instance is required to have something to monitor.")
+        # Ensure there's at least 1 pgbouncer configured, unless they're discovered
+        if len(self.getPgbouncers()) == 0 and len(self.getFileSdConfigs()) == 0:
+            raise Exception("There is no pgbouncer instance configured. At least 1 pgbouncer instance (or file_sd_configs) is required to have something to monitor.")
+
+        # Ensure the scrape concurrency is valid
+        if self.getScrapeConcurrency() < 1:
+            raise Exception("The scrape_concurrency must be greater than or equal to 1")
+
+        # Ensure the polling interval is valid
+        if self.getPollingInterval() < 0:
+            raise Exception("The polling_interval must be greater than or equal to 0")
+
+        # Ensure the cache TTL is valid
+        if self.getCacheTtl() < 0:
+            raise Exception("The cache_ttl must be greater than or equal to 0")
+
+        # Ensure the scrape timeout is valid
+        if self.getScrapeTimeout() < 0:
+            raise Exception("The scrape_timeout must be greater than or equal to 0")
+
+        if self.getScrapeTimeoutOffset() < 0:
+            raise Exception("The scrape_timeout_offset must be greater than or equal to 0")
+
+        # Ensure the probe cache is valid
+        if self.getProbeCacheSize() < 1:
+            raise Exception("The probe_cache_size must be greater than or equal to 1")
+
+        if self.getProbeIdleTimeout() <= 0:
+            raise Exception("The probe_idle_timeout must be greater than 0")
+
+        # Ensure the engine is supported
+        if self.getEngine() not in ["psycopg2", "asyncio"]:
+            raise Exception("The engine must be either psycopg2 or asyncio")
 
         # Validate all pgbouncers config
         for pgbouncerConfig in self.getPgbouncers():
             pgbouncerConfig.validate()
 
+        # Validate all file discovery config
+        for fileSdConfig in self.getFileSdConfigs():
+            fileSdConfig.validate()
+
         # Ensure all pgbouncers extra labels are unique, on multiple pgbouncers
         if len(self.getPgbouncers()) > 1:
-            labels = list(map(lambda item: item.getExtraLabels(), self.getPgbouncers()))
-            duplicates = list(filter(lambda item: labels.count(item) > 1, labels))
+            labels = set(tuple(sorted(item.getExtraLabels().items())) for item in self.getPgbouncers())
 
-            if duplicates or not labels:
+            if len(labels) < len(self.getPgbouncers()):
                 raise Exception("The extra_labels configured for each pgbouncer must be unique otherwise the exporter will export the same metric 2+ times with the same set of labels and then Prometheus will not ingest all metrics")
 
+        # Ensure the configured pgbouncers names are unique, since they're used to probe them
+        names = set()
+        for pgbouncerConfig in self.getPgbouncers():
+            if "name" not in pgbouncerConfig.config:
+                continue
+
+            if pgbouncerConfig.getName() in names:
+                raise Exception("The pgbouncer name {name} is not unique".format(name=pgbouncerConfig.getName()))
+
+            names.add(pgbouncerConfig.getName())
+
+
+def compile_custom_query(config):
+    """
+    Validates a custom query config and compiles it into a CustomQuery. Throws an
+    exception with the error message in case of invalid config.
+    """
+    query = str(config.get("query") or "").strip()
+    if not query.upper().startswith("SHOW ") or query.upper() in BUILTIN_QUERIES:
+        raise Exception("The custom query {query} must be an admin console SHOW command not already run by the built-in collectors".format(query=query))
+
+    metricPrefix = str(config.get("metric_prefix") or "pgbouncer_" + query[5:].strip().lower().replace(" ", "_") + "_")
+    metricMappings = []
+
+    for mapping in config.get("metrics") or []:
+        if mapping.get("type") not in ["counter", "gauge"]:
+            raise Exception("The type of the metrics of the custom query {query} must be counter or gauge".format(query=query))
+
+        if not mapping.get("column") or not METRIC_NAME_PATTERN.match(metricPrefix + str(mapping.get("metric") or mapping.get("column"))):
+            raise Exception("The metrics of the custom query {query} must have a column and a valid metric name".format(query=query))
+
+        metricMappings.append({
+            "type": mapping["type"],
+            "column": mapping["column"],
+            "metric": str(mapping.get("metric") or mapping["column"]),
+            "help": str(mapping.get("help") or "Value of the {column} column of {query}".format(column=mapping["column"], query=query)),
+        })
+
+    if not metricMappings:
+        raise Exception("The custom query {query} must define at least one metric".format(query=query))
+
+    labelMappings = {str(column): str(label) for column, label in (config.get("labels") or {}).items()}
+
+    invalid = [label for label in labelMappings.values() if not LABEL_NAME_PATTERN.match(label)]
+    if invalid:
+        raise Exception("Invalid label names {labels} in the custom query {query}".format(labels=", ".join(invalid), query=query))
+
+    return CustomQuery(query=query, metricPrefix=metricPrefix, metricMappings=metricMappings, labelMappings=labelMappings)
+
+
+class _EnvVarsTemplate(str):
+    """
+    A plain (unquoted) scalar of the config file containing $(ENV_VAR), which is
+    replaced on each read of the config.
+    """
+
+
+class _ConfigLoader(getattr(yaml, "CSafeLoader", yaml.SafeLoader)):
+    """
+    The loader of the config file, based on the libyaml parser if available. It's a
+    private subclass so that the config parsing never alters the global PyYAML loaders.
+    """
+
+
+# The implicit resolvers only apply to plain scalars, so the quoted ones are left untouched
+_ConfigLoader.add_implicit_resolver("!envvarreplacer", ENV_VAR_MATCHER_PATTERN, None)
+_ConfigLoader.add_constructor("!envvarreplacer", lambda loader, node: _EnvVarsTemplate(loader.construct_scalar(node)))
+
+
+# The parsed config files, keyed by path, with the (mtime, size) they were parsed at
+_parsedConfigFiles = {}
+_parsedConfigFilesLock = threading.Lock()
+
+
+def _parse_config_file(filepath):
+    stat = os.stat(filepath)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    with _parsedConfigFilesLock:
+        cached = _parsedConfigFiles.get(filepath)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+    with open(filepath, "r") as stream:
+        parsed = yaml.load(stream, Loader=_ConfigLoader)
+
+    with _parsedConfigFilesLock:
+        _parsedConfigFiles[filepath] = (signature, parsed)
+
+    return parsed
+
+
+def replace_env_vars(value):
+    """
+    Returns a copy of the parsed config where $(ENV_VAR) in plain keys and values is
+    replaced with the ENV_VAR value, if exist, or left untouched if doesn't exist.
+    """
+    if isinstance(value, _EnvVarsTemplate):
+        return ENV_VAR_REPLACER_PATTERN.sub(_replace_env_var, value)
+    elif isinstance(value, dict):
+        return {replace_env_vars(key): replace_env_vars(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [replace_env_vars(item) for item in value]
+    else:
+        return value
+
+
+def _replace_env_var(match):
+    return os.environ[match.group(1)] if match.group(1) in os.environ else match.group()
+
 
 class PgbouncerConfig():
     def __init__(self, config):
         self.config = config
         self.labels = False
+        self.databaseMatcher = False
+        self.customQueries = False
 
     def getDsn(self):
         return self.config["dsn"] if "dsn" in self.config else "postgresql://pgbouncer:@localhost:6431/pgbouncer"
 
+    def getIdentity(self):
+        """
+        Returns the key identifying this pgbouncer across config reloads and discovery
+        refreshes: its DSN and extra labels.
+        """
+        return (self.getDsn(), tuple(sorted(self.getExtraLabels().items())))
+
+    def getName(self):
+        """
+        Returns the name used to probe this pgbouncer, which defaults to its DSN with
+        the password masked.
+        """
+        return str(self.config["name"]) if "name" in self.config and self.config["name"] else self.getDsnWithMaskedPassword()
+
     def getDsnWithMaskedPassword(self):
         match = DSN_PASSWORD_MASK_PATTERN.match(self.getDsn())
         if match:
@@ -99,12 +314,98 @@ class PgbouncerConfig():
     def getConnectTimeout(self):
         return self.config["connect_timeout"] if "connect_timeout" in self.config else 5
 
+    def getPersistentConnection(self):
+        return bool(self.config["persistent_connection"]) if "persistent_connection" in self.config else True
+
+    def getConfigCacheTtl(self):
+        return float(self.config["config_cache_ttl"]) if "config_cache_ttl" in self.config else 0
+
+    def getDerivedMetrics(self):
+        return bool(self.config["derived_metrics"]) if "derived_metrics" in self.config else False
+
+    def getCircuitBreakerFailureThreshold(self):
+        return int(self._getCircuitBreakerOption("failure_threshold", 3))
+
+    def getCircuitBreakerBackoffInitial(self):
+        return float(self._getCircuitBreakerOption("backoff_initial", 1))
+
+    def getCircuitBreakerBackoffMax(self):
+        return float(self._getCircuitBreakerOption("backoff_max", 60))
+
+    def _getCircuitBreakerOption(self, name, default):
+        options = self.config["circuit_breaker"] if "circuit_breaker" in self.config and self.config["circuit_breaker"] else {}
+
+        return options[name] if name in options else default
+
+    def getCollectors(self):
+        return self.config["collectors"] if "collectors" in self.config and self.config["collectors"] else {}
+
+    def isCollectorEnabled(self, name):
+        collectors = self.getCollectors()
+
+        return bool(collectors[name]) if name in collectors else DEFAULT_COLLECTORS[name]
+
+    def getApplicationsTopK(self):
+        return int(self._getApplicationsOption("top_k", 10))
+
+    def getApplicationsAddressPrefixLength(self):
+        return int(self._getApplicationsOption("address_prefix_length", 0))
+
+    def _getApplicationsOption(self, name, default):
+        options = self.config["applications"] if "applications" in self.config and self.config["applications"] else {}
+
+        return options[name] if name in options else default
+
+    def getTopDatabasesLimit(self):
+        return int(self._getTopDatabasesOption("limit", 0))
+
+    def getTopDatabasesRankBy(self):
+        return self._getTopDatabasesOption("rank_by", "total_xact_count")
+
+    def _getTopDatabasesOption(self, name, default):
+        options = self.config["top_databases"] if "top_databases" in self.config and self.config["top_databases"] else {}
+
+        return options[name] if name in options else default
+
+    def getSamplerInterval(self):
+        return float(self._getSamplerOption("interval", 0))
+
+    def getSamplerWindow(self):
+        return float(self._getSamplerOption("window", 60))
+
+    def getSamplerQuantiles(self):
+        return [float(quantile) for quantile in self._getSamplerOption("quantiles", [0.5, 0.9, 0.99])]
+
+    def getSamplerSize(self):
+        # The number of samples kept for each pool, which bounds the memory it uses
+        return max(1, int(round(self.getSamplerWindow() / self.getSamplerInterval())))
+
+    def _getSamplerOption(self, name, default):
+        options = self.config["sampler"] if "sampler" in self.config and self.config["sampler"] else {}
+
+        return options[name] if name in options else default
+
+    def getCustomQueries(self):
+        # Lazy compile the custom queries
+        if self.customQueries is False:
+            queries = self.config["custom_queries"] if "custom_queries" in self.config and self.config["custom_queries"] else []
+            self.customQueries = [compile_custom_query(query) for query in queries]
+
+        return self.customQueries
+
     def getIncludeDatabases(self):
         return self.config["include_databases"] if "include_databases" in self.config else []
 
     def getExcludeDatabases(self):
         return self.config["exclude_databases"] if "exclude_databases" in self.config else []
 
+    def getDatabaseMatcher(self):
+        # Lazy compile the include and exclude databases rules
+        if self.databaseMatcher is False:
+            self.databaseMatcher = DatabaseMatcher(self.getIncludeDatabases(), self.getExcludeDatabases())
+
+        return self.databaseMatcher
+
     def getExtraLabels(self):
         # Lazy instance extra labels
         if self.labels is False:
@@ -124,3 +425,159 @@ class PgbouncerConfig():
         # Check DSN
         if not self.getDsn():
             raise Exception("The DSN is required")
+
+        # Check include and exclude databases rules
+        try:
+            self.getDatabaseMatcher()
+        except re.error as error:
+            raise Exception("The include_databases and exclude_databases contain an invalid regular expression: {error}".format(error=str(error)))
+
+        # Check collectors
+        unknown = [name for name in self.getCollectors() if name not in DEFAULT_COLLECTORS]
+        if unknown:
+            raise Exception("Unknown collectors {names}. Supported collectors are: {supported}".format(names=", ".join(unknown), supported=", ".join(DEFAULT_COLLECTORS)))
+
+        # Check applications breakdown
+        if self.getApplicationsTopK() < 1:
+            raise Exception("The applications top_k must be greater than or equal to 1")
+
+        if not 0 <= self.getApplicationsAddressPrefixLength() <= 32:
+            raise Exception("The applications address_prefix_length must be between 0 and 32")
+
+        # Check SHOW CONFIG cache
+        if self.getConfigCacheTtl() < 0:
+            raise Exception("The config_cache_ttl must be greater than or equal to 0")
+
+        # Check top databases limiter
+        if self.getTopDatabasesLimit() < 0:
+            raise Exception("The top_databases limit must be greater than or equal to 0")
+
+        if self.getTopDatabasesRankBy() not in TOP_DATABASES_RANK_BY:
+            raise Exception("The top_databases rank_by must be one of: {supported}".format(supported=", ".join(TOP_DATABASES_RANK_BY)))
+
+        if self.getTopDatabasesLimit() > 0 and not self.isCollectorEnabled(TOP_DATABASES_RANK_BY[self.getTopDatabasesRankBy()]):
+            raise Exception("The top_databases rank_by {rankBy} requires the {collector} collector".format(rankBy=self.getTopDatabasesRankBy(), collector=TOP_DATABASES_RANK_BY[self.getTopDatabasesRankBy()]))
+
+        # Check derived metrics
+        if self.getDerivedMetrics() and not (self.isCollectorEnabled("pools") and self.isCollectorEnabled("databases")):
+            raise Exception("The derived_metrics require the pools and databases collectors")
+
+        # Check the high frequency sampler
+        if self.getSamplerInterval() < 0:
+            raise Exception("The sampler interval must be greater than or equal to 0")
+
+        if self.getSamplerInterval() > 0 and self.getSamplerWindow() < self.getSamplerInterval():
+            raise Exception("The sampler window must be greater than or equal to the sampler interval")
+
+        if any(not 0 <= quantile <= 1 for quantile in self.getSamplerQuantiles()):
+            raise Exception("The sampler quantiles must be between 0 and 1")
+
+        # Check custom queries
+        queries = set()
+        for customQuery in self.getCustomQueries():
+            if customQuery.query in queries:
+                raise Exception("The custom query {query} is defined more than once".format(query=customQuery.query))
+
+            queries.add(customQuery.query)
+
+        # Check circuit breaker
+        if self.getCircuitBreakerFailureThreshold() < 0:
+            raise Exception("The circuit_breaker failure_threshold must be greater than or equal to 0")
+
+        if self.getCircuitBreakerBackoffInitial() <= 0 or self.getCircuitBreakerBackoffMax() < self.getCircuitBreakerBackoffInitial():
+            raise Exception("The circuit_breaker backoff_initial must be greater than 0 and less than or equal to backoff_max")
+
+
+class DatabaseMatcher():
+    """
+    Matches database names against the include and exclude databases rules, compiled
+    once. A rule can be an exact name, a glob pattern (ie. tenant_*) or a regular
+    expression enclosed in slashes (ie. /^tenant_[0-9]+$/). Exact names are looked up
+    in a set, while patterns are combined into a single regular expression. The result
+    of each database name is cached, since the same databases show up in every query.
+    """
+
+    def __init__(self, includeRules=None, excludeRules=None):
+        self.includeNames, self.includePattern = self._compile(includeRules)
+        self.excludeNames, self.excludePattern = self._compile(excludeRules)
+        self.includeAll = not self.includeNames and self.includePattern is None
+        self.excludeNone = not self.excludeNames and self.excludePattern is None
+        self.cache = {}
+
+    def isEmpty(self):
+        return self.includeAll and self.excludeNone
+
+    def matches(self, database):
+        result = self.cache.get(database)
+
+        if result is None:
+            result = (self.includeAll or self._matchesRules(database, self.includeNames, self.includePattern)) and \
+                (self.excludeNone or not self._matchesRules(database, self.excludeNames, self.excludePattern))
+
+            # Keep the cache bounded, in case databases keep being created and dropped
+            if len(self.cache) >= DATABASE_MATCHER_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[database] = result
+
+        return result
+
+    def _matchesRules(self, database, names, pattern):
+        return database in names or (pattern is not None and database is not None and pattern.match(database) is not None)
+
+    def _compile(self, rules):
+        names = set()
+        patterns = []
+
+        for rule in rules or []:
+            rule = str(rule)
+
+            if len(rule) > 1 and rule.startswith("/") and rule.endswith("/"):
+                # Regular expressions match anywhere in the name, like re.search()
+                patterns.append(".*?(?:{regex})".format(regex=rule[1:-1]))
+            elif DATABASE_GLOB_CHARS.intersection(rule):
+                patterns.append(fnmatch.translate(rule))
+            else:
+                names.add(rule)
+
+        pattern = re.compile("|".join("(?:{pattern})".format(pattern=pattern) for pattern in patterns), re.DOTALL) if patterns else None
+
+        return frozenset(names), pattern
+
+
+class FileSdConfig():
+    """
+    The config of a pgbouncers discovery from files, in the Prometheus file_sd format:
+    a list of groups of targets (pgbouncer DSNs) sharing the same labels.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def getFiles(self):
+        return self.config["files"] if "files" in self.config and self.config["files"] else []
+
+    def getRefreshInterval(self):
+        return float(self.config["refresh_interval"]) if "refresh_interval" in self.config else 60
+
+    def getDefaults(self):
+        return self.config["defaults"] if "defaults" in self.config and self.config["defaults"] else {}
+
+    def validate(self):
+        """
+        Validate the configuration. Throws an exception with the error message in case
+        of invalid config, or just pass on success.
+        """
+
+        # Check files
+        if not isinstance(self.getFiles(), list) or len(self.getFiles()) == 0:
+            raise Exception("The file_sd_configs files must be a non empty list of files, directories or glob patterns")
+
+        # Check refresh interval
+        if self.getRefreshInterval() <= 0:
+            raise Exception("The file_sd_configs refresh_interval must be greater than 0")
+
+        # Check the pgbouncer config applied to the discovered targets
+        if "dsn" in self.getDefaults() or "extra_labels" in self.getDefaults() or "name" in self.getDefaults():
+            raise Exception("The file_sd_configs defaults can't contain dsn, extra_labels and name, which are unique to each discovered target")
+
+        PgbouncerConfig(self.getDefaults()).validate()
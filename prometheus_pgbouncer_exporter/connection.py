@@ -0,0 +1,47 @@
+import logging
+import psycopg2
+from .config import PgbouncerConfig
+from . import pgwire
+
+# The minimum connect timeout honoured by libpq, in seconds
+LIBPQ_MIN_CONNECT_TIMEOUT = 2
+
+
+def libpq_connect_timeout(timeout):
+    """
+    Convert the time left before a scrape deadline into the libpq connect_timeout,
+    which is an integer number of seconds of at least 2 (1 is interpreted as 2). It's
+    rounded down, so that the connect never takes longer than the time left, unless
+    shorter than the minimum.
+    """
+    return max(LIBPQ_MIN_CONNECT_TIMEOUT, int(timeout))
+
+
+def create_connection(config: PgbouncerConfig, timeout=None):
+    """
+    Connect to pgbouncer, within the given time left before the scrape deadline or,
+    if None, the configured connect_timeout, which is passed to libpq unchanged.
+    """
+    connectTimeout = config.getConnectTimeout() if timeout is None else libpq_connect_timeout(timeout)
+    conn = psycopg2.connect(dsn=config.getDsn(), connect_timeout=connectTimeout)
+    conn.set_session(autocommit=True)
+
+    return conn
+
+
+def fetch_query_result(conn, query):
+    # Fetch the rows as plain tuples
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+
+        return pgwire.QueryResult(columns=tuple(column.name for column in cursor.description), rows=cursor.fetchall())
+
+
+def close_connection(conn, config: PgbouncerConfig):
+    if not conn:
+        return
+
+    try:
+        conn.close()
+    except Exception as error:
+        logging.getLogger().debug("Unable to close connection to {dsn}".format(dsn=config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
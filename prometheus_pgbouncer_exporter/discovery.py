@@ -0,0 +1,225 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import yaml
+from collections import namedtuple
+from typing import List
+from .config import FileSdConfig, PgbouncerConfig
+
+# The extensions of the target files read from a directory
+TARGET_FILE_EXTENSIONS = (".json", ".yml", ".yaml")
+
+# Prefer the libyaml based loader, if available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# The state of a target file: its (mtime, size) signature when it was parsed, and the
+# discovered pgbouncers config by identity
+_TargetFile = namedtuple("_TargetFile", ["signature", "targets"])
+
+
+class FileDiscovery():
+    """
+    Discovers the pgbouncers to scrape from files in the Prometheus file_sd format,
+    polling their mtime and size. Only the files which changed are parsed again, and
+    only the targets which are new get validated. The added and removed targets are
+    notified to the listener, which is called as listener(added configs, removed
+    identities) on each refresh changing the set of discovered targets.
+    """
+
+    def __init__(self, sdConfigs: List[FileSdConfig], listener):
+        self.sdConfigs = sdConfigs
+        self.listener = listener
+
+        # The state of each file, keyed by (index of the file_sd_configs entry, path)
+        self.files = {}
+
+        # The number of files each discovered target is listed in
+        self.refcounts = {}
+
+        self.nextRefreshAt = [0] * len(sdConfigs)
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="pgbouncer-discovery", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopEvent.set()
+
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = False
+
+    def reconfigure(self, sdConfigs: List[FileSdConfig]):
+        """
+        Switch to a new file discovery config, keeping the targets which are still
+        discovered with it.
+        """
+        with self.lock:
+            self.sdConfigs = sdConfigs
+            self.nextRefreshAt = [0] * len(sdConfigs)
+
+            # Parse all files again, because their defaults may have changed
+            self.files = {key: state._replace(signature=None) for key, state in self.files.items()}
+
+        self.refresh()
+
+    def refresh(self):
+        """
+        Parse the target files which changed since the previous refresh (of the
+        file_sd_configs entries due to be refreshed) and notify the changes.
+        """
+        with self.lock:
+            now = time.monotonic()
+            added = {}
+            removed = set()
+            seen = set()
+
+            for index, sdConfig in enumerate(self.sdConfigs):
+                if now < self.nextRefreshAt[index]:
+                    seen.update(key for key in self.files if key[0] == index)
+                    continue
+
+                self.nextRefreshAt[index] = now + sdConfig.getRefreshInterval()
+
+                for path in self._listFiles(sdConfig):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+
+                    key = (index, path)
+                    seen.add(key)
+                    self._refreshFile(key, path, (stat.st_mtime_ns, stat.st_size), sdConfig, added, removed)
+
+            # Forget the targets of the files which don't exist anymore
+            for key in [key for key in self.files if key not in seen]:
+                self._updateTargets(key, {}, added, removed)
+                del self.files[key]
+
+            # Notify the changes while holding the lock, so that the listener receives the
+            # changes of concurrent refreshes (ie. on reconfigure) in the same order
+            if added or removed:
+                logging.getLogger().info("Discovered {added} new pgbouncers and {removed} removed ones".format(added=len(added), removed=len(removed)))
+                self.listener(list(added.values()), list(removed))
+
+    def _run(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.refresh()
+            except Exception as error:
+                logging.getLogger().error("Unable to discover pgbouncers", extra={"exception": str(error)})
+
+            with self.lock:
+                wakeUpAt = min(self.nextRefreshAt) if self.nextRefreshAt else time.monotonic() + 60
+
+            self.stopEvent.wait(max(0, wakeUpAt - time.monotonic()))
+
+    def _listFiles(self, sdConfig):
+        paths = []
+
+        for pattern in sdConfig.getFiles():
+            if os.path.isdir(pattern):
+                paths.extend(sorted(os.path.join(pattern, name) for name in os.listdir(pattern) if name.endswith(TARGET_FILE_EXTENSIONS)))
+            else:
+                paths.extend(sorted(glob.glob(pattern)))
+
+        return paths
+
+    def _refreshFile(self, key, path, signature, sdConfig, added, removed):
+        state = self.files.get(key)
+        if state and state.signature == signature:
+            return
+
+        try:
+            targets = self._parseFile(path, sdConfig, state.targets if state else {})
+        except Exception as error:
+            # Keep the targets previously discovered from the file, which is parsed again
+            # on the next refresh (ie. it may be in the middle of being written)
+            logging.getLogger().error("Unable to read the pgbouncer targets from {path}".format(path=path), extra={"exception": str(error)})
+            return
+
+        self._updateTargets(key, targets, added, removed)
+        self.files[key] = _TargetFile(signature=signature, targets=targets)
+
+    def _parseFile(self, path, sdConfig, previous):
+        with open(path, "r") as stream:
+            if path.endswith(".json"):
+                groups = json.load(stream)
+            else:
+                groups = yaml.load(stream, Loader=YAML_LOADER)
+
+        if not groups:
+            return {}
+
+        if not isinstance(groups, list):
+            raise Exception("The target file must contain a list of target groups")
+
+        defaults = sdConfig.getDefaults()
+        targets = {}
+
+        for group in groups:
+            # Meta labels (ie. __meta_filepath) are not exported
+            labels = {name: str(value) for name, value in (group.get("labels") or {}).items() if not name.startswith("__")}
+
+            for dsn in group.get("targets") or []:
+                config = PgbouncerConfig(dict(defaults, dsn=dsn, extra_labels=labels))
+                identity = config.getIdentity()
+
+                # Only validate the targets which changed, including their defaults
+                if identity in previous and previous[identity].config == config.config:
+                    targets[identity] = previous[identity]
+                    continue
+
+                try:
+                    config.validate()
+                except Exception as error:
+                    logging.getLogger().error("Skipping an invalid pgbouncer target from {path}: {error}".format(path=path, error=str(error)))
+                    continue
+
+                targets[identity] = config
+
+        return targets
+
+    def _updateTargets(self, key, targets, added, removed):
+        previous = self.files[key].targets if key in self.files else {}
+
+        for identity, config in targets.items():
+            if identity in previous:
+                # A target whose config changed (ie. its defaults) replaces the previous one
+                if config is not previous[identity]:
+                    removed.add(identity)
+                    added[identity] = config
+
+                continue
+
+            count = self.refcounts.get(identity, 0)
+            self.refcounts[identity] = count + 1
+
+            # A target moved from a file to another one is left untouched
+            if count == 0:
+                if identity in removed:
+                    removed.discard(identity)
+                else:
+                    added[identity] = config
+
+        for identity in previous:
+            if identity in targets:
+                continue
+
+            count = self.refcounts[identity] - 1
+
+            if count == 0:
+                del self.refcounts[identity]
+
+                if identity in added:
+                    del added[identity]
+                else:
+                    removed.add(identity)
+            else:
+                self.refcounts[identity] = count
@@ -0,0 +1,116 @@
+import heapq
+from .metrics import Sample
+
+# The label value of the series the databases out of the top K are folded into
+OTHER_DATABASES = "__other__"
+
+# How databases are ranked by the top K limiter. Each entry is a tuple of (query,
+# candidate columns, whether to rank by the increment since the previous scrape).
+TOP_DATABASES_RANKINGS = {
+    "total_xact_count": ("SHOW STATS", ["total_xact_count", "total_requests"], True),
+    "cl_active": ("SHOW POOLS", ["cl_active"], False),
+    "cl_waiting": ("SHOW POOLS", ["cl_waiting"], False),
+}
+
+
+class TopDatabasesLimiter():
+    """
+    Limits the cardinality of the per-database metrics, keeping the full detail only
+    for the top K databases ranked by activity, while the other ones are folded into
+    a single series per metric, with all the query labels set to "__other__". Folded
+    gauges are summed (or maxed), while folded counters accumulate the increment of
+    each database since the previous scrape, so that the rollup stays monotonic while
+    databases move in and out of the top K.
+    """
+
+    def __init__(self, limit, rankBy):
+        self.limit = limit
+        self.rankBy = rankBy
+        self.top = set()
+        self.rankValues = {}
+        self.counterValues = {}
+        self.rollupCounters = {}
+
+    def rank(self, results, databaseFilter):
+        """
+        Ranks the databases given the results of the queries, and returns the set of
+        the top K ones. The previous top K is kept if the ranking query failed.
+        """
+        query, columns, byIncrement = TOP_DATABASES_RANKINGS[self.rankBy]
+        result = results.get(query)
+        if not result:
+            return self.top
+
+        positions = {column: index for index, column in enumerate(result.columns)}
+        column = next((column for column in columns if column in positions), None)
+        if column is None or "database" not in positions:
+            return self.top
+
+        databaseIndex = positions["database"]
+        valueIndex = positions[column]
+        totals = {}
+
+        for row in result.rows:
+            database = row[databaseIndex]
+            if databaseFilter(database):
+                totals[database] = totals.get(database, 0) + row[valueIndex]
+
+        if byIncrement:
+            previous = self.rankValues
+            self.rankValues = totals
+            totals = {database: _increment(previous.get(database, 0), value) for database, value in totals.items()}
+
+        self.top = set(database for database, value in heapq.nlargest(self.limit, totals.items(), key=lambda item: (item[1], item[0])))
+
+        return self.top
+
+    def export(self, query, rows, plan, extraLabelNames, extraLabelValues):
+        labelNames = plan.labelNames + extraLabelNames
+        labelIndexes = plan.labelIndexes
+        databaseIndex = labelIndexes[plan.labelNames.index("database")]
+        top = self.top
+
+        previousCounters = self.counterValues.get(query, {})
+        counterValues = {}
+        rollupCounters = self.rollupCounters.setdefault(query, {})
+        rollupGauges = {}
+
+        for row in rows:
+            key = tuple([row[index] for index in labelIndexes])
+            folded = row[databaseIndex] not in top
+            labelValues = key + extraLabelValues
+
+            for metric in plan.metrics:
+                if metric.compute:
+                    value = metric.compute(*[row[index] for index in metric.indexes])
+                else:
+                    value = row[metric.indexes[0]]
+
+                # Track the counters of all databases, so that the increment of a database
+                # leaving the top K is known
+                if metric.type == "counter":
+                    counterValues[(metric.name, key)] = value
+
+                if not folded:
+                    yield Sample(metric.type, metric.name, metric.help, labelNames, labelValues, value)
+                elif metric.type == "counter":
+                    rollupCounters[metric.name] = rollupCounters.get(metric.name, 0) + _increment(previousCounters.get((metric.name, key), 0), value)
+                elif metric.name in rollupGauges:
+                    rollupGauges[metric.name] = max(rollupGauges[metric.name], value) if metric.rollup == "max" else rollupGauges[metric.name] + value
+                else:
+                    rollupGauges[metric.name] = value
+
+        # Forget the databases which don't exist anymore
+        self.counterValues[query] = counterValues
+
+        labelValues = tuple(OTHER_DATABASES for _ in plan.labelNames) + extraLabelValues
+
+        for metric in plan.metrics:
+            values = rollupCounters if metric.type == "counter" else rollupGauges
+            if metric.name in values:
+                yield Sample(metric.type, metric.name, metric.help, labelNames, labelValues, values[metric.name])
+
+
+def _increment(previous, current):
+    # A counter lower than the previous value has been reset by a pgbouncer restart
+    return current - previous if current >= previous else current
@@ -0,0 +1,22 @@
+from collections import namedtuple
+
+
+def compute_maxwait_seconds(maxwait, maxwait_us):
+    """
+    Compute the maximum wait by summing `maxwait` with `maxwait_us` (microseconds)
+    so that we have higher precision on the maxwait seconds gauge
+    """
+    return maxwait + maxwait_us / 1000000.0
+
+
+class Sample(namedtuple("Sample", ["type", "name", "help", "labelNames", "labelValues", "value"])):
+    """
+    A single metric sample. Label names and values are tuples, so that the names
+    (and the extra labels tail of the values) can be shared among samples. The
+    value of a histogram sample is a tuple of (cumulative buckets, sum).
+    """
+    __slots__ = ()
+
+    @property
+    def labels(self):
+        return dict(zip(self.labelNames, self.labelValues))
@@ -0,0 +1,416 @@
+"""
+Minimal asyncio client for the PostgreSQL wire protocol, implementing just what's
+required to run simple queries against the pgbouncer admin console: startup,
+authentication (cleartext, md5 and SCRAM-SHA-256) and the simple query protocol.
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import struct
+from collections import namedtuple
+from urllib.parse import urlparse, unquote, parse_qsl
+
+# Protocol constants
+PROTOCOL_VERSION = 196608
+CANCEL_REQUEST_CODE = 80877102
+
+AUTH_OK = 0
+AUTH_CLEARTEXT_PASSWORD = 3
+AUTH_MD5_PASSWORD = 5
+AUTH_SASL = 10
+AUTH_SASL_CONTINUE = 11
+AUTH_SASL_FINAL = 12
+
+# Type OIDs decoded to python numbers, any other type is returned as string
+INTEGER_TYPE_OIDS = frozenset([20, 21, 23, 26])
+FLOAT_TYPE_OIDS = frozenset([700, 701, 1700])
+
+# The result of a simple query: a tuple of column names and a list of tuple rows
+QueryResult = namedtuple("QueryResult", ["columns", "rows"])
+
+
+class PgwireError(Exception):
+    def __init__(self, message, fields=None):
+        super().__init__(message)
+        self.fields = fields or {}
+
+
+def parse_dsn(dsn):
+    """
+    Parse a libpq connection string, either in the URI or in the key/value format,
+    into a dict of connection parameters.
+    """
+    params = {}
+
+    if dsn.startswith("postgresql://") or dsn.startswith("postgres://"):
+        uri = urlparse(dsn)
+        host = uri.netloc.rpartition("@")[2]
+
+        # A percent-encoded unix socket directory is case sensitive, unlike a hostname
+        if host.lower().startswith("%2f"):
+            params["host"] = unquote(host.partition(":")[0])
+        elif uri.hostname:
+            params["host"] = unquote(uri.hostname)
+        if uri.port:
+            params["port"] = uri.port
+        if uri.username:
+            params["user"] = unquote(uri.username)
+        if uri.password is not None:
+            params["password"] = unquote(uri.password)
+        if uri.path and uri.path != "/":
+            params["dbname"] = unquote(uri.path[1:])
+        params.update(parse_qsl(uri.query))
+    else:
+        for item in dsn.split():
+            key, _, value = item.partition("=")
+            params[key] = value.strip("'")
+
+    params["host"] = params.get("host", "localhost")
+    params["port"] = int(params.get("port", 5432))
+    params["user"] = params.get("user", os.environ.get("PGUSER", ""))
+    params["password"] = params.get("password", os.environ.get("PGPASSWORD", ""))
+    params["dbname"] = params.get("dbname", params["user"])
+
+    if params.get("sslmode", "disable") not in ("disable", "allow", "prefer"):
+        raise PgwireError("Unsupported sslmode {mode}: TLS is not supported".format(mode=params["sslmode"]))
+
+    return params
+
+
+async def open_stream(params, reader=None):
+    """
+    Open a stream to the host and port of the connection parameters or, if the host
+    is a directory (ie. /var/run/postgresql), to the unix socket in it, like libpq.
+    """
+    loop = asyncio.get_event_loop()
+    reader = reader or asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+
+    if params["host"].startswith("/"):
+        path = os.path.join(params["host"], ".s.PGSQL.{port}".format(port=params["port"]))
+        transport, _ = await loop.create_unix_connection(lambda: protocol, path)
+    else:
+        transport, _ = await loop.create_connection(lambda: protocol, params["host"], params["port"])
+
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+
+async def connect(dsn, timeout=None):
+    params = parse_dsn(dsn)
+    conn = Connection(params)
+
+    await asyncio.wait_for(conn._connect(), timeout)
+
+    return conn
+
+
+class _CountingStreamReader(asyncio.StreamReader):
+    """
+    A stream reader counting the bytes received, so that the connection knows whether
+    any of them is still unread.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.received = 0
+
+    def feed_data(self, data):
+        self.received += len(data)
+        super().feed_data(data)
+
+
+class Connection():
+    def __init__(self, params):
+        self.params = params
+        self.loop = None
+        self.reader = None
+        self.writer = None
+
+        # The number of bytes read from the reader
+        self.consumed = 0
+        self.backendPid = None
+        self.backendSecret = None
+        self.parameters = {}
+        self.closed = True
+
+    async def query(self, sql):
+        """
+        Run a simple query and return its result. Values are decoded according to
+        the column types into int, float or str (None for NULL).
+        """
+        rows = []
+        columns = await self.stream(sql, rows.append)
+
+        return QueryResult(columns=columns, rows=rows)
+
+    async def stream(self, sql, onRow, onColumns=None):
+        """
+        Run a simple query, passing each row to onRow as soon as it's received instead
+        of keeping the whole result in memory. Returns the column names. An error
+        raised by the callbacks is raised once the reply has been fully read, so
+        that the connection is left usable.
+        """
+        self._send(b"Q", sql.encode("utf-8") + b"\x00")
+
+        columns = ()
+        decoders = ()
+        error = None
+
+        while True:
+            msgType, payload = await self._receive()
+
+            if msgType == b"D":
+                if not error:
+                    try:
+                        onRow(_decode_row(payload, decoders))
+                    except Exception as callbackError:
+                        error = callbackError
+            elif msgType == b"T":
+                columns, decoders = _parse_row_description(payload)
+
+                if onColumns and not error:
+                    try:
+                        onColumns(columns)
+                    except Exception as callbackError:
+                        error = callbackError
+            elif msgType == b"E":
+                error = _parse_error(payload)
+            elif msgType == b"Z":
+                break
+
+        if error:
+            raise error
+
+        return columns
+
+    async def cancel(self):
+        """
+        Ask pgbouncer to cancel the query running on this connection. The request is
+        sent over a new connection, as required by the protocol.
+        """
+        if self.backendPid is None:
+            return
+
+        reader, writer = await open_stream(self.params)
+        try:
+            writer.write(struct.pack("!iiii", 16, CANCEL_REQUEST_CODE, self.backendPid, self.backendSecret))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def isUsable(self):
+        # An idle connection is not expected to receive any data
+        return not self.closed and not self.writer.is_closing() and not self.reader.at_eof() and self.reader.received == self.consumed
+
+    def closeThreadsafe(self):
+        """
+        Close the connection from a thread other than the one running its event loop.
+        """
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.close)
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+
+        try:
+            self._send(b"X", b"")
+        finally:
+            self.writer.close()
+
+    async def _connect(self):
+        self.loop = asyncio.get_event_loop()
+        self.reader, self.writer = await open_stream(self.params, _CountingStreamReader())
+        self.closed = False
+
+        try:
+            startup = b""
+            for key, value in (("user", self.params["user"]), ("database", self.params["dbname"]), ("application_name", "pgbouncer-exporter")):
+                startup += key.encode("utf-8") + b"\x00" + value.encode("utf-8") + b"\x00"
+            startup += b"\x00"
+
+            self.writer.write(struct.pack("!ii", len(startup) + 8, PROTOCOL_VERSION) + startup)
+            await self._authenticate()
+
+            # Wait until the server is ready to accept queries
+            while True:
+                msgType, payload = await self._receive()
+
+                if msgType == b"K":
+                    self.backendPid, self.backendSecret = struct.unpack("!ii", payload)
+                elif msgType == b"S":
+                    key, value, _ = payload.split(b"\x00", 2)
+                    self.parameters[key.decode("utf-8")] = value.decode("utf-8")
+                elif msgType == b"E":
+                    raise _parse_error(payload)
+                elif msgType == b"Z":
+                    break
+        except BaseException:
+            self.closed = True
+            self.writer.close()
+            raise
+
+    async def _authenticate(self):
+        scram = None
+
+        while True:
+            msgType, payload = await self._receive()
+
+            if msgType == b"E":
+                raise _parse_error(payload)
+            elif msgType != b"R":
+                raise PgwireError("Unexpected message {type} during authentication".format(type=msgType))
+
+            code = struct.unpack("!i", payload[:4])[0]
+
+            if code == AUTH_OK:
+                return
+            elif code == AUTH_CLEARTEXT_PASSWORD:
+                self._send(b"p", self.params["password"].encode("utf-8") + b"\x00")
+            elif code == AUTH_MD5_PASSWORD:
+                self._send(b"p", md5_password(self.params["user"], self.params["password"], payload[4:8]).encode("ascii") + b"\x00")
+            elif code == AUTH_SASL:
+                mechanisms = payload[4:].split(b"\x00")
+                if b"SCRAM-SHA-256" not in mechanisms:
+                    raise PgwireError("Unsupported SASL mechanisms {mechanisms}".format(mechanisms=mechanisms))
+
+                scram = ScramSha256(self.params["password"])
+                message = scram.clientFirstMessage()
+                self._send(b"p", b"SCRAM-SHA-256\x00" + struct.pack("!i", len(message)) + message)
+            elif code == AUTH_SASL_CONTINUE and scram:
+                self._send(b"p", scram.clientFinalMessage(payload[4:]))
+            elif code == AUTH_SASL_FINAL and scram:
+                scram.verifyServerFinalMessage(payload[4:])
+            else:
+                raise PgwireError("Unsupported authentication method {code}".format(code=code))
+
+    def _send(self, msgType, payload):
+        self.writer.write(msgType + struct.pack("!i", len(payload) + 4) + payload)
+
+    async def _receive(self):
+        try:
+            header = await self.reader.readexactly(5)
+            payload = await self.reader.readexactly(struct.unpack("!i", header[1:])[0] - 4)
+            self.consumed += len(header) + len(payload)
+        except BaseException:
+            # The protocol state is unknown after a partial read, so the connection can't be reused
+            self.closed = True
+            self.writer.close()
+            raise
+
+        return header[:1], payload
+
+
+class ScramSha256():
+    """
+    Client side of the SCRAM-SHA-256 authentication (without channel binding).
+    """
+
+    def __init__(self, password, nonce=None):
+        self.password = password.encode("utf-8")
+        self.clientNonce = nonce or base64.b64encode(os.urandom(18)).decode("ascii")
+        self.clientFirstBare = "n=,r=" + self.clientNonce
+        self.serverSignature = None
+
+    def clientFirstMessage(self):
+        return ("n,," + self.clientFirstBare).encode("utf-8")
+
+    def clientFinalMessage(self, serverFirst):
+        serverFirst = serverFirst.decode("utf-8")
+        attrs = dict(item.split("=", 1) for item in serverFirst.split(","))
+
+        if not attrs["r"].startswith(self.clientNonce):
+            raise PgwireError("Invalid SCRAM server nonce")
+
+        saltedPassword = hashlib.pbkdf2_hmac("sha256", self.password, base64.b64decode(attrs["s"]), int(attrs["i"]))
+        clientKey = hmac.new(saltedPassword, b"Client Key", hashlib.sha256).digest()
+        storedKey = hashlib.sha256(clientKey).digest()
+
+        clientFinalWithoutProof = "c=biws,r=" + attrs["r"]
+        authMessage = ",".join([self.clientFirstBare, serverFirst, clientFinalWithoutProof]).encode("utf-8")
+
+        clientSignature = hmac.new(storedKey, authMessage, hashlib.sha256).digest()
+        proof = bytes(key ^ signature for key, signature in zip(clientKey, clientSignature))
+
+        serverKey = hmac.new(saltedPassword, b"Server Key", hashlib.sha256).digest()
+        self.serverSignature = hmac.new(serverKey, authMessage, hashlib.sha256).digest()
+
+        return (clientFinalWithoutProof + ",p=" + base64.b64encode(proof).decode("ascii")).encode("utf-8")
+
+    def verifyServerFinalMessage(self, serverFinal):
+        attrs = dict(item.split("=", 1) for item in serverFinal.decode("utf-8").split(","))
+
+        if "v" not in attrs or not hmac.compare_digest(base64.b64decode(attrs["v"]), self.serverSignature):
+            raise PgwireError("Invalid SCRAM server signature")
+
+
+def md5_password(user, password, salt):
+    inner = hashlib.md5((password + user).encode("utf-8")).hexdigest()
+
+    return "md5" + hashlib.md5(inner.encode("ascii") + salt).hexdigest()
+
+
+def _parse_row_description(payload):
+    count = struct.unpack("!h", payload[:2])[0]
+    offset = 2
+    columns = []
+    decoders = []
+
+    for _ in range(count):
+        end = payload.index(b"\x00", offset)
+        columns.append(payload[offset:end].decode("utf-8"))
+        typeOid = struct.unpack("!i", payload[end + 7:end + 11])[0]
+        offset = end + 19
+
+        if typeOid in INTEGER_TYPE_OIDS:
+            decoders.append(int)
+        elif typeOid in FLOAT_TYPE_OIDS:
+            decoders.append(_decode_number)
+        else:
+            decoders.append(None)
+
+    return tuple(columns), tuple(decoders)
+
+
+def _decode_row(payload, decoders):
+    count = struct.unpack("!h", payload[:2])[0]
+    offset = 2
+    values = []
+
+    for index in range(count):
+        length = struct.unpack("!i", payload[offset:offset + 4])[0]
+        offset += 4
+
+        if length < 0:
+            values.append(None)
+            continue
+
+        value = payload[offset:offset + length].decode("utf-8")
+        offset += length
+
+        decoder = decoders[index]
+        values.append(decoder(value) if decoder else value)
+
+    return tuple(values)
+
+
+def _decode_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _parse_error(payload):
+    fields = {}
+
+    for field in payload.split(b"\x00"):
+        if field:
+            fields[field[:1].decode("ascii")] = field[1:].decode("utf-8", "replace")
+
+    return PgwireError(fields.get("M", "Unknown error"), fields)
@@ -0,0 +1,215 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+from prometheus_client.utils import floatToGoString
+from .config import PgbouncerConfig
+from .connection import close_connection, create_connection, fetch_query_result
+from .metrics import Sample, compute_maxwait_seconds
+
+# The SHOW POOLS values kept by the sampler for each pool, as (metric, help)
+SAMPLED_POOLS_METRICS = [
+    ("pgbouncer_pools_client_waiting_connections", "client connections waiting on a server connection"),
+    ("pgbouncer_pools_client_maxwait_seconds", "wait of the first (oldest) client in queue, in seconds"),
+]
+
+
+# The per-second rates computed by the sampler from the SHOW STATS counters, as
+# (column, metric, help, scale)
+SAMPLED_RATES = [
+    ("total_xact_count", "pgbouncer_stats_transactions_per_second", "Transactions pooled per second over the sampler window", 1),
+    ("total_query_count", "pgbouncer_stats_queries_per_second", "Queries pooled per second over the sampler window", 1),
+    ("total_requests", "pgbouncer_stats_requests_per_second", "Requests pooled per second over the sampler window", 1),
+    ("total_wait_time", "pgbouncer_stats_waiting_duration_seconds_per_second", "Time spent by clients waiting for a server per second over the sampler window", 0.000001),
+]
+
+
+def compute_quantile(values, quantile):
+    """
+    Return the nearest-rank quantile of a sorted, non-empty, list of values.
+    """
+    return values[min(len(values) - 1, max(0, math.ceil(quantile * len(values)) - 1))]
+
+
+class PoolsSampler():
+    """
+    Samples SHOW POOLS and SHOW STATS of a pgbouncer every interval seconds, on its
+    own persistent connection, so that the queueing spikes shorter than the scrape
+    interval show up in the max and quantiles of the waiting clients and max wait over
+    a sliding window. The samples are kept in ring buffers of a fixed size, so the
+    memory used by each pool doesn't grow with the scrape interval.
+    """
+
+    def __init__(self, config: PgbouncerConfig, isAvailable=None):
+        self.config = config
+        self.interval = config.getSamplerInterval()
+        self.size = config.getSamplerSize()
+        self.quantiles = config.getSamplerQuantiles()
+
+        # Whether pgbouncer may be sampled (ie. its circuit breaker is not open)
+        self.isAvailable = isAvailable
+
+        # The windows of (waiting clients, max wait seconds) by (database, user), and the
+        # windows of (timestamp, counters) by database along with the sampled counters
+        self.pools = {}
+        self.stats = {}
+        self.rates = ()
+
+        self.samples = 0
+        self.errors = 0
+        self.failing = False
+        self.conn = False
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="pgbouncer-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Don't wait for a sample in progress, the thread closes the connection on exit
+        self.stopEvent.set()
+        self.thread = False
+
+    def sample(self, now=None):
+        try:
+            if not self.conn:
+                self.conn = self._createConnection()
+
+                # The counters restart from zero if pgbouncer has been restarted
+                with self.lock:
+                    self.stats = {}
+
+            pools = self._fetchMetrics(self.conn, "SHOW POOLS")
+            stats = self._fetchMetrics(self.conn, "SHOW STATS")
+
+            with self.lock:
+                self._recordPools(pools)
+                self._recordStats(stats, time.monotonic() if now is None else now)
+                self.samples += 1
+        except Exception as error:
+            # Log the first of consecutive failures only, not once per interval
+            log = logging.getLogger().debug if self.failing else logging.getLogger().error
+            log("Unable to sample {dsn}".format(dsn=self.config.getDsnWithMaskedPassword()), extra={"exception": str(error)})
+            self._closeConnection()
+
+            # Don't export stale samples while pgbouncer can't be sampled
+            with self.lock:
+                self.errors += 1
+                self.failing = True
+                self.pools = {}
+                self.stats = {}
+
+            return False
+
+        self.failing = False
+        return True
+
+    def export(self, databaseFilter, extraLabelNames, extraLabelValues):
+        with self.lock:
+            pools = [(key, list(window)) for key, window in self.pools.items() if databaseFilter(key[0])]
+            stats = [(database, window[0], window[-1]) for database, window in self.stats.items() if len(window) > 1 and databaseFilter(database)]
+            rates = self.rates
+            samples, errors = self.samples, self.errors
+
+        labelNames = ("database", "user") + extraLabelNames
+        quantileLabelNames = ("database", "user", "quantile") + extraLabelNames
+        quantileLabels = [floatToGoString(quantile) for quantile in self.quantiles]
+
+        for (database, user), window in pools:
+            labelValues = (database, user) + extraLabelValues
+
+            for index, (metric, help) in enumerate(SAMPLED_POOLS_METRICS):
+                values = sorted(value[index] for value in window)
+
+                yield Sample("gauge", metric + "_window_max", "Maximum " + help + " over the sampler window", labelNames, labelValues, values[-1])
+                yield Sample("gauge", metric + "_window_mean", "Mean " + help + " over the sampler window", labelNames, labelValues, sum(values) / len(values))
+
+                for quantile, label in zip(self.quantiles, quantileLabels):
+                    yield Sample("gauge", metric + "_window_quantile", "Quantiles of the " + help + " over the sampler window", quantileLabelNames, (database, user, label) + extraLabelValues, compute_quantile(values, quantile))
+
+        labelNames = ("database",) + extraLabelNames
+
+        for database, (firstAt, first), (lastAt, last) in stats:
+            labelValues = (database,) + extraLabelValues
+
+            for index, (column, metric, help, scale) in enumerate(rates):
+                yield Sample("gauge", metric, help, labelNames, labelValues, (last[index] - first[index]) * scale / (lastAt - firstAt))
+
+        yield Sample("counter", "pgbouncer_exporter_sampler_samples", "Number of times the sampler sampled PgBouncer", extraLabelNames, extraLabelValues, samples)
+        yield Sample("counter", "pgbouncer_exporter_sampler_errors", "Number of times the sampler failed to sample PgBouncer", extraLabelNames, extraLabelValues, errors)
+
+    def _recordPools(self, result):
+        positions = {column: index for index, column in enumerate(result.columns)}
+        databaseIndex = positions["database"]
+        userIndex = positions["user"]
+        waitingIndex = positions["cl_waiting"]
+        maxwaitIndex = positions["maxwait"]
+        maxwaitUsIndex = positions.get("maxwait_us")
+        matches = self.config.getDatabaseMatcher().matches
+        pools = {}
+
+        for row in result.rows:
+            if not matches(row[databaseIndex]):
+                continue
+
+            key = (row[databaseIndex], row[userIndex])
+            window = self.pools[key] if key in self.pools else deque(maxlen=self.size)
+            window.append((row[waitingIndex], compute_maxwait_seconds(row[maxwaitIndex], row[maxwaitUsIndex] if maxwaitUsIndex is not None else 0)))
+            pools[key] = window
+
+        # Forget the pools which don't exist anymore
+        self.pools = pools
+
+    def _recordStats(self, result, now):
+        positions = {column: index for index, column in enumerate(result.columns)}
+        databaseIndex = positions["database"]
+        rates = tuple(rate for rate in SAMPLED_RATES if rate[0] in positions)
+        indexes = [positions[rate[0]] for rate in rates]
+        matches = self.config.getDatabaseMatcher().matches
+        stats = {}
+
+        # The columns only change with the pgbouncer version, which requires a restart
+        if rates != self.rates:
+            self.stats = {}
+            self.rates = rates
+
+        for row in result.rows:
+            database = row[databaseIndex]
+            if not matches(database):
+                continue
+
+            window = self.stats[database] if database in self.stats else deque(maxlen=self.size)
+            window.append((now, tuple(row[index] for index in indexes)))
+            stats[database] = window
+
+        self.stats = stats
+
+    def _run(self):
+        nextSampleAt = time.monotonic()
+
+        while not self.stopEvent.is_set():
+            if self.isAvailable is None or self.isAvailable():
+                self.sample()
+
+            # Sample at a fixed rate, skipping the samples we're late for
+            nextSampleAt += self.interval
+            now = time.monotonic()
+            if nextSampleAt < now:
+                nextSampleAt = now
+
+            self.stopEvent.wait(nextSampleAt - now)
+
+        self._closeConnection()
+
+    def _fetchMetrics(self, conn, query):
+        return fetch_query_result(conn, query)
+
+    def _closeConnection(self):
+        close_connection(self.conn, self.config)
+        self.conn = False
+
+    def _createConnection(self, timeout=None):
+        return create_connection(self.config, timeout)
@@ -0,0 +1,162 @@
+import gzip
+import hashlib
+import threading
+from collections import namedtuple
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from prometheus_client import exposition, make_wsgi_app
+from prometheus_client.openmetrics import exposition as openmetrics
+from .collector import PgbouncersMetricsCollector, requested_scrape_timeout
+
+
+# The exposition of a snapshot, rendered once and served as is to all requests
+RenderedExposition = namedtuple("RenderedExposition", ["generation", "contentType", "body", "gzipBody", "etag"])
+
+
+class SnapshotExposition():
+    """
+    Renders the text (or OpenMetrics) exposition of the latest snapshot, of the
+    poller or of the cached collections, once per snapshot generation, and keeps the
+    gzip compressed body next to it.
+    """
+
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.lock = threading.Lock()
+        self.rendered = {}
+
+    def get(self, contentType):
+        snapshot = self.snapshots.getSnapshot()
+        rendered = self.rendered.get(contentType)
+
+        if rendered and rendered.generation == snapshot.generation:
+            return rendered
+
+        # Render only once even if concurrent requests hit a new generation
+        with self.lock:
+            rendered = self.rendered.get(contentType)
+
+            if not rendered or rendered.generation != snapshot.generation:
+                rendered = self.rendered[contentType] = self._render(snapshot, contentType)
+
+        return rendered
+
+    def _render(self, snapshot, contentType):
+        encoder = openmetrics.generate_latest if contentType == openmetrics.CONTENT_TYPE_LATEST else exposition.generate_latest
+        body = encoder(_FamiliesRegistry(snapshot.families))
+        etag = '"{generation}-{digest}"'.format(generation=snapshot.generation, digest=hashlib.sha1(body).hexdigest()[:16])
+
+        return RenderedExposition(
+            generation=snapshot.generation,
+            contentType=contentType,
+            body=body,
+            gzipBody=gzip.compress(body, compresslevel=6),
+            etag=etag)
+
+
+class _FamiliesRegistry():
+    """
+    Exposes a list of metric families with the interface expected by the encoders.
+    """
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+def make_exporter_app(registry, snapshotExposition=False, prober: PgbouncersMetricsCollector = False):
+    """
+    Create a WSGI app which serves the metrics from the pre-rendered snapshot
+    exposition, if any, or renders them from the registry on each request. If a
+    prober is given, the metrics of a single pgbouncer are served on /probe too.
+    """
+    registryApp = make_wsgi_app(registry)
+
+    def exporter_app(environ, start_response):
+        params = parse_qs(environ.get("QUERY_STRING", ""))
+
+        if prober and environ.get("PATH_INFO") == "/probe":
+            return _serve_probe(prober, params, environ, start_response)
+
+        # Filtering by metric names can't be served from the rendered exposition
+        if not snapshotExposition or "name[]" in params:
+            with requested_scrape_timeout(_parse_scrape_timeout(environ)):
+                return registryApp(environ, start_response)
+
+        # The cached collections are collected again on the request following their expiry
+        _, contentType = exposition.choose_encoder(environ.get("HTTP_ACCEPT"))
+
+        with requested_scrape_timeout(_parse_scrape_timeout(environ)):
+            rendered = snapshotExposition.get(contentType)
+
+        # The gzip compressed representation has its own entity tag
+        useGzip = "gzip" in environ.get("HTTP_ACCEPT_ENCODING", "")
+        body = rendered.gzipBody if useGzip else rendered.body
+        etag = rendered.etag[:-1] + '-gzip"' if useGzip else rendered.etag
+
+        headers = [("Content-Type", contentType), ("ETag", etag), ("Vary", "Accept, Accept-Encoding")]
+        if useGzip:
+            headers.append(("Content-Encoding", "gzip"))
+
+        if etag in environ.get("HTTP_IF_NONE_MATCH", ""):
+            start_response("304 Not Modified", headers)
+            return [b""]
+
+        headers.append(("Content-Length", str(len(body))))
+        start_response("200 OK", headers)
+        return [body]
+
+    return exporter_app
+
+
+def _serve_probe(prober, params, environ, start_response):
+    if "target" not in params:
+        start_response("400 Bad Request", [("Content-Type", "text/plain")])
+        return [b"The target parameter is required"]
+
+    with requested_scrape_timeout(_parse_scrape_timeout(environ)):
+        families = prober.probe(params["target"][0])
+
+    if families is None:
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Unknown target"]
+
+    encoder, contentType = exposition.choose_encoder(environ.get("HTTP_ACCEPT"))
+    body = encoder(_FamiliesRegistry(families))
+
+    start_response("200 OK", [("Content-Type", contentType), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def _parse_scrape_timeout(environ):
+    """
+    Returns the scrape timeout sent by Prometheus, or None if missing or invalid.
+    """
+    try:
+        timeout = float(environ.get("HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS", ""))
+    except ValueError:
+        return None
+
+    return timeout if timeout > 0 else None
+
+
+class _SilentHandler(WSGIRequestHandler):
+    """WSGI handler that does not log requests."""
+
+    def log_message(self, format, *args):
+        """Log nothing."""
+
+
+def start_http_server(port, addr, registry, snapshotExposition=False, prober=False):
+    """
+    Starts the HTTP server serving the metrics as a daemon thread.
+    """
+    app = make_exporter_app(registry, snapshotExposition, prober)
+    httpd = make_server(addr, port, app, exposition.ThreadingWSGIServer, handler_class=_SilentHandler)
+
+    thread = threading.Thread(target=httpd.serve_forever, name="http-server", daemon=True)
+    thread.start()
+
+    return httpd
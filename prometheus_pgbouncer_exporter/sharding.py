@@ -0,0 +1,43 @@
+import hashlib
+from .config import PgbouncerConfig
+
+
+class Shard():
+    """
+    One of the shards the pgbouncers are split across, when running multiple exporter
+    replicas. Each pgbouncer is owned by the shard with the highest rendezvous hash of
+    its key (the extra labels or, if none, the DSN), so that adding or removing a
+    shard moves only the pgbouncers owned by that shard.
+    """
+
+    def __init__(self, index=0, count=1):
+        if count < 1:
+            raise Exception("The shard count must be greater than or equal to 1")
+
+        if not 0 <= index < count:
+            raise Exception("The shard index must be between 0 and the shard count minus 1")
+
+        self.index = index
+        self.count = count
+
+    def owns(self, config: PgbouncerConfig):
+        if self.count == 1:
+            return True
+
+        key = get_shard_key(config)
+
+        return max(range(self.count), key=lambda index: compute_rendezvous_score(key, index)) == self.index
+
+
+def get_shard_key(config: PgbouncerConfig):
+    labels = config.getExtraLabels()
+
+    if labels:
+        return ",".join("{name}={value}".format(name=name, value=value) for name, value in sorted(labels.items()))
+
+    return config.getDsn()
+
+
+def compute_rendezvous_score(key, index):
+    # A stable hash, unlike hash() which is salted differently by each process
+    return int.from_bytes(hashlib.blake2b("{key}\0{index}".format(key=key, index=index).encode("utf-8"), digest_size=8).digest(), "big")
@@ -0,0 +1,91 @@
+import heapq
+import logging
+import threading
+import time
+
+
+class _WatchedQuery():
+    def __init__(self, conn):
+        self.conn = conn
+        self.done = False
+        self.cancelled = False
+
+        # Held while sending the cancel request, so that a query completed in the
+        # meanwhile (and the next one on the same connection) is never cancelled
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        with self.lock:
+            if self.done:
+                return
+
+            self.cancelled = True
+
+            try:
+                self.conn.cancel()
+            except Exception as error:
+                logging.getLogger().debug("Unable to cancel the query", extra={"exception": str(error)})
+
+    def complete(self):
+        # Waits for the cancel request in-flight, if any
+        with self.lock:
+            self.done = True
+
+
+class QueryWatchdog():
+    """
+    Cancels the queries running on psycopg2 connections, on the pgbouncer side, once
+    they run past their timeout. A single thread watches the queries of all pgbouncers,
+    instead of starting a timer thread for each query.
+    """
+
+    def __init__(self):
+        # A heap of (cancel at, sequence, watched query). The queries completed in time
+        # are discarded once they reach the top of the heap.
+        self.queue = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.thread = False
+
+    def watch(self, conn, timeout):
+        query = _WatchedQuery(conn)
+
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.queue, (time.monotonic() + timeout, self.sequence, query))
+
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, name="pgbouncer-watchdog", daemon=True)
+                self.thread.start()
+
+            self.condition.notify()
+
+        return query
+
+    def unwatch(self, query):
+        query.complete()
+
+    def _run(self):
+        while True:
+            overdue = []
+
+            with self.condition:
+                now = time.monotonic()
+
+                while self.queue and (self.queue[0][2].done or self.queue[0][0] <= now):
+                    cancelAt, sequence, query = heapq.heappop(self.queue)
+
+                    if not query.done:
+                        overdue.append(query)
+
+                if not overdue:
+                    self.condition.wait(self.queue[0][0] - now if self.queue else None)
+
+            # The cancel request opens a connection to pgbouncer, so it's sent from its
+            # own thread to not delay the cancellation of the other queries
+            for query in overdue:
+                threading.Thread(target=query.cancel, name="pgbouncer-cancel", daemon=True).start()
+
+
+# The watchdog of the queries of all pgbouncers
+QUERY_WATCHDOG = QueryWatchdog()
@@ -0,0 +1,74 @@
+import unittest
+from prometheus_pgbouncer_exporter.aggregators import *
+
+
+class TestConnectionsAggregator(unittest.TestCase):
+
+    def testShouldParsePgbouncerTimestamp(self):
+        self.assertEqual(parse_pgbouncer_timestamp("2024-01-31 10:00:00 UTC"), 1706695200)
+        self.assertEqual(parse_pgbouncer_timestamp("invalid"), None)
+        self.assertEqual(parse_pgbouncer_timestamp(None), None)
+
+    def testShouldNotObserveTheWaitOfServers(self):
+        aggregator = ConnectionsAggregator("pgbouncer_servers_", observeWait=False, now=1706695200)
+        aggregator.begin(("type", "user", "database", "state", "connect_time", "request_time", "wait", "wait_us"))
+        aggregator.add(("S", "marco", "test", "waiting", "2024-01-31 09:00:00 UTC", "2024-01-31 09:59:59 UTC", 1, 0))
+        aggregator.add(("S", "marco", "prod", "active", "2024-01-31 09:00:00 UTC", "2024-01-31 09:59:59 UTC", 0, 0))
+
+        samples = list(aggregator.export(lambda database: database != "prod", (), ()))
+
+        self.assertEqual([sample.name for sample in samples], ["pgbouncer_servers_connection_age_seconds", "pgbouncer_servers_request_age_seconds"])
+        self.assertEqual(samples[0].value[1], 3600)
+        self.assertEqual(samples[1].value[1], 1)
+
+
+class TestApplicationsAggregator(unittest.TestCase):
+
+    def testShouldExportTheBusiestApplicationsAndFoldTheOtherOnes(self):
+        aggregator = ApplicationsAggregator(topK=3)
+        aggregator.begin(("type", "user", "database", "state", "addr", "application_name"))
+
+        rows = [("C", "marco", "test", "active", "10.0.0.1", "api")] * 50 + \
+               [("C", "marco", "test", "waiting", "10.0.0.2", "api")] * 20 + \
+               [("C", "marco", "test", "waiting", "10.0.1.1", "worker")] * 30 + \
+               [("C", "marco", "test", "active", "10.0.1.{index}".format(index=index), "script-{index}".format(index=index)) for index in range(100)] + \
+               [("C", "marco", "prod", "active", "10.0.2.1", "api")] * 5
+
+        for row in rows:
+            aggregator.add(row)
+
+        samples = list(aggregator.export(lambda database: True, ("pool_id",), ("1",)))
+        active = {(sample.labels["database"], sample.labels["application_name"]): sample.value for sample in samples if sample.name == "pgbouncer_clients_application_active_connections"}
+        waiting = {(sample.labels["database"], sample.labels["application_name"]): sample.value for sample in samples if sample.name == "pgbouncer_clients_application_waiting_connections"}
+
+        # The series are bounded by topK + 1 per database, the applications more frequent
+        # than 1/topK of the clients are guaranteed to be tracked and the totals are exact
+        self.assertEqual(len([key for key in active if key[0] == "test"]), 4)
+        self.assertEqual(active[("test", "api")], 50)
+        self.assertEqual(waiting[("test", "api")], 20)
+        self.assertEqual(sum(value for key, value in active.items() if key[0] == "test"), 150)
+        self.assertEqual(sum(value for key, value in waiting.items() if key[0] == "test"), 50)
+        self.assertEqual(active[("prod", "api")], 5)
+        self.assertEqual(active[("prod", "__other__")], 0)
+        self.assertEqual(samples[0].labels["pool_id"], "1")
+
+    def testShouldBreakDownApplicationsByAddressPrefix(self):
+        aggregator = ApplicationsAggregator(topK=10, addressPrefixLength=24)
+        aggregator.begin(("database", "state", "addr", "application_name"))
+        aggregator.add(("test", "active", "10.0.0.1", "api"))
+        aggregator.add(("test", "active", "10.0.0.2", "api"))
+        aggregator.add(("test", "waiting", "10.0.1.1", "api"))
+        aggregator.add(("test", "active", "unix", "psql"))
+
+        samples = [sample for sample in aggregator.export(lambda database: True, (), ()) if sample.name == "pgbouncer_clients_application_active_connections"]
+
+        self.assertEqual([(sample.labels["application_name"], sample.labels["address_prefix"], sample.value) for sample in samples], [
+            ("api", "10.0.0.0/24", 2),
+            ("api", "10.0.1.0/24", 0),
+            ("psql", "unix", 1),
+            ("__other__", "__other__", 0),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
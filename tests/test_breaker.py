@@ -0,0 +1,76 @@
+import time
+import unittest
+from unittest.mock import MagicMock
+from prometheus_pgbouncer_exporter.breaker import *
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def testShouldOpenAfterConsecutiveFailures(self):
+        breaker = CircuitBreaker("test", MagicMock(), failureThreshold=3, backoffInitial=60)
+
+        breaker.recordFailure()
+        breaker.recordFailure()
+        breaker.recordSuccess()
+        breaker.recordFailure()
+        breaker.recordFailure()
+        self.assertFalse(breaker.isOpen())
+
+        breaker.recordFailure()
+        self.assertTrue(breaker.isOpen())
+        self.assertEqual(breaker.export(), ({"closed": 0, "open": 1, "half_open": 0}, {"closed": 0, "open": 1, "half_open": 0}))
+
+        breaker.stop()
+
+    def testShouldNeverOpenIfDisabled(self):
+        breaker = CircuitBreaker("test", MagicMock(), failureThreshold=0)
+
+        for _ in range(10):
+            breaker.recordFailure()
+
+        self.assertFalse(breaker.isEnabled())
+        self.assertFalse(breaker.isOpen())
+
+    def testShouldReprobeInBackgroundWithExponentialBackoffUntilSuccess(self):
+        delays = []
+
+        def probe():
+            # The first two probes fail
+            if len(delays) < 2:
+                delays.append(breaker.backoff)
+                breaker.recordFailure()
+            else:
+                breaker.recordSuccess()
+
+        breaker = CircuitBreaker("test", probe, failureThreshold=1, backoffInitial=0.05, backoffMax=0.1)
+        breaker.recordFailure()
+
+        time.sleep(0.6)
+
+        self.assertFalse(breaker.isOpen())
+        self.assertEqual(delays, [0.05, 0.1])
+        self.assertEqual(breaker.backoff, 0.05)
+        self.assertEqual(breaker.export()[1], {"closed": 1, "open": 3, "half_open": 3})
+
+    def testShouldTreatAProbeRecordingNothingAsFailed(self):
+        probe = MagicMock(side_effect=Exception("Unexpected error"))
+        breaker = CircuitBreaker("test", probe, failureThreshold=1, backoffInitial=0.05, backoffMax=60)
+        breaker.recordFailure()
+
+        time.sleep(0.1)
+        breaker.stop()
+
+        self.assertTrue(breaker.isOpen())
+        self.assertEqual(breaker.backoff, 0.1)
+
+    def testShouldAddJitterToTheProbeDelay(self):
+        breaker = CircuitBreaker("test", MagicMock(), backoffInitial=10)
+
+        for _ in range(100):
+            delay = breaker.getNextProbeDelay()
+            self.assertGreaterEqual(delay, 10)
+            self.assertLessEqual(delay, 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,38 @@
+import asyncio
+import math
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock
+from collections import namedtuple
+from unittest.mock import MagicMock, patch
 from prometheus_pgbouncer_exporter.config import *
 from prometheus_pgbouncer_exporter.collector import *
+from prometheus_pgbouncer_exporter.pgwire import QueryResult
+from prometheus_pgbouncer_exporter.sharding import Shard
+from tests.fake_pgbouncer import FakePgbouncer, INT8_OID, TEXT_OID
 
 #
 # Helpers
 #
 
 def getMetricsByName(metrics, name):
-    return list(filter(lambda item: item["name"] == name, metrics))
+    return list(filter(lambda item: item.name == name, metrics))
 
+def asQueryResult(fetchMetricsMock):
+    """
+    Convert the list of dicts returned by the mock into a QueryResult of tuple rows.
+    """
+    def fetchMetrics(conn, query):
+        rows = fetchMetricsMock(conn, query)
+        if not rows:
+            return rows
+
+        columns = tuple(rows[0].keys())
+        return QueryResult(columns=columns, rows=[tuple(row[column] for column in columns) for row in rows])
+
+    return fetchMetrics
+
+@asQueryResult
 def fetchMetricsSuccessFromPgBouncer17Mock(conn, query):
     if query == "SHOW STATS":
         return [
@@ -34,6 +57,7 @@ def fetchMetricsSuccessFromPgBouncer17Mock(conn, query):
     else:
         return False
 
+@asQueryResult
 def fetchMetricsSuccessFromPgBouncer18Mock(conn, query):
     if query == "SHOW STATS":
         return [
@@ -58,6 +82,7 @@ def fetchMetricsSuccessFromPgBouncer18Mock(conn, query):
     else:
         return False
 
+@asQueryResult
 def fetchMetricsPartialFailureFromPgBouncer17Mock(conn, query):
     if query == "SHOW STATS":
         return [
@@ -76,6 +101,31 @@ def fetchMetricsPartialFailureFromPgBouncer17Mock(conn, query):
 def fetchMetricsFailureMock(conn, query):
     raise Exception("Error while fetching metrics")
 
+def fakePgbouncerResults():
+    return {
+        "SHOW VERSION": (("version",), (TEXT_OID,), [("PgBouncer 1.21.0",)]),
+        "SHOW STATS": (
+            ("database", "total_xact_count", "total_query_count"),
+            (TEXT_OID, INT8_OID, INT8_OID),
+            [("test", 2, 1), ("prod", 6, 4)]
+        ),
+        "SHOW POOLS": (
+            ("database", "user", "cl_active", "cl_waiting", "maxwait", "maxwait_us"),
+            (TEXT_OID, TEXT_OID, INT8_OID, INT8_OID, INT8_OID, INT8_OID),
+            [("test", "marco", 1, 2, 8, 100000), ("prod", "marco", 8, 7, 1, 200000)]
+        ),
+        "SHOW DATABASES": (
+            ("name", "database", "pool_size"),
+            (TEXT_OID, TEXT_OID, INT8_OID),
+            [("test", "test", 50), ("prod", "prod", 90)]
+        ),
+        "SHOW CONFIG": (
+            ("key", "value", "changeable"),
+            (TEXT_OID, TEXT_OID, TEXT_OID),
+            [("max_client_conn", "500", "yes"), ("max_user_connections", "0", "yes")]
+        ),
+    }
+
 #
 # Tests
 #
@@ -95,9 +145,9 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
         metrics = getMetricsByName(collector.collect(), "pgbouncer_up")
 
         self.assertEqual(len(metrics), 1)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {})
 
     def testShouldExportPgbouncerDownMetricOnNoMetricsScraped(self):
         config = PgbouncerConfig({})
@@ -108,9 +158,9 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
         metrics = getMetricsByName(collector.collect(), "pgbouncer_up")
 
         self.assertEqual(len(metrics), 1)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 0)
-        self.assertEqual(metrics[0]["labels"], {})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 0)
+        self.assertEqual(metrics[0].labels, {})
 
     def testShouldExportPgbouncerDownMetricOnMetricsPartiallyScraped(self):
         config = PgbouncerConfig({})
@@ -121,9 +171,9 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
         metrics = getMetricsByName(collector.collect(), "pgbouncer_up")
 
         self.assertEqual(len(metrics), 1)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 0)
-        self.assertEqual(metrics[0]["labels"], {})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 0)
+        self.assertEqual(metrics[0].labels, {})
 
     def testShouldComputeMaxwait(self):
         config = PgbouncerConfig({})
@@ -133,12 +183,12 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_pools_client_maxwait_seconds")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertAlmostEqual(metrics[0]["value"], 8.1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test", "user":"marco"})
-        self.assertEqual(metrics[1]["type"], "gauge")
-        self.assertAlmostEqual(metrics[1]["value"], 1.2)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod", "user":"marco"})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertAlmostEqual(metrics[0].value, 8.1)
+        self.assertEqual(metrics[0].labels, {"database":"test", "user":"marco"})
+        self.assertEqual(metrics[1].type, "gauge")
+        self.assertAlmostEqual(metrics[1].value, 1.2)
+        self.assertEqual(metrics[1].labels, {"database":"prod", "user":"marco"})
 
     def testShouldExportDatabasesMetrics(self):
         config = PgbouncerConfig({})
@@ -148,39 +198,39 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_databases_database_pool_size")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 50)
-        self.assertEqual(metrics[0]["labels"], {"backend_database":"test", "database":"test"})
-        self.assertEqual(metrics[1]["type"], "gauge")
-        self.assertEqual(metrics[1]["value"], 90)
-        self.assertEqual(metrics[1]["labels"], {"backend_database":"prod", "database":"prod"})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 50)
+        self.assertEqual(metrics[0].labels, {"backend_database":"test", "database":"test"})
+        self.assertEqual(metrics[1].type, "gauge")
+        self.assertEqual(metrics[1].value, 90)
+        self.assertEqual(metrics[1].labels, {"backend_database":"prod", "database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_databases_database_reserve_pool_size")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 10)
-        self.assertEqual(metrics[0]["labels"], {"backend_database":"test", "database":"test"})
-        self.assertEqual(metrics[1]["type"], "gauge")
-        self.assertEqual(metrics[1]["value"], 20)
-        self.assertEqual(metrics[1]["labels"], {"backend_database":"prod", "database":"prod"})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 10)
+        self.assertEqual(metrics[0].labels, {"backend_database":"test", "database":"test"})
+        self.assertEqual(metrics[1].type, "gauge")
+        self.assertEqual(metrics[1].value, 20)
+        self.assertEqual(metrics[1].labels, {"backend_database":"prod", "database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_databases_database_current_connections")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 30)
-        self.assertEqual(metrics[0]["labels"], {"backend_database":"test", "database":"test"})
-        self.assertEqual(metrics[1]["type"], "gauge")
-        self.assertEqual(metrics[1]["value"], 75)
-        self.assertEqual(metrics[1]["labels"], {"backend_database":"prod", "database":"prod"})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 30)
+        self.assertEqual(metrics[0].labels, {"backend_database":"test", "database":"test"})
+        self.assertEqual(metrics[1].type, "gauge")
+        self.assertEqual(metrics[1].value, 75)
+        self.assertEqual(metrics[1].labels, {"backend_database":"prod", "database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_databases_database_max_connections")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 0)
-        self.assertEqual(metrics[0]["labels"], {"backend_database":"test", "database":"test"})
-        self.assertEqual(metrics[1]["type"], "gauge")
-        self.assertEqual(metrics[1]["value"], 5)
-        self.assertEqual(metrics[1]["labels"], {"backend_database":"prod", "database":"prod"})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 0)
+        self.assertEqual(metrics[0].labels, {"backend_database":"test", "database":"test"})
+        self.assertEqual(metrics[1].type, "gauge")
+        self.assertEqual(metrics[1].value, 5)
+        self.assertEqual(metrics[1].labels, {"backend_database":"prod", "database":"prod"})
 
     def testShouldExportConfigMetrics(self):
         config = PgbouncerConfig({})
@@ -190,13 +240,13 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_config_max_client_conn")
         self.assertEqual(len(metrics), 1)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 500)
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 500)
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_config_max_user_connections")
         self.assertEqual(len(metrics), 1)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 0)
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 0)
 
 
     def testShouldExportQueriesMetricsFromPgBouncer17(self):
@@ -207,39 +257,39 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_requests_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 4)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 4)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_queries_duration_microseconds")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 2)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 3)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 2)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 3)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_received_bytes_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 3)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 2)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 3)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 2)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_sent_bytes_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 4)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 1)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 4)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 1)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_queries_total")
         self.assertEqual(len(metrics), 0)
@@ -255,66 +305,66 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_queries_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 4)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 4)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_transactions_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 2)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 6)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 2)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 6)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_transactions_duration_microseconds")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 2)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 3)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 2)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 3)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_waiting_duration_microseconds")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 2)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 2)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_queries_duration_microseconds")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 2)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 3)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 2)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 3)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_received_bytes_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 3)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 2)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 3)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 2)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_sent_bytes_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 4)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 1)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 4)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 1)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_requests_total")
         self.assertEqual(len(metrics), 0)
@@ -331,21 +381,21 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_requests_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 4)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 4)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_pools_client_active_connections")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test", "user": "marco"})
-        self.assertEqual(metrics[1]["type"], "gauge")
-        self.assertEqual(metrics[1]["value"], 8)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod", "user": "marco"})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test", "user": "marco"})
+        self.assertEqual(metrics[1].type, "gauge")
+        self.assertEqual(metrics[1].value, 8)
+        self.assertEqual(metrics[1].labels, {"database":"prod", "user": "marco"})
 
     def testShouldNotFilterDatabasesOnEmptyIncludeDatabasesConfigOption(self):
         config = PgbouncerConfig({"include_databases":[]})
@@ -355,21 +405,21 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_requests_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 4)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 4)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_pools_client_active_connections")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test", "user": "marco"})
-        self.assertEqual(metrics[1]["type"], "gauge")
-        self.assertEqual(metrics[1]["value"], 8)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod", "user": "marco"})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test", "user": "marco"})
+        self.assertEqual(metrics[1].type, "gauge")
+        self.assertEqual(metrics[1].value, 8)
+        self.assertEqual(metrics[1].labels, {"database":"prod", "user": "marco"})
 
     def testShouldFilterDatabasesByIncludeDatabasesConfigOption(self):
         config = PgbouncerConfig({"include_databases": ["prod"]})
@@ -379,15 +429,15 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_requests_total")
         self.assertEqual(len(metrics), 1)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 4)
-        self.assertEqual(metrics[0]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 4)
+        self.assertEqual(metrics[0].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_pools_client_active_connections")
         self.assertEqual(len(metrics), 1)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 8)
-        self.assertEqual(metrics[0]["labels"], {"database":"prod", "user": "marco"})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 8)
+        self.assertEqual(metrics[0].labels, {"database":"prod", "user": "marco"})
 
     def testShouldFilterDatabasesByExcludeDatabasesConfigOption(self):
         config = PgbouncerConfig({"exclude_databases": ["prod"]})
@@ -397,15 +447,607 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_requests_total")
         self.assertEqual(len(metrics), 1)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_pools_client_active_connections")
         self.assertEqual(len(metrics), 1)
-        self.assertEqual(metrics[0]["type"], "gauge")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test", "user": "marco"})
+        self.assertEqual(metrics[0].type, "gauge")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test", "user": "marco"})
+
+    def testShouldFilterDatabasesByGlobPatterns(self):
+        config = PgbouncerConfig({"include_databases": ["pr*"], "exclude_databases": ["/^te/"]})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer17Mock)
+
+        metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_requests_total")
+        self.assertEqual(len(metrics), 1)
+        self.assertEqual(metrics[0].labels, {"database":"prod"})
+
+    #
+    # Persistent connection
+    #
+
+    def testShouldReuseTheConnectionAcrossScrapes(self):
+        config = PgbouncerConfig({})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=MagicMock())
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        collector.collect()
+        collector.collect()
+
+        self.assertEqual(collector._createConnection.call_count, 1)
+        collector._createConnection.return_value.close.assert_not_called()
+
+        collector.close()
+        collector._createConnection.return_value.close.assert_called_once()
+
+    def testShouldNotWaitForTheScrapeInProgressOnClose(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetchMetricsMock(conn, query):
+            started.set()
+            release.wait(5)
+            return fetchMetricsSuccessFromPgBouncer18Mock(conn, query)
+
+        collector = PgbouncerMetricsCollector(PgbouncerConfig({}))
+        collector._createConnection = MagicMock(return_value=MagicMock())
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsMock)
+
+        scrape = threading.Thread(target=collector.collect)
+        scrape.start()
+        started.wait(1)
+
+        start = time.monotonic()
+        collector.close()
+        self.assertLess(time.monotonic() - start, 0.5)
+        collector._createConnection.return_value.close.assert_not_called()
+
+        # The scrape drops the connection once completed
+        release.set()
+        scrape.join()
+        collector._createConnection.return_value.close.assert_called_once()
+
+    def testShouldCacheShowConfigOnThePersistentConnection(self):
+        config = PgbouncerConfig({"config_cache_ttl": 60})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=MagicMock())
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        first = list(collector.collect())
+        second = list(collector.collect())
+
+        queries = [call[0][1] for call in collector._fetchMetrics.call_args_list]
+        self.assertEqual(queries.count("SHOW CONFIG"), 1)
+        self.assertEqual(getMetricsByName(second, "pgbouncer_config_max_client_conn")[0].value, 500)
+        self.assertEqual(getMetricsByName(second, "pgbouncer_up")[0].value, 1)
+
+        # The cache expires after the TTL
+        collector.cachedResults["SHOW CONFIG"] = (collector.cachedResults["SHOW CONFIG"][0], time.monotonic())
+        collector.collect()
+
+        queries = [call[0][1] for call in collector._fetchMetrics.call_args_list]
+        self.assertEqual(queries.count("SHOW CONFIG"), 2)
+
+    def testShouldInvalidateTheCachedShowConfigOnReconnect(self):
+        config = PgbouncerConfig({"config_cache_ttl": 60})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=MagicMock())
+        collector._isConnectionUsable = MagicMock(side_effect=[True, False, True, True])
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        collector.collect()
+        collector.collect()
+
+        queries = [call[0][1] for call in collector._fetchMetrics.call_args_list]
+        self.assertEqual(queries.count("SHOW CONFIG"), 2)
+        self.assertEqual(collector._createConnection.call_count, 2)
+
+    def testShouldReconnectWhenTheConnectionIsNoLongerUsable(self):
+        config = PgbouncerConfig({})
+        collector = PgbouncerMetricsCollector(config)
+        brokenConn = MagicMock()
+        collector._createConnection = MagicMock(side_effect=[brokenConn, MagicMock()])
+        collector._isConnectionUsable = MagicMock(side_effect=[True, False, True])
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        collector.collect()
+        metrics = getMetricsByName(collector.collect(), "pgbouncer_up")
+
+        self.assertEqual(collector._createConnection.call_count, 2)
+        brokenConn.close.assert_called_once()
+        self.assertEqual(metrics[0].value, 1)
+
+    def testShouldCloseTheConnectionOnEachScrapeIfNotPersistent(self):
+        config = PgbouncerConfig({"persistent_connection": False})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(side_effect=lambda timeout: MagicMock())
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        collector.collect()
+        collector.collect()
+
+        self.assertEqual(collector._createConnection.call_count, 2)
+        self.assertFalse(collector.conn)
+
+    #
+    # Compiled query plans
+    #
+
+    def testShouldDetectVersionAndCompileQueryPlansOncePerConnection(self):
+        def fetchMetricsMock(conn, query):
+            if query == "SHOW VERSION":
+                return QueryResult(columns=("version",), rows=[("PgBouncer 1.17.0",)])
+
+            return fetchMetricsSuccessFromPgBouncer18Mock(conn, query)
+
+        config = PgbouncerConfig({})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=MagicMock())
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsMock)
+
+        list(collector.collect())
+        plans = dict(collector.plans)
+        metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_transactions_total")
+
+        self.assertEqual(collector.version, (1, 17, 0))
+        self.assertEqual(len(plans), 3)
+        self.assertEqual(collector.plans, plans)
+        self.assertEqual([call[0][1] for call in collector._fetchMetrics.call_args_list].count("SHOW VERSION"), 1)
+        self.assertEqual(len(metrics), 2)
+
+    def testShouldExcludeMetricsNotSupportedByThePgbouncerVersion(self):
+        mappings = EXPORTED_QUERIES[0][2]
+        columns = ("database", "total_requests", "total_xact_count", "total_query_time")
+
+        plan = compile_query_plan(columns, (1, 7), "pgbouncer_stats_", mappings, {"database": "database"})
+        self.assertEqual([metric.name for metric in plan.metrics], ["pgbouncer_stats_requests_total", "pgbouncer_stats_queries_duration_microseconds"])
+
+        plan = compile_query_plan(columns, (1, 8, 1), "pgbouncer_stats_", mappings, {"database": "database"})
+        self.assertEqual([metric.name for metric in plan.metrics], ["pgbouncer_stats_transactions_total", "pgbouncer_stats_queries_duration_microseconds"])
+
+        # The columns returned are used when the version is unknown
+        plan = compile_query_plan(columns, None, "pgbouncer_stats_", mappings, {"database": "database"})
+        self.assertEqual(len(plan.metrics), 3)
+        self.assertEqual(plan.databaseIndex, 0)
+        self.assertEqual(plan.labelIndexes, (0,))
+
+    def testShouldParsePgbouncerVersion(self):
+        self.assertEqual(parse_pgbouncer_version("PgBouncer 1.21.0"), (1, 21, 0))
+        self.assertEqual(parse_pgbouncer_version("PgBouncer 1.8"), (1, 8))
+        self.assertEqual(parse_pgbouncer_version("unknown"), None)
+
+    #
+    # Streaming
+    #
+
+    def testShouldExportSamplesSharingLabelNamesAndExtraLabels(self):
+        config = PgbouncerConfig({"extra_labels": {"pool_id": 1}})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        # The samples are streamed from the results, but materialized within the scrape
+        samples = collector.collect()
+        self.assertIsInstance(samples, list)
+
+        metrics = getMetricsByName(samples, "pgbouncer_pools_client_active_connections")
+        self.assertEqual(metrics[0].labelNames, ("database", "user", "pool_id"))
+        self.assertEqual(metrics[0].labelValues, ("test", "marco", "1"))
+        self.assertIs(metrics[0].labelNames, metrics[1].labelNames)
+        self.assertEqual(metrics[0].labels, {"database": "test", "user": "marco", "pool_id": "1"})
+
+    #
+    # Scrape instrumentation
+    #
+
+    def testShouldExportQueryDurationsAndRowsByQuery(self):
+        config = PgbouncerConfig({"extra_labels": {"pool_id": 1}})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        samples = list(collector.collect())
+
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_connect_duration_seconds")
+        self.assertEqual(len(metrics), 1)
+        self.assertEqual(metrics[0].type, "histogram")
+        self.assertEqual(metrics[0].labels, {"pool_id": "1"})
+        self.assertEqual(metrics[0].value[0][-1], ("+Inf", 1))
+
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_query_duration_seconds")
+        self.assertEqual([metric.labels["query"] for metric in metrics], ["SHOW VERSION", "SHOW STATS", "SHOW POOLS", "SHOW DATABASES", "SHOW CONFIG"])
+        self.assertEqual(metrics[1].value[0][-1], ("+Inf", 1))
+
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_query_rows")
+        self.assertEqual(metrics[1].labels, {"query": "SHOW STATS", "pool_id": "1"})
+        self.assertEqual(metrics[1].value, 2)
+
+        # All samples but the instrumentation ones
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_samples")
+        self.assertEqual(metrics[0].value, len([sample for sample in samples if not sample.name.startswith("pgbouncer_exporter_")]))
+
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_errors")
+        self.assertEqual(sum(metric.value for metric in metrics), 1)
+        self.assertEqual([metric.labels["stage"] for metric in metrics if metric.value], ["SHOW VERSION"])
+
+    def testShouldCountErrorsByStage(self):
+        config = PgbouncerConfig({})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(side_effect=Exception("Unable to connect"))
+
+        metrics = getMetricsByName(collector.collect(), "pgbouncer_exporter_errors")
+        self.assertEqual({metric.labels["stage"]: metric.value for metric in metrics if metric.value}, {"connect": 1})
+
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsPartialFailureFromPgBouncer17Mock)
+
+        metrics = getMetricsByName(collector.collect(), "pgbouncer_exporter_errors")
+        self.assertEqual({metric.labels["stage"]: metric.value for metric in metrics if metric.value}, {"connect": 1, "SHOW VERSION": 1, "SHOW POOLS": 1})
+
+    def testShouldCountTransformErrors(self):
+        def fetchMetricsMock(conn, query):
+            # The "user" label column is missing
+            if query == "SHOW POOLS":
+                return QueryResult(columns=("database", "cl_active"), rows=[("test", 1)])
+
+            return fetchMetricsSuccessFromPgBouncer18Mock(conn, query)
+
+        config = PgbouncerConfig({})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsMock)
+
+        samples = list(collector.collect())
+
+        self.assertEqual(getMetricsByName(samples, "pgbouncer_up")[0].value, 0)
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_errors")
+        self.assertEqual({metric.labels["stage"]: metric.value for metric in metrics if metric.value}, {"SHOW VERSION": 1, "transform": 1})
+
+    def testShouldCountTheTransformErrorsOfTheAggregatedQueries(self):
+        config = PgbouncerConfig({"collectors": {"clients": True}})
+        collector = PgbouncerMetricsCollector(config)
+        aggregator = MagicMock()
+        aggregator.export = MagicMock(side_effect=Exception("Unexpected row"))
+
+        samples = list(collector._exportAllMetrics({"SHOW CLIENTS": aggregator}, True))
+
+        self.assertEqual(getMetricsByName(samples, "pgbouncer_up")[0].value, 0)
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_errors")
+        self.assertEqual({metric.labels["stage"]: metric.value for metric in metrics if metric.value}, {"transform": 1})
+
+    #
+    # Scrape deadline
+    #
+
+    def testShouldCancelTheQueryRunningPastTheDeadline(self):
+        conn = MagicMock()
+        cancelled = threading.Event()
+        conn.cancel = MagicMock(side_effect=cancelled.set)
+
+        def fetchMetricsMock(conn, query):
+            # SHOW POOLS hangs until cancelled
+            if query == "SHOW POOLS":
+                cancelled.wait(5)
+                return False
+
+            return fetchMetricsSuccessFromPgBouncer18Mock(conn, query)
+
+        config = PgbouncerConfig({})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=conn)
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsMock)
+
+        start = time.monotonic()
+        samples = list(collector.collect(deadline=time.monotonic() + 0.5))
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(conn.cancel.call_count, 1)
+        self.assertEqual(getMetricsByName(samples, "pgbouncer_up")[0].value, 0)
+        self.assertEqual(getMetricsByName(samples, "pgbouncer_scrape_incomplete")[0].value, 1)
+
+        # The queries following the cancelled one still run
+        self.assertEqual(len(getMetricsByName(samples, "pgbouncer_stats_transactions_total")), 2)
+        self.assertEqual(len(getMetricsByName(samples, "pgbouncer_databases_database_pool_size")), 2)
+        self.assertEqual(len(getMetricsByName(samples, "pgbouncer_pools_client_active_connections")), 0)
+
+    def testShouldExportScrapeCompleteWithinTheDeadline(self):
+        config = PgbouncerConfig({})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=MagicMock())
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        samples = list(collector.collect(deadline=time.monotonic() + 2))
+
+        self.assertEqual(getMetricsByName(samples, "pgbouncer_up")[0].value, 1)
+        self.assertEqual(getMetricsByName(samples, "pgbouncer_scrape_incomplete")[0].value, 0)
+
+        # The connect timeout is capped by the time left before the deadline
+        self.assertLessEqual(collector._createConnection.call_args[0][0], 2)
+
+    def testShouldPassTheConfiguredConnectTimeoutUnchanged(self):
+        for connectTimeout, timeLeft, expected in [(0, None, 0), (1, None, 1), (1, 10, 1), (5, 10, 5), (0, 10, 9), (5, 3, 2)]:
+            collector = PgbouncerMetricsCollector(PgbouncerConfig({"connect_timeout": connectTimeout}))
+
+            with patch("psycopg2.connect") as connect:
+                collector._getConnection(deadline=None if timeLeft is None else time.monotonic() + timeLeft)
+
+            # Only the time left before the deadline is rounded down and clamped for libpq
+            self.assertEqual(connect.call_args[1]["connect_timeout"], expected)
+
+    #
+    # Circuit breaker
+    #
+
+    def testShouldReportUnreachablePgbouncerDownWithoutConnectingOnceTheCircuitIsOpen(self):
+        config = PgbouncerConfig({"circuit_breaker": {"failure_threshold": 2, "backoff_initial": 0.1}})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(side_effect=Exception("Unable to connect"))
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        list(collector.collect())
+        list(collector.collect())
+        samples = list(collector.collect())
+
+        self.assertEqual(collector._createConnection.call_count, 2)
+        self.assertEqual(getMetricsByName(samples, "pgbouncer_up")[0].value, 0)
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_circuit_breaker_state")
+        self.assertEqual({metric.labels["state"]: metric.value for metric in metrics}, {"closed": 0, "open": 1, "half_open": 0})
+
+        # The background probe closes the circuit once pgbouncer is reachable again
+        collector._createConnection = MagicMock(return_value=MagicMock())
+        time.sleep(0.3)
+
+        samples = list(collector.collect())
+        self.assertEqual(collector._createConnection.call_count, 1)
+        self.assertEqual(getMetricsByName(samples, "pgbouncer_up")[0].value, 1)
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_circuit_breaker_transitions")
+        self.assertEqual({metric.labels["state"]: metric.value for metric in metrics}, {"closed": 1, "open": 1, "half_open": 1})
+
+        collector.close()
+
+    #
+    # SHOW CLIENTS and SHOW SERVERS
+    #
+
+    def testShouldFoldClientsInBatchesIntoHistogramsPerPool(self):
+        now = time.time()
+        connectTime = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(now - 120))
+        requestTime = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(now - 5))
+        rows = [("test", "marco", "waiting" if index % 2 else "active", connectTime, requestTime, index % 3, 500000) for index in range(2500)]
+
+        cursor = MagicMock()
+        cursor.description = [namedtuple("Column", ["name"])(column) for column in ("database", "user", "state", "connect_time", "request_time", "wait", "wait_us")]
+        cursor.fetchmany = MagicMock(side_effect=[rows[0:1000], rows[1000:2000], rows[2000:], []])
+        conn = MagicMock()
+        conn.cursor = MagicMock(return_value=cursor)
+
+        config = PgbouncerConfig({"collectors": {"clients": True}})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=conn)
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        samples = list(collector.collect())
+
+        self.assertFalse(cursor.fetchall.called)
+        self.assertEqual(getMetricsByName(samples, "pgbouncer_up")[0].value, 1)
+
+        metrics = getMetricsByName(samples, "pgbouncer_clients_connection_age_seconds")
+        self.assertEqual(len(metrics), 1)
+        self.assertEqual(metrics[0].labels, {"database": "test", "user": "marco"})
+        self.assertEqual(dict(metrics[0].value[0])["60.0"], 0)
+        self.assertEqual(dict(metrics[0].value[0])["300.0"], 2500)
+
+        metrics = getMetricsByName(samples, "pgbouncer_clients_request_age_seconds")
+        self.assertEqual(dict(metrics[0].value[0])["10.0"], 2500)
+
+        # Only the waiting clients are observed
+        metrics = getMetricsByName(samples, "pgbouncer_clients_wait_seconds")
+        self.assertEqual(dict(metrics[0].value[0])["1.0"], 417)
+        self.assertEqual(dict(metrics[0].value[0])["+Inf"], 1250)
+
+        metrics = getMetricsByName(samples, "pgbouncer_exporter_query_rows")
+        self.assertEqual({metric.labels["query"]: metric.value for metric in metrics}["SHOW CLIENTS"], 2500)
+
+        # SHOW SERVERS is not enabled
+        self.assertNotIn("SHOW SERVERS", [call[0][0] for call in cursor.execute.call_args_list])
+
+    #
+    # Selectable collectors and custom queries
+    #
+
+    def testShouldRunOnlyTheQueriesOfTheEnabledCollectors(self):
+        config = PgbouncerConfig({"collectors": {"stats": False, "databases": False, "config": False}})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        metrics = list(collector.collect())
+
+        queries = [call[0][1] for call in collector._fetchMetrics.call_args_list]
+        self.assertEqual(queries, ["SHOW VERSION", "SHOW POOLS"])
+        self.assertEqual(len(getMetricsByName(metrics, "pgbouncer_pools_client_active_connections")), 2)
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_stats_transactions_total"), [])
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_config_max_client_conn"), [])
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_up")[0].value, 1)
+
+    def testShouldExportTheMetricsOfTheCustomQueries(self):
+        def fetchMetricsMock(conn, query):
+            if query == "SHOW LISTS":
+                return QueryResult(columns=("list", "items"), rows=[("databases", 3), ("users", 2)])
+
+            return fetchMetricsSuccessFromPgBouncer18Mock(conn, query)
+
+        config = PgbouncerConfig({"custom_queries": [{
+            "query": "SHOW LISTS",
+            "metrics": [{"column": "items", "type": "gauge", "help": "Number of items"}],
+            "labels": {"list": "list"},
+        }]})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsMock)
+
+        metrics = list(collector.collect())
+
+        samples = getMetricsByName(metrics, "pgbouncer_lists_items")
+        self.assertEqual([(sample.type, sample.help, sample.labels, sample.value) for sample in samples], [
+            ("gauge", "Number of items", {"list": "databases"}, 3),
+            ("gauge", "Number of items", {"list": "users"}, 2),
+        ])
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_up")[0].value, 1)
+
+    #
+    # Derived metrics
+    #
+
+    def testShouldExportTheDerivedSaturationMetrics(self):
+        config = PgbouncerConfig({"derived_metrics": True})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        metrics = list(collector.collect())
+
+        samples = getMetricsByName(metrics, "pgbouncer_pools_server_utilization_ratio")
+        self.assertEqual([(sample.labels, sample.value) for sample in samples], [
+            ({"database": "test", "user": "marco"}, 3 / 50),
+            ({"database": "prod", "user": "marco"}, 6 / 90),
+        ])
+        self.assertEqual([sample.value for sample in getMetricsByName(metrics, "pgbouncer_pools_server_headroom_connections")], [25, 70])
+        self.assertEqual([sample.value for sample in getMetricsByName(metrics, "pgbouncer_pools_client_waiting_per_active_server_ratio")], [2 / 3, 7 / 6])
+        self.assertEqual([sample.value for sample in getMetricsByName(metrics, "pgbouncer_pools_reserve_pool_in_use_connections")], [0, 0])
+
+    def testShouldExportTheReservePoolInUseAndTheWaitingClientsWithNoActiveServer(self):
+        def fetchMetricsMock(conn, query):
+            if query == "SHOW POOLS":
+                return QueryResult(
+                    columns=("database", "user", "cl_active", "cl_waiting", "sv_active", "sv_idle", "sv_used", "sv_tested", "sv_login", "maxwait", "maxwait_us"),
+                    rows=[("test", "marco", 0, 4, 0, 0, 0, 0, 0, 1, 0), ("prod", "marco", 100, 0, 95, 0, 0, 0, 0, 0, 0)])
+
+            return fetchMetricsSuccessFromPgBouncer18Mock(conn, query)
+
+        config = PgbouncerConfig({"derived_metrics": True})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsMock)
+
+        metrics = list(collector.collect())
+
+        self.assertEqual([sample.value for sample in getMetricsByName(metrics, "pgbouncer_pools_client_waiting_per_active_server_ratio")], [math.inf, 0])
+        self.assertEqual([sample.value for sample in getMetricsByName(metrics, "pgbouncer_pools_server_headroom_connections")], [50, -5])
+        self.assertEqual([sample.value for sample in getMetricsByName(metrics, "pgbouncer_pools_reserve_pool_in_use_connections")], [0, 5])
+
+    def testShouldExportTheDerivedMetricsOnlyForTheFilteredDatabases(self):
+        config = PgbouncerConfig({"derived_metrics": True, "include_databases": ["prod"]})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        metrics = list(collector.collect())
+
+        samples = getMetricsByName(metrics, "pgbouncer_pools_server_utilization_ratio")
+        self.assertEqual([sample.labels["database"] for sample in samples], ["prod"])
+
+    def testShouldNotExportTheDerivedMetricsByDefault(self):
+        collector = PgbouncerMetricsCollector(PgbouncerConfig({}))
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        metrics = list(collector.collect())
+
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_pools_server_utilization_ratio"), [])
+
+    #
+    # Top databases limiter
+    #
+
+    def testShouldFoldTheDatabasesOutOfTheTopKIntoOther(self):
+        config = PgbouncerConfig({"top_databases": {"limit": 1, "rank_by": "cl_active"}})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        metrics = list(collector.collect())
+
+        samples = getMetricsByName(metrics, "pgbouncer_pools_client_active_connections")
+        self.assertEqual(len(samples), 2)
+        self.assertEqual(samples[0].labels, {"database": "prod", "user": "marco"})
+        self.assertEqual(samples[0].value, 8)
+        self.assertEqual(samples[1].labels, {"database": "__other__", "user": "__other__"})
+        self.assertEqual(samples[1].value, 1)
+
+        samples = getMetricsByName(metrics, "pgbouncer_databases_database_pool_size")
+        self.assertEqual([(sample.labels["database"], sample.value) for sample in samples], [("prod", 90), ("__other__", 50)])
+
+        samples = getMetricsByName(metrics, "pgbouncer_pools_client_maxwait_seconds")
+        self.assertEqual(samples[1].value, 8.1)
+
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_up")[0].value, 1)
+
+    def testShouldKeepTheOtherCountersMonotonicWhileDatabasesMoveInAndOutOfTheTopK(self):
+        scrapes = iter([{"test": 10, "prod": 5}, {"test": 11, "prod": 20}, {"test": 30, "prod": 21}])
+        current = {}
+
+        @asQueryResult
+        def fetchMetricsMock(conn, query):
+            if query == "SHOW STATS":
+                current.update(next(scrapes))
+                return [{"database": database, "total_xact_count": value} for database, value in current.items()]
+
+            return False
+
+        config = PgbouncerConfig({"top_databases": {"limit": 1}})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsMock)
+
+        exported = []
+        for _ in range(3):
+            samples = getMetricsByName(collector.collect(), "pgbouncer_stats_transactions_total")
+            exported.append({sample.labels["database"]: sample.value for sample in samples})
+
+        self.assertEqual(exported, [
+            {"test": 10, "__other__": 5},
+            {"prod": 20, "__other__": 6},
+            {"test": 30, "__other__": 7},
+        ])
+
+    #
+    # Applications breakdown
+    #
+
+    def testShouldQueryShowClientsOnceForAllItsCollectors(self):
+        cursor = MagicMock()
+        cursor.description = [namedtuple("Column", ["name"])(column) for column in ("database", "user", "state", "application_name")]
+        cursor.fetchmany = MagicMock(side_effect=[[("test", "marco", "active", "api")], []])
+        conn = MagicMock()
+        conn.cursor = MagicMock(return_value=cursor)
+
+        config = PgbouncerConfig({"collectors": {"clients": True, "applications": True}})
+        collector = PgbouncerMetricsCollector(config)
+        collector._createConnection = MagicMock(return_value=conn)
+        collector._isConnectionUsable = MagicMock(return_value=True)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        samples = list(collector.collect())
+
+        self.assertEqual(cursor.execute.call_count, 1)
+        self.assertEqual(len(getMetricsByName(samples, "pgbouncer_clients_connection_age_seconds")), 1)
+        self.assertEqual(len(getMetricsByName(samples, "pgbouncer_clients_application_active_connections")), 2)
 
     #
     # Metrics exported on partial failure
@@ -419,16 +1061,504 @@ class TestPgbouncerMetricsCollector(unittest.TestCase):
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_stats_requests_total")
         self.assertEqual(len(metrics), 2)
-        self.assertEqual(metrics[0]["type"], "counter")
-        self.assertEqual(metrics[0]["value"], 1)
-        self.assertEqual(metrics[0]["labels"], {"database":"test"})
-        self.assertEqual(metrics[1]["type"], "counter")
-        self.assertEqual(metrics[1]["value"], 4)
-        self.assertEqual(metrics[1]["labels"], {"database":"prod"})
+        self.assertEqual(metrics[0].type, "counter")
+        self.assertEqual(metrics[0].value, 1)
+        self.assertEqual(metrics[0].labels, {"database":"test"})
+        self.assertEqual(metrics[1].type, "counter")
+        self.assertEqual(metrics[1].value, 4)
+        self.assertEqual(metrics[1].labels, {"database":"prod"})
 
         metrics = getMetricsByName(collector.collect(), "pgbouncer_pools_client_active_connections")
         self.assertEqual(len(metrics), 0)
 
+    #
+    # Sampler
+    #
+
+    def testShouldExportTheSamplerWindowsFromTheCollector(self):
+        config = PgbouncerConfig({"sampler": {"interval": 60}, "extra_labels": {"pool_id": "1"}})
+
+        # Sample on demand, instead of in background
+        with patch.object(PoolsSampler, "start"):
+            collector = PgbouncerMetricsCollector(config)
+
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+        collector.sampler._createConnection = MagicMock(return_value=MagicMock())
+        collector.sampler._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+        collector.sampler.sample(now=0)
+
+        metrics = list(collector.collect())
+        collector.close()
+
+        samples = getMetricsByName(metrics, "pgbouncer_pools_client_waiting_connections_window_max")
+        self.assertEqual([(sample.labels, sample.value) for sample in samples], [
+            ({"database": "test", "user": "marco", "pool_id": "1"}, 2),
+            ({"database": "prod", "user": "marco", "pool_id": "1"}, 7),
+        ])
+
+    def testShouldNotFailTheScrapeIfTheSamplerExportFails(self):
+        with patch.object(PoolsSampler, "start"):
+            collector = PgbouncerMetricsCollector(PgbouncerConfig({"sampler": {"interval": 60}}))
+
+        collector._createConnection = MagicMock(return_value=False)
+        collector._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+        collector.sampler.export = MagicMock(side_effect=Exception("Unexpected"))
+
+        metrics = list(collector.collect())
+        collector.close()
+
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_up")[0].value, 1)
+        errors = {sample.labels["stage"]: sample.value for sample in getMetricsByName(metrics, "pgbouncer_exporter_errors")}
+        self.assertEqual(errors["transform"], 1)
+
+class TestPgbouncersMetricsCollector(unittest.TestCase):
+
+    def testShouldScrapeAllPgbouncersConcurrently(self):
+        def slowFetchMetricsMock(conn, query):
+            time.sleep(0.1)
+            return fetchMetricsSuccessFromPgBouncer18Mock(conn, query)
+
+        configs = [PgbouncerConfig({"extra_labels": {"pool_id": index}}) for index in range(4)]
+        collector = PgbouncersMetricsCollector(configs, concurrency=4)
+        for target in collector.collectors:
+            target._createConnection = MagicMock(return_value=False)
+            target._fetchMetrics = MagicMock(side_effect=slowFetchMetricsMock)
+
+        start = time.monotonic()
+        metrics = {metric.name: metric for metric in collector.collect()}
+        elapsed = time.monotonic() - start
+
+        # Each pgbouncer takes ~0.4s, so a sequential scrape would take ~1.6s
+        self.assertLess(elapsed, 1.2)
+
+        # Results are merged in the configured order into the same metric family
+        samples = metrics["pgbouncer_up"].samples
+        self.assertEqual([sample.labels for sample in samples], [{"pool_id": str(index)} for index in range(4)])
+        self.assertEqual([sample.value for sample in samples], [1, 1, 1, 1])
+
+    def testShouldMergeTheInstrumentationHistogramsIntoMetricFamilies(self):
+        configs = [PgbouncerConfig({"extra_labels": {"pool_id": index}}) for index in range(2)]
+        collector = PgbouncersMetricsCollector(configs)
+        for target in collector.collectors:
+            target._createConnection = MagicMock(return_value=False)
+            target._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        metrics = {metric.name: metric for metric in collector.collect()}
+        family = metrics["pgbouncer_exporter_query_duration_seconds"]
+
+        self.assertEqual(family.type, "histogram")
+        counts = [sample for sample in family.samples if sample.name == "pgbouncer_exporter_query_duration_seconds_count"]
+        self.assertEqual(len(counts), 10)
+        self.assertEqual(counts[0].labels, {"query": "SHOW VERSION", "pool_id": "0"})
+        self.assertEqual(counts[0].value, 1)
+
+    def testShouldReturnTheMetricsScrapedWithinTheScrapeTimeout(self):
+        def stuckFetchMetricsMock(conn, query):
+            time.sleep(2)
+            return fetchMetricsSuccessFromPgBouncer18Mock(conn, query)
+
+        configs = [PgbouncerConfig({"extra_labels": {"pool_id": index}}) for index in range(2)]
+        collector = PgbouncersMetricsCollector(configs, scrapeTimeout=0.5)
+        collector.collectors[0]._createConnection = MagicMock(return_value=False)
+        collector.collectors[0]._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+        collector.collectors[1]._createConnection = MagicMock(return_value=False)
+        collector.collectors[1]._fetchMetrics = MagicMock(side_effect=stuckFetchMetricsMock)
+
+        start = time.monotonic()
+        metrics = {metric.name: metric for metric in collector.collect()}
+
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual([(sample.labels, sample.value) for sample in metrics["pgbouncer_up"].samples], [({"pool_id": "0"}, 1), ({"pool_id": "1"}, 0)])
+        self.assertEqual([(sample.labels, sample.value) for sample in metrics["pgbouncer_scrape_incomplete"].samples], [({"pool_id": "0"}, 0), ({"pool_id": "1"}, 1)])
+        self.assertEqual(len(metrics["pgbouncer_pools_client_active_connections"].samples), 2)
+
+        # The instrumentation metrics are exported for the incomplete scrape too
+        self.assertEqual(set(sample.labels["pool_id"] for sample in metrics["pgbouncer_exporter_errors"].samples), {"0", "1"})
+
+    def testShouldHonourTheScrapeTimeoutRequestedByTheClient(self):
+        collector = PgbouncersMetricsCollector([], scrapeTimeout=0, scrapeTimeoutOffset=0.5)
+        self.assertIsNone(collector._getScrapeTimeout())
+
+        with requested_scrape_timeout(10):
+            self.assertEqual(collector._getScrapeTimeout(), 9.5)
+
+        # The configured scrape timeout caps the requested one
+        collector = PgbouncersMetricsCollector([], scrapeTimeout=5, scrapeTimeoutOffset=0.5)
+        self.assertEqual(collector._getScrapeTimeout(), 5)
+
+        with requested_scrape_timeout(3):
+            self.assertEqual(collector._getScrapeTimeout(), 2.5)
+
+    def testShouldShareTheInflightCollectionAmongConcurrentCollects(self):
+        def slowFetchMetricsMock(conn, query):
+            time.sleep(0.05)
+            return fetchMetricsSuccessFromPgBouncer18Mock(conn, query)
+
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({})])
+        collector.collectors[0]._createConnection = MagicMock(return_value=False)
+        collector.collectors[0]._fetchMetrics = MagicMock(side_effect=slowFetchMetricsMock)
+
+        threads = [threading.Thread(target=collector.collect) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(collector.collectors[0]._fetchMetrics.call_count, 5)
+        self.assertEqual(collector.cacheMisses, 1)
+        self.assertEqual(collector.cacheHits, 3)
+
+    def testShouldReuseTheCachedCollectionWithinTheTtl(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({})], cacheTtl=60)
+        collector.collectors[0]._createConnection = MagicMock(return_value=False)
+        collector.collectors[0]._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        collector.collect()
+        metrics = {metric.name: metric for metric in collector.collect()}
+
+        self.assertEqual(collector.collectors[0]._fetchMetrics.call_count, 5)
+        self.assertEqual(metrics["pgbouncer_up"].samples[0].value, 1)
+        self.assertEqual(metrics["pgbouncer_exporter_collect_cache_hits"].samples[0].value, 1)
+        self.assertEqual(metrics["pgbouncer_exporter_collect_cache_misses"].samples[0].value, 1)
+
+    def testShouldServeTheCachedCollectionAsASnapshotPerGeneration(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({})], cacheTtl=60)
+        collector.collectors[0]._createConnection = MagicMock(return_value=False)
+        collector.collectors[0]._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+        extraCollector = MagicMock()
+        extraCollector.collect.return_value = []
+        snapshots = CachedMetricsSnapshots(collector, [extraCollector])
+
+        first = snapshots.getSnapshot()
+        self.assertIs(snapshots.getSnapshot(), first)
+        self.assertEqual(first.generation, 1)
+        self.assertIn("pgbouncer_up", [family.name for family in first.families])
+        self.assertIn("pgbouncer_exporter_collect_cache_hits", [family.name for family in first.families])
+        self.assertEqual(extraCollector.collect.call_count, 1)
+
+        # The snapshot changes once the cached collection expires
+        collector.cached = collector.cached._replace(expiresAt=0)
+        self.assertEqual(snapshots.getSnapshot().generation, 2)
+
+    def testShouldNotCacheTheCollectionByDefault(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({})])
+        collector.collectors[0]._createConnection = MagicMock(return_value=False)
+        collector.collectors[0]._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        collector.collect()
+        collector.collect()
+
+        self.assertEqual(collector.collectors[0]._fetchMetrics.call_count, 10)
+        self.assertEqual(collector.cacheMisses, 2)
+
+    def testShouldCloseReplacedCollectorsOnUpdate(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({})])
+        previous = collector.collectors[0]
+        closed = threading.Event()
+        previous.close = MagicMock(side_effect=closed.set)
+
+        collector.update([PgbouncerConfig({"connect_timeout": 1})])
+
+        # Collectors are closed in background
+        self.assertTrue(closed.wait(1))
+        previous.close.assert_called_once()
+        self.assertIsNot(collector.collectors[0], previous)
+
+    def testShouldKeepTheCollectorsOfUnchangedPgbouncersOnUpdate(self):
+        collector = PgbouncersMetricsCollector([
+            PgbouncerConfig({"dsn": "postgresql://one", "extra_labels": {"pool_id": 1}}),
+            PgbouncerConfig({"dsn": "postgresql://two", "extra_labels": {"pool_id": 2}}),
+        ])
+        unchanged, removed = collector.collectors
+        closed = threading.Event()
+        unchanged.close = MagicMock()
+        removed.close = MagicMock(side_effect=closed.set)
+
+        collector.update([
+            PgbouncerConfig({"dsn": "postgresql://one", "extra_labels": {"pool_id": 1}}),
+            PgbouncerConfig({"dsn": "postgresql://three", "extra_labels": {"pool_id": 3}}),
+        ])
+
+        self.assertIs(collector.collectors[0], unchanged)
+        self.assertEqual(collector.collectors[1].config.getDsn(), "postgresql://three")
+        self.assertTrue(closed.wait(1))
+        unchanged.close.assert_not_called()
+        removed.close.assert_called_once()
+
+    def testShouldOnlyScrapeThePgbouncersOwnedByTheShard(self):
+        configs = [PgbouncerConfig({"dsn": "postgresql://pgbouncer-{index}".format(index=index), "extra_labels": {"pool_id": index}}) for index in range(20)]
+        shard = Shard(1, 2)
+        collector = PgbouncersMetricsCollector(configs, shard=shard)
+        collector.updateDiscovered([PgbouncerConfig({"dsn": "postgresql://discovered-{index}".format(index=index), "extra_labels": {"pool_id": 20 + index}}) for index in range(20)], [])
+
+        self.assertTrue(0 < len(collector.collectors) < 40)
+        self.assertTrue(all(shard.owns(item.config) for item in collector.collectors))
+
+        metrics = [metric for metric in collector._exporterMetrics() if metric.name == "pgbouncer_exporter_shard_targets"]
+        self.assertEqual(metrics[0].samples[0].labels, {"shard_index": "1", "shard_count": "2"})
+        self.assertEqual(metrics[0].samples[0].value, len(collector.collectors))
+
+    def testShouldProbeASinglePgbouncerByName(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"name": "one", "extra_labels": {"pool_id": 1}}), PgbouncerConfig({"name": "two", "extra_labels": {"pool_id": 2}})])
+
+        for scraped in collector.collectors:
+            scraped._createConnection = MagicMock(return_value=False)
+            scraped._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        with unittest.mock.patch("prometheus_pgbouncer_exporter.collector.PgbouncerMetricsCollector") as factory:
+            families = collector.probe("two")
+
+        up = [family for family in families if family.name == "pgbouncer_up"][0]
+        self.assertEqual([(sample.labels, sample.value) for sample in up.samples], [({"pool_id": "2"}, 1)])
+
+        # The scraped collector is reused, instead of creating a new one
+        self.assertEqual(factory.call_count, 0)
+        self.assertTrue(collector.collectors[1]._fetchMetrics.called)
+        self.assertFalse(collector.collectors[0]._fetchMetrics.called)
+        self.assertEqual(list(collector.probeCollectors.keys()), [])
+        self.assertIsNone(collector.probe("unknown"))
+
+    def testShouldProbeThePgbouncersOwnedByOtherShardsWithoutSampler(self):
+        shard = Shard(0, 2)
+        shard.owns = MagicMock(return_value=False)
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"name": "one", "sampler": {"interval": 1}})], shard=shard)
+
+        def createCollector(config, sample=True):
+            probed = PgbouncerMetricsCollector(config, sample=sample)
+            probed._createConnection = MagicMock(return_value=False)
+            probed._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+            return probed
+
+        with unittest.mock.patch("prometheus_pgbouncer_exporter.collector.PgbouncerMetricsCollector", side_effect=createCollector) as factory:
+            self.assertIsNotNone(collector.probe("one"))
+            collector.probe("one")
+
+        # The collector is kept warm across probes, and doesn't sample the pools
+        self.assertEqual(collector.collectors, [])
+        self.assertEqual(factory.call_count, 1)
+        self.assertFalse(collector.probeCollectors["one"][0].sampler)
+
+        # Once the pgbouncer is scraped by this exporter, the probe collector is evicted
+        shard.owns.return_value = True
+        collector.update([PgbouncerConfig({"name": "one"})])
+        probed, evicted = collector._getProbeCollector("one")
+
+        self.assertIs(probed, collector.collectors[0])
+        self.assertEqual(len(evicted), 1)
+        self.assertEqual(list(collector.probeCollectors.keys()), [])
+
+    def testShouldEvictTheLeastRecentlyProbedCollectors(self):
+        shard = Shard(0, 2)
+        shard.owns = MagicMock(return_value=False)
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"name": name}) for name in ["one", "two", "three"]], probeCacheSize=2, shard=shard)
+
+        first, evicted = collector._getProbeCollector("one")
+        first.close = MagicMock()
+        collector._getProbeCollector("two")
+        collector._getProbeCollector("one")
+        second, evicted = collector._getProbeCollector("three")
+
+        self.assertEqual(list(collector.probeCollectors.keys()), ["one", "three"])
+        self.assertEqual([item.config.getName() for item in evicted], ["two"])
+
+        collector.probeIdleTimeout = 0
+        second, evicted = collector._getProbeCollector("three")
+        self.assertEqual([item.config.getName() for item in evicted], ["one"])
+
+    def testShouldEvictTheIdleProbedCollectorsWithoutFurtherProbes(self):
+        shard = Shard(0, 2)
+        shard.owns = MagicMock(return_value=False)
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"name": "one"})], probeIdleTimeout=0.05, shard=shard)
+
+        probed, evicted = collector._getProbeCollector("one")
+        closed = threading.Event()
+        probed.close = MagicMock(side_effect=closed.set)
+
+        self.assertTrue(closed.wait(1))
+        self.assertEqual(list(collector.probeCollectors.keys()), [])
+        self.assertFalse(collector.probeEvictionTimer)
+
+    def testShouldAddAndRemoveDiscoveredCollectorsIncrementally(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"dsn": "postgresql://static"})])
+        static = collector.collectors[0]
+
+        collector.updateDiscovered([PgbouncerConfig({"dsn": "postgresql://one", "extra_labels": {"pool": "one"}}), PgbouncerConfig({"dsn": "postgresql://two", "extra_labels": {"pool": "two"}})], [])
+        self.assertEqual([item.config.getDsn() for item in collector.collectors], ["postgresql://static", "postgresql://one", "postgresql://two"])
+
+        kept = collector.collectors[2]
+        removed = collector.collectors[1]
+        closed = threading.Event()
+        removed.close = MagicMock(side_effect=closed.set)
+
+        collector.updateDiscovered([PgbouncerConfig({"dsn": "postgresql://static"})], [("postgresql://one", (("pool", "one"),))])
+        self.assertEqual(collector.collectors, [static, kept])
+        self.assertTrue(closed.wait(1))
+        removed.close.assert_called_once()
+
+    def testShouldNotScrapeTheDiscoveredPgbouncersExportingTheSameSeriesOfAnotherOne(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"dsn": "postgresql://static", "extra_labels": {"pool": "a"}})])
+        static = collector.collectors[0]
+
+        # The labels of the discovered pgbouncers clash with the static one and each other
+        collector.updateDiscovered([
+            PgbouncerConfig({"dsn": "postgresql://one", "extra_labels": {"pool": "a"}}),
+            PgbouncerConfig({"dsn": "postgresql://two", "extra_labels": {"pool": "b"}}),
+            PgbouncerConfig({"dsn": "postgresql://three", "extra_labels": {"pool": "b"}})], [])
+
+        self.assertEqual([item.config.getDsn() for item in collector.collectors], ["postgresql://static", "postgresql://two"])
+        self.assertEqual(len(collector.pendingDiscoveredConfigs), 2)
+
+        # The pending ones are scraped once the pgbouncer with the same labels is gone
+        collector.updateDiscovered([], [("postgresql://two", (("pool", "b"),))])
+        collector.update([])
+
+        self.assertEqual([item.config.getDsn() for item in collector.collectors], ["postgresql://three", "postgresql://one"])
+        self.assertEqual(collector.pendingDiscoveredConfigs, {})
+
+        # A static pgbouncer takes precedence over the discovered one with the same labels
+        discovered = collector.collectors[1]
+        discovered.close = MagicMock()
+        collector.update([static.config])
+
+        self.assertEqual([item.config.getDsn() for item in collector.collectors], ["postgresql://static", "postgresql://three"])
+        self.assertEqual(list(collector.pendingDiscoveredConfigs.keys()), [("postgresql://one", (("pool", "a"),))])
+
+
+class TestPgbouncersMetricsPoller(unittest.TestCase):
+
+    def testShouldServeAnEmptySnapshotBeforeTheFirstPoll(self):
+        poller = PgbouncersMetricsPoller(PgbouncersMetricsCollector([]), 60)
+
+        self.assertEqual(poller.collect(), ())
+        self.assertEqual(poller.snapshot.generation, 0)
+
+    def testShouldServeTheLatestSnapshotWithoutScrapingPgbouncer(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({})])
+        collector.collectors[0]._createConnection = MagicMock(return_value=False)
+        collector.collectors[0]._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        poller = PgbouncersMetricsPoller(collector, 60)
+        poller.poll()
+        fetchCount = collector.collectors[0]._fetchMetrics.call_count
+
+        metrics = {metric.name: metric for metric in poller.collect()}
+        metrics = {metric.name: metric for metric in poller.collect()}
+
+        self.assertEqual(collector.collectors[0]._fetchMetrics.call_count, fetchCount)
+        self.assertEqual(poller.snapshot.generation, 1)
+        self.assertEqual(metrics["pgbouncer_up"].samples[0].value, 1)
+        self.assertEqual(metrics["pgbouncer_up"].samples[0].timestamp, poller.snapshot.timestamp)
+
+    def testShouldPollInBackgroundUntilStopped(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({})])
+        collector.collectors[0]._createConnection = MagicMock(return_value=False)
+        collector.collectors[0]._fetchMetrics = MagicMock(side_effect=fetchMetricsSuccessFromPgBouncer18Mock)
+
+        poller = PgbouncersMetricsPoller(collector, 0.05)
+        poller.start()
+        time.sleep(0.3)
+        poller.stop()
+
+        generation = poller.snapshot.generation
+        self.assertGreater(generation, 1)
+
+        time.sleep(0.1)
+        self.assertEqual(poller.snapshot.generation, generation)
+
+
+class TestAsyncioEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [FakePgbouncer(fakePgbouncerResults(), auth="md5").start() for _ in range(2)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def testShouldScrapeAllPgbouncersFromASingleEventLoop(self):
+        configs = [PgbouncerConfig({"dsn": server.getDsn(), "extra_labels": {"pool_id": index}}) for index, server in enumerate(self.servers)]
+        collector = PgbouncersMetricsCollector(configs, engine="asyncio")
+
+        metrics = {metric.name: metric for metric in collector.collect()}
+
+        self.assertEqual([sample.value for sample in metrics["pgbouncer_up"].samples], [1, 1])
+        self.assertEqual([(sample.labels, sample.value) for sample in metrics["pgbouncer_stats_transactions"].samples], [
+            ({"database": "test", "pool_id": "0"}, 2),
+            ({"database": "prod", "pool_id": "0"}, 6),
+            ({"database": "test", "pool_id": "1"}, 2),
+            ({"database": "prod", "pool_id": "1"}, 6),
+        ])
+        self.assertAlmostEqual(metrics["pgbouncer_pools_client_maxwait_seconds"].samples[0].value, 8.1)
+        self.assertEqual(metrics["pgbouncer_config_max_client_conn"].samples[0].value, 500)
+
+        collector.close()
+
+    def testShouldReuseTheConnectionAndReconnectWhenItBreaks(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"dsn": self.servers[0].getDsn()})], engine="asyncio")
+
+        collector.collect()
+        collector.collect()
+        self.assertEqual(self.servers[0].connections, 1)
+
+        self.servers[0].disconnect()
+        time.sleep(0.1)
+
+        metrics = {metric.name: metric for metric in collector.collect()}
+        self.assertEqual(self.servers[0].connections, 2)
+        self.assertEqual(metrics["pgbouncer_up"].samples[0].value, 1)
+
+        collector.close()
+
+    def testShouldCancelTheQueryRunningPastTheScrapeTimeout(self):
+        async def stuckResult():
+            await asyncio.sleep(5)
+
+        results = fakePgbouncerResults()
+        results["SHOW POOLS"] = stuckResult
+        server = FakePgbouncer(results).start()
+        self.servers.append(server)
+
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"dsn": server.getDsn()})], engine="asyncio", scrapeTimeout=0.5)
+
+        start = time.monotonic()
+        metrics = {metric.name: metric for metric in collector.collect()}
+        time.sleep(0.1)
+
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(server.cancelRequests, 1)
+        self.assertEqual(metrics["pgbouncer_up"].samples[0].value, 0)
+        self.assertEqual(metrics["pgbouncer_scrape_incomplete"].samples[0].value, 1)
+        self.assertEqual(len(metrics["pgbouncer_stats_transactions"].samples), 2)
+
+        collector.close()
+
+    def testShouldStreamServersIntoHistograms(self):
+        results = fakePgbouncerResults()
+        results["SHOW SERVERS"] = (
+            ("type", "user", "database", "state", "connect_time", "request_time", "wait", "wait_us"),
+            (TEXT_OID, TEXT_OID, TEXT_OID, TEXT_OID, TEXT_OID, TEXT_OID, INT8_OID, INT8_OID),
+            [("S", "marco", "test", "active", "2024-01-31 09:00:00 UTC", "2024-01-31 09:59:59 UTC", 0, 0)] * 3
+        )
+        server = FakePgbouncer(results).start()
+        self.servers.append(server)
+
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"dsn": server.getDsn(), "collectors": {"servers": True}})], engine="asyncio")
+        metrics = {metric.name: metric for metric in collector.collect()}
+
+        self.assertEqual(metrics["pgbouncer_up"].samples[0].value, 1)
+        self.assertEqual(metrics["pgbouncer_servers_connection_age_seconds"].type, "histogram")
+        counts = [sample for sample in metrics["pgbouncer_servers_connection_age_seconds"].samples if sample.name.endswith("_count")]
+        self.assertEqual([(sample.labels, sample.value) for sample in counts], [({"database": "test", "user": "marco"}, 3)])
+
+        collector.close()
+
+    def testShouldExportPgbouncerDownOnConnectionFailure(self):
+        collector = PgbouncersMetricsCollector([PgbouncerConfig({"dsn": self.servers[0].getDsn(password="wrong")})], engine="asyncio")
+
+        metrics = {metric.name: metric for metric in collector.collect()}
+        self.assertEqual(metrics["pgbouncer_up"].samples[0].value, 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,14 @@
+import unittest
+from prometheus_pgbouncer_exporter.connection import *
+
+
+class TestConnection(unittest.TestCase):
+
+    def testShouldRoundTheLibpqConnectTimeoutDown(self):
+        self.assertEqual(libpq_connect_timeout(5), 5)
+        self.assertEqual(libpq_connect_timeout(3.7), 3)
+        self.assertEqual(libpq_connect_timeout(0.5), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
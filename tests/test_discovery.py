@@ -0,0 +1,161 @@
+import json
+import os
+import tempfile
+import unittest
+from prometheus_pgbouncer_exporter.config import FileSdConfig
+from prometheus_pgbouncer_exporter.discovery import FileDiscovery
+
+
+class TestFileDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.changes = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def writeTargets(self, name, groups, mtime=None):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "w") as stream:
+            json.dump(groups, stream)
+
+        # Ensure the change is detected even within the mtime resolution
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+        return path
+
+    def createDiscovery(self, defaults=None):
+        sdConfig = FileSdConfig({"files": [self.dir.name], "refresh_interval": 0.001, "defaults": defaults})
+
+        return FileDiscovery([sdConfig], lambda added, removed: self.changes.append((added, removed)))
+
+    def testShouldNotifyTheDiscoveredTargets(self):
+        self.writeTargets("a.json", [{"targets": ["postgresql://one", "postgresql://two"], "labels": {"pool": "a", "__meta_ignored": "x"}}])
+        discovery = self.createDiscovery({"connect_timeout": 2})
+        discovery.refresh()
+
+        self.assertEqual(len(self.changes), 1)
+        added, removed = self.changes[0]
+        self.assertEqual([config.getDsn() for config in added], ["postgresql://one", "postgresql://two"])
+        self.assertEqual(added[0].getExtraLabels(), {"pool": "a"})
+        self.assertEqual(added[0].getConnectTimeout(), 2)
+        self.assertEqual(removed, [])
+
+    def testShouldNotifyTheChangesWhileHoldingTheLock(self):
+        self.writeTargets("a.json", [{"targets": ["postgresql://one"], "labels": {"pool": "a"}}])
+        locked = []
+
+        sdConfig = FileSdConfig({"files": [self.dir.name], "refresh_interval": 0.001})
+        discovery = FileDiscovery([sdConfig], lambda added, removed: locked.append(discovery.lock.locked()))
+        discovery.refresh()
+
+        self.assertEqual(locked, [True])
+
+    def testShouldNotNotifyUnchangedFiles(self):
+        self.writeTargets("a.json", [{"targets": ["postgresql://one"], "labels": {"pool": "a"}}])
+        discovery = self.createDiscovery()
+        discovery.refresh()
+        discovery.nextRefreshAt = [0]
+        discovery.refresh()
+
+        self.assertEqual(len(self.changes), 1)
+
+    def testShouldNotifyOnlyTheChangedTargets(self):
+        self.writeTargets("a.json", [{"targets": ["postgresql://one", "postgresql://two"], "labels": {"pool": "a"}}], mtime=1000)
+        discovery = self.createDiscovery()
+        discovery.refresh()
+
+        self.writeTargets("a.json", [{"targets": ["postgresql://two", "postgresql://three"], "labels": {"pool": "a"}}], mtime=2000)
+        discovery.nextRefreshAt = [0]
+        discovery.refresh()
+
+        self.assertEqual(len(self.changes), 2)
+        added, removed = self.changes[1]
+        self.assertEqual([config.getDsn() for config in added], ["postgresql://three"])
+        self.assertEqual(removed, [("postgresql://one", (("pool", "a"),))])
+
+    def testShouldReplaceTheTargetsWhoseDefaultsChangedOnReconfigure(self):
+        self.writeTargets("a.json", [{"targets": ["postgresql://one"], "labels": {"pool": "a"}}])
+        discovery = self.createDiscovery({"connect_timeout": 5})
+        discovery.refresh()
+
+        sdConfig = FileSdConfig({"files": [self.dir.name], "defaults": {"connect_timeout": 1, "include_databases": ["foo"]}})
+        discovery.reconfigure([sdConfig])
+
+        self.assertEqual(len(self.changes), 2)
+        added, removed = self.changes[1]
+        self.assertEqual(removed, [("postgresql://one", (("pool", "a"),))])
+        self.assertEqual([config.getDsn() for config in added], ["postgresql://one"])
+        self.assertEqual(added[0].getConnectTimeout(), 1)
+        self.assertEqual(added[0].getIncludeDatabases(), ["foo"])
+
+    def testShouldNotNotifyUnchangedTargetsOnReconfigure(self):
+        self.writeTargets("a.json", [{"targets": ["postgresql://one"], "labels": {"pool": "a"}}])
+        discovery = self.createDiscovery({"connect_timeout": 5})
+        discovery.refresh()
+
+        discovery.reconfigure([FileSdConfig({"files": [self.dir.name], "defaults": {"connect_timeout": 5}})])
+
+        self.assertEqual(len(self.changes), 1)
+
+    def testShouldNotNotifyTargetsMovedToAnotherFile(self):
+        self.writeTargets("a.json", [{"targets": ["postgresql://one"], "labels": {"pool": "a"}}])
+        discovery = self.createDiscovery()
+        discovery.refresh()
+
+        os.remove(os.path.join(self.dir.name, "a.json"))
+        self.writeTargets("b.json", [{"targets": ["postgresql://one"], "labels": {"pool": "a"}}])
+        discovery.nextRefreshAt = [0]
+        discovery.refresh()
+
+        self.assertEqual(len(self.changes), 1)
+
+    def testShouldRemoveTheTargetsOfDeletedFiles(self):
+        self.writeTargets("a.json", [{"targets": ["postgresql://one"], "labels": {"pool": "a"}}])
+        discovery = self.createDiscovery()
+        discovery.refresh()
+
+        os.remove(os.path.join(self.dir.name, "a.json"))
+        discovery.nextRefreshAt = [0]
+        discovery.refresh()
+
+        self.assertEqual(self.changes[1], ([], [("postgresql://one", (("pool", "a"),))]))
+
+    def testShouldKeepTheTargetsOfUnparsableFiles(self):
+        self.writeTargets("a.json", [{"targets": ["postgresql://one"], "labels": {"pool": "a"}}], mtime=1000)
+        discovery = self.createDiscovery()
+        discovery.refresh()
+
+        path = os.path.join(self.dir.name, "a.json")
+        with open(path, "w") as stream:
+            stream.write("[{")
+        os.utime(path, (2000, 2000))
+
+        discovery.nextRefreshAt = [0]
+        discovery.refresh()
+
+        self.assertEqual(len(self.changes), 1)
+
+    def testShouldSkipInvalidTargets(self):
+        self.writeTargets("a.json", [{"targets": ["", "postgresql://one"], "labels": {"pool": "a"}}])
+        discovery = self.createDiscovery()
+        discovery.refresh()
+
+        added, removed = self.changes[0]
+        self.assertEqual([config.getDsn() for config in added], ["postgresql://one"])
+
+    def testShouldReadYamlTargetFiles(self):
+        with open(os.path.join(self.dir.name, "a.yml"), "w") as stream:
+            stream.write("- targets:\n    - postgresql://one\n  labels:\n    pool: a\n")
+
+        discovery = self.createDiscovery()
+        discovery.refresh()
+
+        added, removed = self.changes[0]
+        self.assertEqual([config.getDsn() for config in added], ["postgresql://one"])
+
+
+if __name__ == '__main__':
+    unittest.main()
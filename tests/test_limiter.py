@@ -0,0 +1,30 @@
+import unittest
+from prometheus_pgbouncer_exporter.limiter import *
+from prometheus_pgbouncer_exporter.pgwire import QueryResult
+
+
+class TestTopDatabasesLimiter(unittest.TestCase):
+
+    def testShouldRankDatabasesByIncrementSinceThePreviousScrape(self):
+        limiter = TopDatabasesLimiter(1, "total_xact_count")
+
+        def rank(rows):
+            return limiter.rank({"SHOW STATS": QueryResult(columns=("database", "total_xact_count"), rows=rows)}, lambda database: database != "pgbouncer")
+
+        self.assertEqual(rank([("test", 100), ("prod", 10), ("pgbouncer", 1000)]), {"test"})
+        self.assertEqual(rank([("test", 110), ("prod", 30), ("pgbouncer", 2000)]), {"prod"})
+
+        # A counter reset (ie. pgbouncer restart) counts the current value as increment
+        self.assertEqual(rank([("test", 5), ("prod", 40)]), {"prod"})
+        self.assertEqual(rank([("test", 50), ("prod", 41)]), {"test"})
+
+    def testShouldKeepThePreviousTopDatabasesIfTheRankingQueryFailed(self):
+        limiter = TopDatabasesLimiter(1, "cl_active")
+
+        self.assertEqual(limiter.rank({"SHOW POOLS": QueryResult(columns=("database", "cl_active"), rows=[("test", 1), ("prod", 2)])}, lambda database: True), {"prod"})
+        self.assertEqual(limiter.rank({"SHOW POOLS": False}, lambda database: True), {"prod"})
+        self.assertEqual(limiter.rank({}, lambda database: True), {"prod"})
+
+
+if __name__ == '__main__':
+    unittest.main()
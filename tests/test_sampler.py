@@ -0,0 +1,100 @@
+import unittest
+from unittest.mock import MagicMock
+from prometheus_pgbouncer_exporter.config import PgbouncerConfig
+from prometheus_pgbouncer_exporter.pgwire import QueryResult
+from prometheus_pgbouncer_exporter.sampler import *
+
+
+def getMetricsByName(metrics, name):
+    return list(filter(lambda item: item.name == name, metrics))
+
+
+class TestPoolsSampler(unittest.TestCase):
+
+    def createSampler(self, config, waiting):
+        # Sample the waiting clients of the "test" pool from the given sequence, while
+        # the pgbouncer counters grow by 10 transactions per sample
+        sequence = iter(waiting)
+        transactions = iter(range(0, 1000, 10))
+
+        def fetchMetricsMock(conn, query):
+            if query == "SHOW POOLS":
+                return QueryResult(columns=("database", "user", "cl_waiting", "maxwait", "maxwait_us"), rows=[("test", "marco", next(sequence), 0, 500000)])
+
+            return QueryResult(columns=("database", "total_xact_count", "total_wait_time"), rows=[("test", next(transactions), 2000000)])
+
+        sampler = PoolsSampler(PgbouncerConfig(dict({"sampler": {"interval": 1, "window": 5}}, **config)))
+        sampler._createConnection = MagicMock(return_value=MagicMock())
+        sampler._fetchMetrics = MagicMock(side_effect=fetchMetricsMock)
+
+        return sampler
+
+    def testShouldExportTheWindowMaxMeanAndQuantiles(self):
+        sampler = self.createSampler({}, [0, 8, 1, 2, 3, 4, 5])
+
+        for now in range(7):
+            self.assertTrue(sampler.sample(now=now))
+
+        metrics = list(sampler.export(lambda database: True, (), ()))
+
+        # The spike of 8 waiting clients is still in the window of the last 5 samples
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_pools_client_waiting_connections_window_max")[0].value, 5)
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_pools_client_waiting_connections_window_mean")[0].value, 3)
+        self.assertEqual([(sample.labels["quantile"], sample.value) for sample in getMetricsByName(metrics, "pgbouncer_pools_client_waiting_connections_window_quantile")], [("0.5", 3), ("0.9", 5), ("0.99", 5)])
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_pools_client_maxwait_seconds_window_max")[0].value, 0.5)
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_pools_client_waiting_connections_window_max")[0].labels, {"database": "test", "user": "marco"})
+
+    def testShouldKeepAFixedNumberOfSamplesPerPool(self):
+        sampler = self.createSampler({}, range(100))
+
+        for now in range(100):
+            sampler.sample(now=now)
+
+        self.assertEqual(len(sampler.pools[("test", "marco")]), 5)
+        self.assertEqual(len(sampler.stats["test"]), 5)
+
+    def testShouldExportThePerSecondRatesOfTheCounters(self):
+        sampler = self.createSampler({}, range(10))
+
+        sampler.sample(now=0)
+        self.assertEqual(getMetricsByName(list(sampler.export(lambda database: True, (), ())), "pgbouncer_stats_transactions_per_second"), [])
+
+        sampler.sample(now=0.5)
+        sampler.sample(now=1)
+        metrics = list(sampler.export(lambda database: True, (), ()))
+
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_stats_transactions_per_second")[0].value, 20)
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_stats_waiting_duration_seconds_per_second")[0].value, 0)
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_stats_queries_per_second"), [])
+
+    def testShouldForgetTheSamplesOnFailure(self):
+        sampler = self.createSampler({}, [1])
+        sampler.sample(now=0)
+        sampler._fetchMetrics.side_effect = Exception("Connection lost")
+
+        self.assertFalse(sampler.sample(now=1))
+        self.assertEqual(sampler.conn, False)
+
+        metrics = list(sampler.export(lambda database: True, (), ()))
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_pools_client_waiting_connections_window_max"), [])
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_exporter_sampler_errors")[0].value, 1)
+        self.assertEqual(getMetricsByName(metrics, "pgbouncer_exporter_sampler_samples")[0].value, 1)
+
+    def testShouldCountTheUnexpectedResultsAsErrors(self):
+        sampler = self.createSampler({}, [1])
+        sampler._fetchMetrics = MagicMock(return_value=QueryResult(columns=("database", "user", "cl_waiting"), rows=[("test", "marco", 1)]))
+
+        self.assertFalse(sampler.sample(now=0))
+        self.assertEqual(sampler.errors, 1)
+        self.assertEqual(sampler.pools, {})
+
+    def testShouldSampleOnlyTheFilteredDatabases(self):
+        sampler = self.createSampler({"exclude_databases": ["test"]}, [1])
+        sampler.sample(now=0)
+
+        self.assertEqual(sampler.pools, {})
+        self.assertEqual(sampler.stats, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import gzip
+import unittest
+from unittest.mock import MagicMock
+from wsgiref.util import setup_testing_defaults
+from prometheus_client import CollectorRegistry
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.openmetrics import exposition as openmetrics
+from prometheus_pgbouncer_exporter.collector import MetricsSnapshot, get_requested_scrape_timeout
+from prometheus_pgbouncer_exporter.server import *
+
+#
+# Helpers
+#
+
+def createSnapshot(generation, value):
+    family = GaugeMetricFamily("pgbouncer_up", "PgBouncer is UP", labels=["pool_id"])
+    family.add_metric(["1"], value)
+
+    return MetricsSnapshot(families=(family,), generation=generation, timestamp=None)
+
+def callApp(app, headers={}, query=""):
+    environ = {"QUERY_STRING": query}
+    environ.update(headers)
+    setup_testing_defaults(environ)
+
+    response = {}
+
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = dict(headers)
+
+    response["body"] = b"".join(app(environ, start_response))
+
+    return response
+
+#
+# Tests
+#
+
+class TestSnapshotExposition(unittest.TestCase):
+
+    def testShouldRenderOncePerSnapshotGeneration(self):
+        poller = MagicMock()
+        poller.snapshot = createSnapshot(1, 1)
+        poller.getSnapshot.side_effect = lambda: poller.snapshot
+        snapshotExposition = SnapshotExposition(poller)
+        snapshotExposition._render = MagicMock(side_effect=snapshotExposition._render)
+
+        first = snapshotExposition.get(exposition.CONTENT_TYPE_LATEST)
+        second = snapshotExposition.get(exposition.CONTENT_TYPE_LATEST)
+        self.assertIs(first, second)
+        self.assertIn(b'pgbouncer_up{pool_id="1"} 1.0', first.body)
+        self.assertEqual(gzip.decompress(first.gzipBody), first.body)
+
+        poller.snapshot = createSnapshot(2, 0)
+        third = snapshotExposition.get(exposition.CONTENT_TYPE_LATEST)
+        self.assertIn(b'pgbouncer_up{pool_id="1"} 0.0', third.body)
+        self.assertNotEqual(first.etag, third.etag)
+        self.assertEqual(snapshotExposition._render.call_count, 2)
+
+    def testShouldRenderOpenMetrics(self):
+        poller = MagicMock()
+        poller.snapshot = createSnapshot(1, 1)
+        poller.getSnapshot.side_effect = lambda: poller.snapshot
+        snapshotExposition = SnapshotExposition(poller)
+
+        rendered = snapshotExposition.get(openmetrics.CONTENT_TYPE_LATEST)
+        self.assertTrue(rendered.body.endswith(b"# EOF\n"))
+
+
+class TestExporterApp(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = MagicMock()
+        self.poller.snapshot = createSnapshot(1, 1)
+        self.poller.getSnapshot.side_effect = lambda: self.poller.snapshot
+        self.app = make_exporter_app(CollectorRegistry(), SnapshotExposition(self.poller))
+
+    def testShouldServeTheRenderedSnapshot(self):
+        response = callApp(self.app)
+
+        self.assertEqual(response["status"], "200 OK")
+        self.assertEqual(response["headers"]["Content-Type"], exposition.CONTENT_TYPE_LATEST)
+        self.assertNotIn("Content-Encoding", response["headers"])
+        self.assertIn(b'pgbouncer_up{pool_id="1"} 1.0', response["body"])
+
+    def testShouldServeTheCompressedSnapshotToGzipClients(self):
+        response = callApp(self.app, {"HTTP_ACCEPT_ENCODING": "gzip, deflate"})
+
+        self.assertEqual(response["headers"]["Content-Encoding"], "gzip")
+        self.assertEqual(response["headers"]["Content-Length"], str(len(response["body"])))
+        self.assertIn(b'pgbouncer_up{pool_id="1"} 1.0', gzip.decompress(response["body"]))
+
+    def testShouldReplyNotModifiedOnMatchingEtag(self):
+        etag = callApp(self.app)["headers"]["ETag"]
+
+        response = callApp(self.app, {"HTTP_IF_NONE_MATCH": etag})
+        self.assertEqual(response["status"], "304 Not Modified")
+        self.assertEqual(response["body"], b"")
+
+        self.poller.snapshot = createSnapshot(2, 1)
+        response = callApp(self.app, {"HTTP_IF_NONE_MATCH": etag})
+        self.assertEqual(response["status"], "200 OK")
+
+    def testShouldRenderFromTheRegistryWithoutSnapshot(self):
+        registry = CollectorRegistry()
+        registry.register(self.poller)
+        self.poller.collect.return_value = createSnapshot(1, 1).families
+
+        response = callApp(make_exporter_app(registry))
+
+        self.assertEqual(response["status"], "200 OK")
+        self.assertNotIn("ETag", response["headers"])
+        self.assertIn(b'pgbouncer_up{pool_id="1"} 1.0', response["body"])
+
+    def testShouldPassTheScrapeTimeoutRequestedByPrometheusToTheCollectors(self):
+        timeouts = []
+
+        def collect():
+            timeouts.append(get_requested_scrape_timeout())
+            return createSnapshot(1, 1).families
+
+        registry = CollectorRegistry()
+        registry.register(self.poller)
+        self.poller.collect.side_effect = collect
+        app = make_exporter_app(registry)
+
+        callApp(app, {"HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS": "10"})
+        callApp(app, {"HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS": "invalid"})
+        callApp(app)
+
+        self.assertEqual(timeouts, [10, None, None])
+        self.assertIsNone(get_requested_scrape_timeout())
+
+    def testShouldPassTheScrapeTimeoutRequestedByPrometheusToTheSnapshots(self):
+        timeouts = []
+
+        def getSnapshot():
+            timeouts.append(get_requested_scrape_timeout())
+            return createSnapshot(1, 1)
+
+        self.poller.getSnapshot.side_effect = getSnapshot
+        callApp(self.app, {"HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS": "10"})
+
+        self.assertEqual(timeouts, [10])
+
+    def testShouldServeTheProbedPgbouncer(self):
+        prober = MagicMock()
+        prober.probe.side_effect = lambda target: createSnapshot(1, 1).families if target == "one" else None
+        app = make_exporter_app(CollectorRegistry(), prober=prober)
+
+        response = callApp(app, {"PATH_INFO": "/probe"}, "target=one")
+        self.assertEqual(response["status"], "200 OK")
+        self.assertIn(b'pgbouncer_up{pool_id="1"} 1.0', response["body"])
+
+        self.assertEqual(callApp(app, {"PATH_INFO": "/probe"}, "target=two")["status"], "404 Not Found")
+        self.assertEqual(callApp(app, {"PATH_INFO": "/probe"})["status"], "400 Bad Request")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from prometheus_pgbouncer_exporter.config import PgbouncerConfig
+from prometheus_pgbouncer_exporter.sharding import Shard
+
+
+def createConfigs(count):
+    return [PgbouncerConfig({"dsn": "postgresql://pgbouncer-{index}".format(index=index), "extra_labels": {"pool_id": index}}) for index in range(count)]
+
+
+def getOwners(configs, count):
+    shards = [Shard(index, count) for index in range(count)]
+
+    return [[shard.index for shard in shards if shard.owns(config)] for config in configs]
+
+
+class TestShard(unittest.TestCase):
+
+    def testShouldOwnAllPgbouncersWithASingleShard(self):
+        self.assertTrue(all(Shard().owns(config) for config in createConfigs(10)))
+
+    def testShouldAssignEachPgbouncerToExactlyOneShard(self):
+        owners = getOwners(createConfigs(300), 3)
+
+        self.assertTrue(all(len(shards) == 1 for shards in owners))
+
+        # Each shard owns roughly a third of the pgbouncers
+        for index in range(3):
+            self.assertGreater(sum(1 for shards in owners if shards == [index]), 60)
+
+    def testShouldOnlyMovePgbouncersToTheAddedShard(self):
+        configs = createConfigs(300)
+        before = getOwners(configs, 3)
+        after = getOwners(configs, 4)
+
+        moved = [(previous, current) for previous, current in zip(before, after) if previous != current]
+
+        self.assertTrue(all(current == [3] for previous, current in moved))
+        self.assertLess(len(moved), 150)
+
+    def testShouldKeepTheOwnerWhenTheDsnChanges(self):
+        config = PgbouncerConfig({"dsn": "postgresql://one", "extra_labels": {"pool_id": 1}})
+        changed = PgbouncerConfig({"dsn": "postgresql://two", "extra_labels": {"pool_id": 1}})
+
+        self.assertEqual(getOwners([config], 5), getOwners([changed], 5))
+
+    def testShouldRaiseExceptionOnInvalidIndex(self):
+        with self.assertRaisesRegex(Exception, "The shard index must be between 0"):
+            Shard(2, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+from prometheus_pgbouncer_exporter.watchdog import *
+
+
+class TestQueryWatchdog(unittest.TestCase):
+
+    def testShouldCancelOnlyTheOverdueQueriesFromASingleThread(self):
+        watchdog = QueryWatchdog()
+        cancelled = threading.Event()
+        overdue = MagicMock()
+        overdue.cancel = MagicMock(side_effect=cancelled.set)
+        completed = MagicMock()
+
+        inTime = [watchdog.watch(completed, 0.05) for _ in range(50)]
+        thread = watchdog.thread
+        late = watchdog.watch(overdue, 0.05)
+        self.assertIs(watchdog.thread, thread)
+
+        for query in inTime:
+            watchdog.unwatch(query)
+
+        self.assertTrue(cancelled.wait(1))
+        self.assertTrue(late.cancelled)
+        self.assertFalse(any(query.cancelled for query in inTime))
+        completed.cancel.assert_not_called()
+
+    def testShouldNotCancelACompletedQuery(self):
+        watchdog = QueryWatchdog()
+        conn = MagicMock()
+
+        query = watchdog.watch(conn, 10)
+        watchdog.unwatch(query)
+        query.cancel()
+
+        self.assertFalse(query.cancelled)
+        conn.cancel.assert_not_called()
+
+    def testShouldWaitForTheInflightCancelOnUnwatch(self):
+        watchdog = QueryWatchdog()
+        sending = threading.Event()
+        release = threading.Event()
+        conn = MagicMock()
+        conn.cancel = MagicMock(side_effect=lambda: sending.set() or release.wait(1))
+
+        query = watchdog.watch(conn, 0)
+        self.assertTrue(sending.wait(1))
+
+        unwatching = threading.Thread(target=watchdog.unwatch, args=(query,))
+        unwatching.start()
+        unwatching.join(0.05)
+        self.assertTrue(unwatching.is_alive())
+
+        release.set()
+        unwatching.join(1)
+        self.assertFalse(unwatching.is_alive())
+        self.assertTrue(query.cancelled)
+        self.assertTrue(query.done)
+
+
+if __name__ == '__main__':
+    unittest.main()